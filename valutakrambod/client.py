@@ -2,16 +2,21 @@
 # Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
 # This file is covered by the GPLv2 or later, read COPYING for details.
 
-import functools
 import tornado.ioloop
 
+from tornado import gen
+
 from . import *
 
 class SimpleClient(object):
-    def __init__(self):
+    """Print the rates of all known services.  The services run in the
+given tornado IOLoop or asyncio event loop, or the current IOLoop if
+none is given.
+
+    """
+    def __init__(self, ioloop=None):
+        self.ioloop = ioloop
         self.services = []
-        self.streams = []
-        pass
     def newdata(self, service, pair, changed):
         print("%-15s %s-%s: %8.3f %8.3f" % (
             service.servicename(),
@@ -20,32 +25,20 @@ class SimpleClient(object):
             service.rates[pair]['ask'],
             service.rates[pair]['bid'])
         )
-    async def refresh(self, service):
-        await service.fetchRates(service.wantedpairs)
     def run(self):
-        self.ioloop = tornado.ioloop.IOLoop.current()
-        self.services = valutakrambod.service.knownServices()
-        for e in self.services:
-            service = e()
+        self.ioloop = valutakrambod.services.tornadoloop(self.ioloop) \
+            or tornado.ioloop.IOLoop.current()
+        for e in valutakrambod.service.knownServices():
+            service = e(ioloop=self.ioloop)
             service.subscribe(self.newdata)
-            stream = service.websocket()
-            if stream:
-                self.streams.append(stream)
-            else:
-                # Fetch information from non-streaming services immediately
-                self.ioloop.call_later(len(self.services),
-                                       functools.partial(self.refresh, service))
-                # as well as regularly
-                service.periodicUpdate(60)
-        for stream in self.streams:
-            stream.connect()
+            self.services.append(service.start(60))
         try:
             self.ioloop.start()
         except KeyboardInterrupt:
             print("Interrupted by keyboard, closing all connections.")
-            pass
-        for stream in self.streams:
-            stream.close()
+        self.ioloop.run_sync(self.close)
+    async def close(self):
+        await gen.multi([service.aclose() for service in self.services])
 
 def BTCrates():
     client = SimpleClient()
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Run the services in separate worker processes, and publish their
+rates in a rate table in shared memory.
+
+The rate table is a file mapped into memory, normally in /dev/shm.  It
+start with a header and a directory listing the service and pair of
+each slot, followed by one fixed size slot per service and pair.  Each
+slot hold the ask and bid prices, the update times and the top levels
+of the order book as floating point numbers.
+
+There is one writer per slot, and any number of readers in any local
+process.  The slots are protected by a sequence lock: the writer
+increment the sequence counter before and after updating the slot, and
+readers retry if the counter was odd or changed while they read.
+Readers never block the writer.
+
+Example use:
+
+  ingestor = Ingestor([[Kraken, Bitstamp], [Bl3p]])
+  ingestor.start()
+  ...
+  print(ingestor.table.rates())
+  ingestor.stop()
+
+"""
+
+import functools
+import multiprocessing
+import mmap
+import os
+import struct
+import tempfile
+import time
+import unittest
+
+import tornado.ioloop
+
+from tornado import gen
+
+MAGIC = b'VKRT'
+HEADER = struct.Struct('<4sIII')
+KEY = struct.Struct('<64s')
+SEQ = struct.Struct('<Q')
+TOP = struct.Struct('<dddd')
+
+class RateTable(object):
+    """A rate table in a memory mapped file.  Use create() to make a new
+table and RateTable(path) to open an existing one.
+
+    """
+    def __init__(self, path, writable = False):
+        self.path = path
+        flags = os.O_RDWR if writable else os.O_RDONLY
+        fd = os.open(path, flags)
+        try:
+            size = os.fstat(fd).st_size
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            self.m = mmap.mmap(fd, size, access=access)
+        finally:
+            os.close(fd)
+        magic, self.nslots, self.depth, self.slotsize = \
+            HEADER.unpack_from(self.m, 0)
+        if MAGIC != magic:
+            raise ValueError('%s is not a rate table' % path)
+        self.levels = struct.Struct('<%dd' % (4 * self.depth))
+        self.keys = []
+        self.slots = {}
+        for i in range(self.nslots):
+            key = KEY.unpack_from(self.m, HEADER.size + i * KEY.size)[0]
+            service, pair = key.rstrip(b'\0').decode('UTF-8').split(' ')
+            key = (service, tuple(pair.split('-')))
+            self.keys.append(key)
+            self.slots[key] = i
+        self.base = HEADER.size + self.nslots * KEY.size
+    @classmethod
+    def create(cls, path, keys, depth = 5):
+        """Create a rate table in path with one slot per (service name, pair)
+key, with room for depth order book levels per side.
+
+        """
+        slotsize = SEQ.size + TOP.size + 4 * depth * 8
+        size = HEADER.size + len(keys) * (KEY.size + slotsize)
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(keys), depth, slotsize))
+            for service, pair in keys:
+                f.write(KEY.pack(("%s %s-%s" % ((service,) + pair)).encode('UTF-8')))
+            f.write(b'\0' * (size - f.tell()))
+        return cls(path, writable=True)
+    def close(self):
+        self.m.close()
+    def _offset(self, slot):
+        return self.base + slot * self.slotsize
+    def write(self, slot, ask, bid, when, stored, asks = (), bids = ()):
+        """Update the slot.  asks and bids are lists of (price, volume)
+tuples, best price first.  Missing levels are stored as zero.
+
+        """
+        offset = self._offset(slot)
+        seq = SEQ.unpack_from(self.m, offset)[0]
+        SEQ.pack_into(self.m, offset, seq + 1)
+        TOP.pack_into(self.m, offset + SEQ.size, ask, bid, when or 0, stored)
+        values = []
+        for levels in (asks, bids):
+            levels = list(levels)[:self.depth]
+            for price, volume in levels:
+                values.extend((price, volume))
+            values.extend([0.0] * (2 * (self.depth - len(levels))))
+        self.levels.pack_into(self.m, offset + SEQ.size + TOP.size, *values)
+        SEQ.pack_into(self.m, offset, seq + 2)
+    def read(self, slot, retries = 1000):
+        """Return the content of slot as a dictionary, or None if the slot was
+never written.  Raise RuntimeError if no consistent copy could be
+read after the given number of attempts.
+
+        """
+        offset = self._offset(slot)
+        for attempt in range(retries):
+            before = SEQ.unpack_from(self.m, offset)[0]
+            if before & 1:
+                continue
+            ask, bid, when, stored = TOP.unpack_from(self.m, offset + SEQ.size)
+            values = self.levels.unpack_from(self.m, offset + SEQ.size + TOP.size)
+            if before != SEQ.unpack_from(self.m, offset)[0]:
+                continue
+            if 0 == before:
+                return None
+            n = 2 * self.depth
+            return {
+                'ask': ask,
+                'bid': bid,
+                'when': when or None,
+                'stored': stored,
+                'asks': [l for l in zip(values[0:n:2], values[1:n:2]) if l[1]],
+                'bids': [l for l in zip(values[n::2], values[n+1::2]) if l[1]],
+                'seq': before,
+            }
+        raise RuntimeError('unable to read consistent rate table slot %d' % slot)
+    def rates(self):
+        """Return a dictionary with the content of all written slots, with
+(service name, pair) as the key.
+
+        """
+        res = {}
+        for i, key in enumerate(self.keys):
+            r = self.read(i)
+            if r is not None:
+                res[key] = r
+        return res
+
+def _publish(table, slots, service, pair, changed):
+    if pair not in slots:
+        return
+    r = service.rates[pair]
+    asks = bids = ()
+    book = service.orderbooks.get(pair)
+    if book is not None:
+        asks = [(float(p), float(v)) for p, v in book.ask.items()[:table.depth]]
+        bids = [(float(p), float(v)) for p, v in book.bid.items()[:table.depth]]
+    table.write(slots[pair], float(r['ask']), float(r['bid']),
+                r['when'] and float(r['when']), r['stored'], asks, bids)
+
+def worker(path, services, period = 60, stop = None):
+    """Run the given services and publish their rates in the rate table
+in path.  services is a list of (service class, {pair: slot}) tuples.
+Services without websocket support are polled every period seconds.
+The services are closed and the worker return when the multiprocessing
+event stop is set, or on KeyboardInterrupt.
+
+    """
+    ioloop = tornado.ioloop.IOLoop.current()
+    table = RateTable(path, writable=True)
+    running = []
+    for cls, slots in services:
+        service = cls(ioloop=ioloop)
+        service.subscribe(functools.partial(_publish, table, slots))
+        running.append(service.start(period))
+    async def close():
+        await gen.multi([service.aclose() for service in running])
+    async def shutdown():
+        await close()
+        ioloop.stop()
+    def checkstop():
+        if stop.is_set():
+            watcher.stop()
+            ioloop.add_callback(shutdown)
+    if stop is not None:
+        watcher = tornado.ioloop.PeriodicCallback(checkstop, 100)
+        watcher.start()
+    try:
+        ioloop.start()
+    except KeyboardInterrupt:
+        ioloop.run_sync(close)
+    table.close()
+
+class Ingestor(object):
+    """Run groups of services in worker processes, one process per group,
+publishing to a common rate table available in the table member.
+Use check() or is_alive() to find workers that died, and errsubscribe()
+to be told about them.
+
+    """
+    def __init__(self, groups, path = None, depth = 5, period = 60):
+        if path is None:
+            shm = '/dev/shm'
+            fd, path = tempfile.mkstemp(prefix='valutakrambod-', suffix='.rates',
+                                        dir=shm if os.path.isdir(shm) else None)
+            os.close(fd)
+        self.path = path
+        self.period = period
+        self.groups = []
+        self.names = []
+        keys = []
+        for group in groups:
+            g = []
+            names = []
+            for cls in group:
+                service = cls()
+                slots = {}
+                for pair in service.wantedpairs or []:
+                    slots[pair] = len(keys)
+                    keys.append((service.servicename(), pair))
+                g.append((cls, slots))
+                names.append(service.servicename())
+            self.groups.append(g)
+            self.names.append(names)
+        self.table = RateTable.create(path, keys, depth)
+        self.processes = []
+        self.stopping = None
+        self.dead = set()
+        self.errsubscribers = []
+    def errsubscribe(self, callback):
+        self.errsubscribers.append(callback)
+    def logerror(self, msg):
+        for s in self.errsubscribers:
+            s(self, msg)
+    def start(self):
+        # Use fresh processes instead of forking the IO loop and
+        # HTTP clients of this process.
+        ctx = multiprocessing.get_context('spawn')
+        self.stopping = ctx.Event()
+        for group in self.groups:
+            p = ctx.Process(target=worker,
+                            args=(self.path, group, self.period, self.stopping),
+                            daemon=True)
+            p.start()
+            self.processes.append(p)
+    def is_alive(self):
+        """Return True if all the worker processes are running."""
+        return all(p.is_alive() for p in self.processes)
+    def check(self):
+        """Return the names of the services in the worker processes that
+died, and log the workers not reported by an earlier call.
+
+        """
+        res = []
+        for p, names in zip(self.processes, self.names):
+            if p.is_alive():
+                continue
+            res.extend(names)
+            if p.pid not in self.dead:
+                self.dead.add(p.pid)
+                self.logerror("worker running %s died with exit code %s" %
+                              (", ".join(names), p.exitcode))
+        return res
+    def stop(self, timeout = 10):
+        """Ask the workers to close their services, and terminate the workers
+still running after timeout seconds.
+
+        """
+        self.check()
+        if self.stopping is not None:
+            self.stopping.set()
+        deadline = time.monotonic() + timeout
+        for p in self.processes:
+            p.join(max(0, deadline - time.monotonic()))
+        for p, names in zip(self.processes, self.names):
+            if p.is_alive():
+                self.logerror("worker running %s did not stop in %d seconds, terminating" %
+                              (", ".join(names), timeout))
+                p.terminate()
+                p.join()
+        self.processes = []
+        self.table.close()
+        os.unlink(self.path)
+
+class TestIngest(unittest.TestCase):
+    """
+Run simple self test of the rate table and the worker processes.
+"""
+    def testTable(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            keys = [('A', ('BTC', 'EUR')), ('B', ('BTC', 'USD'))]
+            t = RateTable.create(path, keys, depth=2)
+            t.write(1, 101.0, 99.0, None, 5.0, [(101.0, 1.0)],
+                    [(99.0, 2.0), (98.0, 1.0), (97.0, 1.0)])
+            reader = RateTable(path)
+            self.assertEqual(keys, reader.keys)
+            self.assertEqual(None, reader.read(0))
+            r = reader.rates()[('B', ('BTC', 'USD'))]
+            self.assertEqual(101.0, r['ask'])
+            self.assertEqual([(101.0, 1.0)], r['asks'])
+            self.assertEqual([(99.0, 2.0), (98.0, 1.0)], r['bids'])
+            # A write in progress is never returned
+            SEQ.pack_into(t.m, t._offset(1), 3)
+            self.assertRaises(RuntimeError, reader.read, 1, 10)
+            reader.close()
+            t.close()
+        finally:
+            os.unlink(path)
+    def testWorker(self):
+        from valutakrambod.service.dummyservice import DummyService
+        i = Ingestor([[DummyService]])
+        errors = []
+        i.errsubscribe(lambda ingestor, msg: errors.append(msg))
+        i.start()
+        try:
+            for n in range(100):
+                rates = i.table.rates()
+                if rates:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(1, len(rates))
+            r = list(rates.values())[0]
+            self.assertTrue(r['ask'] > r['bid'])
+            self.assertEqual(5, len(r['asks']))
+            self.assertTrue(i.is_alive())
+            self.assertEqual([], i.check())
+            processes = list(i.processes)
+        finally:
+            i.stop()
+        # The worker stopped on request instead of being terminated
+        self.assertEqual([0], [p.exitcode for p in processes])
+        self.assertEqual([], errors)
+    def testDeadWorker(self):
+        import signal
+        from valutakrambod.service.dummyservice import DummyService
+        i = Ingestor([[DummyService], [DummyService]])
+        errors = []
+        i.errsubscribe(lambda ingestor, msg: errors.append(msg))
+        i.start()
+        try:
+            dead = i.processes[1]
+            os.kill(dead.pid, signal.SIGKILL)
+            dead.join()
+            self.assertFalse(i.is_alive())
+            self.assertEqual(i.names[1], i.check())
+            # Only reported once
+            i.check()
+            self.assertEqual(1, len(errors))
+            self.assertIn(i.names[1][0], errors[0])
+        finally:
+            i.stop()
+        self.assertEqual(1, len(errors))
+
+if __name__ == '__main__':
+    unittest.main()
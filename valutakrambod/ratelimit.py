@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Token bucket rate limiting of the requests sent to the services.
+
+Each service declare its limits in the ratelimits class member, a
+dictionary with the endpoint class ('public', 'private' or 'order') as
+the key and a (rate, burst) tuple as the value.  The rate is the
+number of requests per second allowed in the long run, and burst the
+number of requests which can be sent back to back.  Endpoint classes
+without a declared limit are not throttled.
+
+The buckets are shared between all service objects talking to the
+same host, to ensure several instances of the same service together
+stay within the limits of the exchange.
+
+"""
+
+import time
+import unittest
+
+from tornado import gen
+
+class TokenBucket(object):
+    """A token bucket refilled with rate tokens per second, holding at most
+burst tokens.  Every request consume one token.  Requests arriving
+when the bucket is empty reserve a future token and wait for it,
+making sure waiting requests are served in the order they arrived.
+
+    """
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError('rate must be a positive number')
+        if burst < 1:
+            raise ValueError('burst must be at least one')
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.last = clock()
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+    def available(self):
+        """Return True if a request can be sent right away."""
+        self._refill()
+        return self.tokens >= 1
+    def tryacquire(self):
+        """Consume a token if one is available right away.  Return True if a
+token was consumed, False otherwise.
+
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    def reserve(self):
+        """Consume a token, and return the number of seconds to wait before
+the request it represent can be sent.
+
+        """
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+    async def acquire(self):
+        """Wait until a token is available.  Return the number of seconds
+spent waiting.
+
+        """
+        delay = self.reserve()
+        if 0 < delay:
+            await gen.sleep(delay)
+        return delay
+
+_buckets = {}
+
+def bucket(host, endpoint, rate, burst):
+    """Return the shared token bucket for the given host and endpoint
+class, creating it if it does not exist yet or if the limits changed.
+
+    """
+    key = (host, endpoint)
+    b = _buckets.get(key)
+    if b is None or b.rate != rate or b.burst != burst:
+        b = TokenBucket(rate, burst)
+        _buckets[key] = b
+    return b
+
+class TestTokenBucket(unittest.TestCase):
+    """
+Run simple self test of the token bucket.
+"""
+    def setUp(self):
+        self.now = 0.0
+        self.b = TokenBucket(2, burst=3, clock=lambda: self.now)
+    def testBurst(self):
+        for i in range(3):
+            self.assertEqual(0, self.b.reserve())
+        self.assertFalse(self.b.available())
+        self.assertEqual(0.5, self.b.reserve())
+        self.assertEqual(1.0, self.b.reserve())
+    def testRefill(self):
+        for i in range(3):
+            self.assertTrue(self.b.tryacquire())
+        self.assertFalse(self.b.tryacquire())
+        self.now += 0.5
+        self.assertTrue(self.b.tryacquire())
+        self.assertFalse(self.b.tryacquire())
+        # Never refill above the burst size
+        self.now += 100
+        for i in range(3):
+            self.assertTrue(self.b.tryacquire())
+        self.assertFalse(self.b.tryacquire())
+    def testSharedBuckets(self):
+        a = bucket('api.example.com', 'public', 1, 1)
+        self.assertTrue(a is bucket('api.example.com', 'public', 1, 1))
+        self.assertFalse(a is bucket('api.example.com', 'private', 1, 1))
+        self.assertFalse(a is bucket('api.example.com', 'public', 2, 1))
+
+if __name__ == '__main__':
+    unittest.main()
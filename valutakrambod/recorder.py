@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Record raw websocket messages and HTTP bodies received from the
+services, and replay them later to reproduce problems and measure the
+parser performance offline.
+
+The recording is an append only file starting with a magic string,
+followed by one record per message.  Each record consist of a header
+with the receive timestamp, the record type, the length of the
+service name, the length of the URL and the length of the payload,
+followed by the service name, the URL and the raw payload.  For
+websocket messages the URL is the websocket URL, followed by #N if the
+message was received by client number N of a WebSocketClientGroup.
+
+To record, set the recorder member of the services to a Recorder
+object.  To replay, use replay() with a set of websocket clients.
+The messages are fed to the _on_message() method of the client of the
+service they were received from.
+
+"""
+
+import collections
+import os
+import struct
+import tempfile
+import time
+import unittest
+
+MAGIC = b'VKREC1\n'
+HEADER = struct.Struct('<dBHHI')
+
+WEBSOCKET = 1
+HTTP = 2
+
+Record = collections.namedtuple('Record',
+                                ['when', 'kind', 'service', 'url', 'payload'])
+
+class Recorder(object):
+    def __init__(self, path):
+        self.f = open(path, 'ab')
+        if 0 == self.f.tell():
+            self.f.write(MAGIC)
+    def record(self, kind, service, payload, url = '', when = None):
+        """Append a record of the message payload received from service.
+The payload is a string or bytes.
+
+        """
+        if when is None:
+            when = time.time()
+        if isinstance(payload, str):
+            payload = payload.encode('UTF-8')
+        service = service.encode('UTF-8')
+        url = url.encode('UTF-8')
+        self.f.write(HEADER.pack(when, kind, len(service), len(url),
+                                 len(payload)))
+        self.f.write(service)
+        self.f.write(url)
+        self.f.write(payload)
+    def flush(self):
+        self.f.flush()
+    def close(self):
+        self.f.close()
+
+def records(path):
+    """Return an iterator over the records in the recording."""
+    with open(path, 'rb') as f:
+        if MAGIC != f.read(len(MAGIC)):
+            raise ValueError('%s is not a valutakrambod recording' % path)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                # End of file, or the last record was cut short
+                return
+            when, kind, servicelen, urllen, payloadlen = HEADER.unpack(header)
+            service = f.read(servicelen).decode('UTF-8')
+            url = f.read(urllen).decode('UTF-8')
+            payload = f.read(payloadlen)
+            if len(payload) < payloadlen:
+                return
+            yield Record(when, kind, service, url, payload)
+
+def shardof(url):
+    """Return the number of the client in a websocket client group
+receiving a websocket message recorded with url, or None if it was not
+received by a group.
+
+    """
+    base, sep, shard = url.rpartition('#')
+    if not sep or not shard.isdigit():
+        return None
+    return int(shard)
+
+def replay(path, clients, speed = None):
+    """Feed the websocket messages in the recording to the _on_message()
+method of the clients, a dictionary with the service name as key and
+the websocket client as value.  Messages from services without a
+client and HTTP bodies are skipped.  Messages received by a client in
+a websocket client group are passed to the client with the same number
+in the group given in clients, as the channels and order book state
+are per connection.
+
+If speed is None or zero, the messages are fed as fast as possible.
+Otherwise they are fed at speed times the recorded pace, ie 1 for
+the recorded speed.
+
+Return a dictionary with statistics per service, with the number of
+messages, the number of messages failing, the time spent handling them
+and the number of messages per second the handler sustained.
+
+    """
+    stats = {}
+    first = None
+    start = time.time()
+    for r in records(path):
+        if WEBSOCKET != r.kind or r.service not in clients:
+            continue
+        if first is None:
+            first = r.when
+        if speed:
+            delay = start + (r.when - first) / speed - time.time()
+            if 0 < delay:
+                time.sleep(delay)
+        if r.service not in stats:
+            stats[r.service] = {'messages': 0, 'errors': 0, 'seconds': 0.0}
+        s = stats[r.service]
+        msg = r.payload.decode('UTF-8')
+        client = clients[r.service]
+        shard = shardof(r.url)
+        if shard is not None and shard < len(getattr(client, 'clients', [])):
+            client = client.clients[shard]
+        before = time.perf_counter()
+        try:
+            client._on_message(msg)
+        except Exception:
+            s['errors'] += 1
+        s['seconds'] += time.perf_counter() - before
+        s['messages'] += 1
+    for s in stats.values():
+        if 0 < s['seconds']:
+            s['rate'] = s['messages'] / s['seconds']
+        else:
+            s['rate'] = float('inf')
+    return stats
+
+class TestRecorder(unittest.TestCase):
+    """
+Run simple self test of the recorder and replay.
+"""
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.path)
+    def tearDown(self):
+        os.unlink(self.path)
+    def testRoundtrip(self):
+        r = Recorder(self.path)
+        r.record(WEBSOCKET, 'Kraken', '{"event":"heartbeat"}', when=1.0)
+        r.record(HTTP, 'Bl3p', b'{}', url='https://api.bl3p.eu/', when=2.0)
+        r.close()
+        # Appending keep the existing records
+        r = Recorder(self.path)
+        r.record(WEBSOCKET, 'Kraken', '[1]', when=3.0)
+        r.close()
+        l = list(records(self.path))
+        self.assertEqual(3, len(l))
+        self.assertEqual(Record(2.0, HTTP, 'Bl3p', 'https://api.bl3p.eu/', b'{}'),
+                         l[1])
+        self.assertEqual(b'[1]', l[2].payload)
+    def testReplay(self):
+        r = Recorder(self.path)
+        for i in range(10):
+            r.record(WEBSOCKET, 'Kraken', str(i), when=i / 1000)
+        r.record(WEBSOCKET, 'Other', 'x')
+        r.close()
+        class Client(object):
+            def __init__(self):
+                self.messages = []
+            def _on_message(self, msg):
+                if '5' == msg:
+                    raise ValueError()
+                self.messages.append(msg)
+        c = Client()
+        stats = replay(self.path, {'Kraken': c}, speed=1)
+        self.assertEqual(['0', '1', '2', '3', '4', '6', '7', '8', '9'],
+                         c.messages)
+        self.assertEqual(10, stats['Kraken']['messages'])
+        self.assertEqual(1, stats['Kraken']['errors'])
+        self.assertFalse('Other' in stats)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Helpers to handle failing services: jittered exponential backoff for
+retrying requests, and a circuit breaker pausing the polling of a
+service after repeated failures.
+
+"""
+
+import random
+import time
+import unittest
+
+from tornado import httpclient
+
+def backoff(attempt, base=0.5, cap=30, rand=random.random):
+    """Return the number of seconds to wait before retry number attempt
+(counting from zero), using exponential backoff with full jitter.
+
+    """
+    return rand() * min(cap, base * 2 ** attempt)
+
+def retryable(exception):
+    """Return True if the request failing with exception is worth
+retrying, ie if it failed because of a network problem, a server side
+problem or rate limiting, and not because of a problem with the
+request itself.
+
+    """
+    if isinstance(exception, httpclient.HTTPError):
+        # 599 is used by tornado for timeouts and connection problems
+        return exception.code in (429, 599) or 500 <= exception.code < 600
+    return isinstance(exception, (OSError, TimeoutError))
+
+def retryafter(exception):
+    """Return the delay in seconds requested by the service in a
+Retry-After header, or None if no delay was requested.
+
+    """
+    response = getattr(exception, 'response', None)
+    if response is None or 'Retry-After' not in response.headers:
+        return None
+    try:
+        return float(response.headers['Retry-After'])
+    except ValueError:
+        # Ignore the HTTP-date form of the header
+        return None
+
+class CircuitBreaker(object):
+    """Keep track of consecutive failures for a service.  After threshold
+failures in a row, the circuit open and allow() return False for
+cooldown seconds.  After that a single probe is allowed through.  If
+it succeed, the circuit close again, while if it fail the circuit open
+again with twice the cooldown, up to maxcooldown seconds.
+
+The onchange callback is called with the new state every time the
+state change.
+
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALFOPEN = "half-open"
+    def __init__(self, threshold=5, cooldown=30, maxcooldown=600,
+                 onchange=None, clock=time.monotonic):
+        self.threshold = threshold
+        self.basecooldown = cooldown
+        self.cooldown = cooldown
+        self.maxcooldown = maxcooldown
+        self.onchange = onchange
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.openuntil = 0
+        self.probing = False
+    def _setstate(self, state):
+        if state != self.state:
+            self.state = state
+            if self.onchange:
+                self.onchange(state)
+    def allow(self):
+        """Return True if a request should be attempted now."""
+        if self.CLOSED == self.state:
+            return True
+        if self.OPEN == self.state and self.clock() >= self.openuntil:
+            self._setstate(self.HALFOPEN)
+        if self.HALFOPEN == self.state and not self.probing:
+            self.probing = True
+            return True
+        return False
+    def success(self):
+        self.failures = 0
+        self.probing = False
+        self.cooldown = self.basecooldown
+        self._setstate(self.CLOSED)
+    def failure(self):
+        self.failures += 1
+        if self.HALFOPEN == self.state:
+            self.probing = False
+            self.cooldown = min(self.maxcooldown, 2 * self.cooldown)
+            self._open()
+        elif self.CLOSED == self.state and self.failures >= self.threshold:
+            self._open()
+    def _open(self):
+        self.openuntil = self.clock() + self.cooldown
+        self._setstate(self.OPEN)
+
+class TestCircuitBreaker(unittest.TestCase):
+    """
+Run simple self test of the circuit breaker.
+"""
+    def setUp(self):
+        self.now = 0.0
+        self.states = []
+        self.c = CircuitBreaker(threshold=3, cooldown=10, maxcooldown=15,
+                                onchange=self.states.append,
+                                clock=lambda: self.now)
+    def testTrip(self):
+        for i in range(2):
+            self.c.failure()
+            self.assertTrue(self.c.allow())
+        self.c.failure()
+        self.assertFalse(self.c.allow())
+        self.assertEqual([CircuitBreaker.OPEN], self.states)
+    def testProbe(self):
+        for i in range(3):
+            self.c.failure()
+        self.now += 10
+        # Only one probe at the time
+        self.assertTrue(self.c.allow())
+        self.assertFalse(self.c.allow())
+        self.c.failure()
+        self.assertEqual(CircuitBreaker.OPEN, self.c.state)
+        self.now += 10
+        self.assertFalse(self.c.allow())
+        self.now += 5
+        self.assertTrue(self.c.allow())
+        self.c.success()
+        self.assertTrue(self.c.allow())
+        self.assertEqual([CircuitBreaker.OPEN, CircuitBreaker.HALFOPEN,
+                          CircuitBreaker.OPEN, CircuitBreaker.HALFOPEN,
+                          CircuitBreaker.CLOSED], self.states)
+    def testBackoff(self):
+        self.assertEqual(2, backoff(2, base=0.5, cap=30, rand=lambda: 1))
+        self.assertEqual(30, backoff(10, base=0.5, cap=30, rand=lambda: 1))
+    def testRetryable(self):
+        self.assertTrue(retryable(httpclient.HTTPError(503)))
+        self.assertTrue(retryable(httpclient.HTTPError(429)))
+        self.assertFalse(retryable(httpclient.HTTPError(404)))
+        self.assertTrue(retryable(ConnectionRefusedError()))
+        self.assertFalse(retryable(ValueError()))
+
+if __name__ == '__main__':
+    unittest.main()
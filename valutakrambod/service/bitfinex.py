@@ -2,12 +2,36 @@
 # Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
 # This file is covered by the GPLv2 or later, read COPYING for details.
 
+import simplejson
 import unittest
 import time
 import tornado.ioloop
+import zlib
 
 from decimal import Decimal
+from valutakrambod.services import Orderbook
 from valutakrambod.services import Service
+from valutakrambod.websocket import WebSocketClient
+from valutakrambod.websocket import shard
+
+def jsnumber(value):
+    """Return the Decimal value formatted like JavaScript format numbers,
+ie without trailing zeros, and using exponent form only for values
+below 1e-6 or from 1e21.
+
+    """
+    if 0 == value:
+        return '0'
+    value = value.normalize()
+    if Decimal('1e-6') <= abs(value) < Decimal('1e21'):
+        return '{:f}'.format(value)
+    sign, digits, exponent = value.as_tuple()
+    mantissa = ''.join(map(str, digits))
+    if 1 < len(mantissa):
+        mantissa = mantissa[0] + '.' + mantissa[1:]
+    return '%s%se%s%d' % ('-' if sign else '', mantissa,
+                          '+' if 0 < value.adjusted() else '-',
+                          abs(value.adjusted()))
 
 class Bitfinex(Service):
     """Query the Bitfinex API, documented on
@@ -16,6 +40,10 @@ class Bitfinex(Service):
     """
 
     baseurl = "https://api.bitfinex.com/v1"
+    # The v1 ticker allow 30 requests per minute.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (0.5, 5),
+    }
 
     def servicename(self):
         return "Bitfinex"
@@ -43,9 +71,152 @@ class Bitfinex(Service):
             res[p] = self.rates[p]
         return res
 
+    class WSClient(WebSocketClient):
+        """Follow the Bitfinex order books and tickers using the v2 websocket
+API, documented on https://docs.bitfinex.com/docs/ws-general .  The
+server add a CRC32 checksum of the top 25 levels after every book
+update, and the book channel is subscribed again if the checksum of
+our copy of the book does not match.
+
+        """
+        # Bitfinex send a heartbeat every 15 seconds for quiet channels
+        heartbeatinterval = 15
+        usedecimal = True
+        # Flag asking for checksums after every book update
+        CONF_CHECKSUM = 131072
+        # Info code asking clients to reconnect
+        INFO_RECONNECT = 20051
+        # Bitfinex allow 25 channels per connection, and each pair use
+        # two channels.
+        maxpairs = 12
+        bookdepth = 25
+        def __init__(self, service, pairs = None):
+            super().__init__(service, pairs=pairs)
+            self.url = "wss://api-pub.bitfinex.com/ws/2"
+            self.channels = {}
+        def connect(self, url = None):
+            if url is None:
+                url = self.url
+            super().connect(url)
+        def _on_connection_success(self):
+            self.send({'event': 'conf', 'flags': self.CONF_CHECKSUM})
+            for pair in self.streampairs():
+                symbol = "t%s%s" % pair
+                self._subscribebook(symbol)
+                self.send({
+                    'event': 'subscribe',
+                    'channel': 'ticker',
+                    'symbol': symbol,
+                })
+        def _subscribebook(self, symbol):
+            self.send({
+                'event': 'subscribe',
+                'channel': 'book',
+                'symbol': symbol,
+                'prec': 'P0',
+                'len': str(self.bookdepth),
+            })
+        def _on_disconnect(self):
+            self.channels = {}
+        def _on_data(self, m):
+            #print(m)
+            if dict == type(m):
+                self._on_event(m)
+                return
+            info = self.channels.get(m[0])
+            if info is None or 'hb' == m[1]:
+                return
+            if 'cs' == m[1]:
+                self._checksum(info, m[2])
+            elif 'book' == info['channel']:
+                self._on_book(info, m[1])
+            elif 'ticker' == info['channel']:
+                # Only use the ticker while the book is not available
+                if not info['pair'] in self.service.orderbooks:
+                    self.service.updateRates(info['pair'],
+                                             Decimal(m[1][2]),
+                                             Decimal(m[1][0]),
+                                             None)
+        def _on_event(self, m):
+            if 'subscribed' == m['event']:
+                symbol = m['symbol']
+                self.channels[m['chanId']] = {
+                    'channel': m['channel'],
+                    'symbol': symbol,
+                    'pair': (symbol[1:4], symbol[4:]),
+                }
+            elif 'unsubscribed' == m['event']:
+                info = self.channels.pop(m['chanId'], None)
+                if info is not None and 'book' == info['channel']:
+                    self._subscribebook(info['symbol'])
+            elif 'info' == m['event']:
+                if self.INFO_RECONNECT == m.get('code') \
+                   and self._ws_connection is not None:
+                    # Trigger the reconnect done when the server
+                    # close the connection.
+                    self._ws_connection.close()
+            elif 'error' == m['event']:
+                self.service.logerror("%s websocket error: %s" % (
+                    self.service.servicename(), m.get('msg')))
+        def _on_book(self, info, data):
+            pair = info['pair']
+            if 0 < len(data) and list == type(data[0]):
+                # Snapshot
+                o = Orderbook()
+                entries = data
+            else:
+                o = self.service.orderbooks.get(pair)
+                if o is None:
+                    return
+                entries = [data]
+            for price, count, amount in entries:
+                price = Decimal(price)
+                amount = Decimal(amount)
+                if 0 < amount:
+                    oside = o.SIDE_BID
+                else:
+                    oside = o.SIDE_ASK
+                if 0 == count:
+                    try:
+                        o.remove(oside, price)
+                    except KeyError:
+                        pass
+                else:
+                    o.update(oside, price, abs(amount))
+            self.service.updateOrderbook(pair, o)
+        def checksum(self, o):
+            """Return the checksum of the order book as calculated by Bitfinex, ie
+the signed CRC32 of the price and amount of the top 25 bids and asks,
+interleaved, with negative amounts for the asks.  The numbers are
+formatted like in JavaScript.
+
+            """
+            bids = list(o.bid.items())[:25]
+            asks = list(o.ask.items())[:25]
+            values = []
+            for i in range(25):
+                if i < len(bids):
+                    values.extend((jsnumber(bids[i][0]), jsnumber(bids[i][1])))
+                if i < len(asks):
+                    values.extend((jsnumber(asks[i][0]), jsnumber(-asks[i][1])))
+            crc = zlib.crc32(':'.join(values).encode('UTF-8'))
+            if crc >= 2 ** 31:
+                crc -= 2 ** 32
+            return crc
+        def _checksum(self, info, checksum):
+            o = self.service.orderbooks.get(info['pair'])
+            if o is None:
+                return
+            if self.checksum(o) != checksum:
+                self.service.logerror("%s %s-%s order book checksum mismatch, resubscribing" % (
+                    (self.service.servicename(),) + info['pair']))
+                self.service.addmetric('websocket.checksumerrors')
+                del self.service.orderbooks[info['pair']]
+                for chanid, i in self.channels.items():
+                    if i is info:
+                        self.send({'event': 'unsubscribe', 'chanId': chanid})
     def websocket(self):
-        """Bitfinex websocket API not implemented 2018-09-10."""
-        return None
+        return shard(self, self.WSClient)
 
 class TestBitfinex(unittest.TestCase):
     """
@@ -93,6 +264,45 @@ Run simple self test.
         self.runCheck(self.checkUpdates, timeout=10)
         self.assertTrue(0 < self.updates)
 
+    def testWebsocketBook(self):
+        c = self.s.websocket()
+        sent = []
+        c.send = sent.append
+        pair = ('BTC', 'USD')
+        c._on_message(simplejson.dumps({
+            'event': 'subscribed', 'channel': 'book', 'chanId': 17,
+            'symbol': 'tBTCUSD', 'prec': 'P0', 'len': '25',
+        }))
+        c._on_message('[17,[[100.5,1,0.5],[100,2,1.25],[101,1,-0.75]]]')
+        self.assertEqual(Decimal('101'), self.s.rates[pair]['ask'])
+        self.assertEqual(Decimal('100.5'), self.s.rates[pair]['bid'])
+        c._on_message('[17,[100.5,0,1]]')
+        c._on_message('[17,"hb"]')
+        self.assertEqual(Decimal('100'), self.s.rates[pair]['bid'])
+        o = self.s.orderbooks[pair]
+        # CRC32 of '100:1.25:101:-0.75'
+        self.assertEqual(322830780, c.checksum(o))
+        c._on_message('[17,"cs",%d]' % c.checksum(o))
+        self.assertEqual([], sent)
+        c._on_message('[17,"cs",%d]' % (c.checksum(o) + 1))
+        self.assertFalse(pair in self.s.orderbooks)
+        self.assertEqual([{'event': 'unsubscribe', 'chanId': 17}], sent)
+        c._on_message(simplejson.dumps({
+            'event': 'unsubscribed', 'chanId': 17, 'status': 'OK',
+        }))
+        self.assertEqual('book', sent[1]['channel'])
+    def testChecksumFormat(self):
+        for value, text in (('0', '0'), ('7000', '7000'), ('0.10', '0.1'),
+                            ('-0.75', '-0.75'), ('1e-6', '0.000001'),
+                            ('0.00000005', '5e-8'), ('-1.50e-7', '-1.5e-7'),
+                            ('1e21', '1e+21')):
+            self.assertEqual(text, jsnumber(Decimal(value)))
+        c = self.s.websocket()
+        o = Orderbook()
+        o.update(o.SIDE_BID, Decimal('100.10'), Decimal('0.00000005'))
+        o.update(o.SIDE_ASK, Decimal('101'), Decimal('1E-5'))
+        self.assertEqual(zlib.crc32(b'100.1:5e-8:101:-0.00001'), c.checksum(o))
+
 if __name__ == '__main__':
     t = TestBitfinex()
     unittest.main()
@@ -14,6 +14,12 @@ class Bitmynt(Service):
 Query the Bitmynt API.
 """
     baseurl = "http://bitmynt.no/"
+    hedging = True
+    # A single small site without a documented limit, the ticker
+    # change a few times per minute at most.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (0.2, 2),
+    }
 
     def servicename(self):
         return "Bitmynt"
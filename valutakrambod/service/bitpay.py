@@ -14,6 +14,10 @@ those values are set to be identical.
 Documentation is available from https://bitpay.com/api .
 """
     baseurl = "https://bitpay.com/rates/"
+    # No documented limit, so stay at a modest pace.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (1, 5),
+    }
     def servicename(self):
         return "Bitpay"
 
@@ -14,12 +14,12 @@ import urllib
 
 from decimal import Decimal, ROUND_DOWN, ROUND_UP
 from os.path import expanduser
-from tornado import ioloop
 
 from valutakrambod.services import Orderbook
 from valutakrambod.services import Service
 from valutakrambod.services import Trading
 from valutakrambod.websocket import WebSocketClient
+from valutakrambod.websocket import shard
 
 class Bitstamp(Service):
     """Query the Bitstamp API.  Documentation is available from
@@ -35,6 +35,14 @@ the websocket API.
         'BTC' : 'XBT',
         }
     baseurl = "https://www.bitstamp.net/api/"
+    # "Do not make more than 8000 requests per 10 minutes or we will
+    # ban your IP address."  Split the budget between the endpoint
+    # classes.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (8, 8),
+        Service.ENDPOINT_PRIVATE : (2, 4),
+        Service.ENDPOINT_ORDER : (2, 4),
+    }
     def servicename(self):
         return "Bitstamp"
 
@@ -55,7 +63,7 @@ the websocket API.
         # Use same nonce as Finance::BitStamp::API perl module
         nonce = int(time.time()*1000000)
         return nonce
-    async def _signedpost(self, url, data):
+    async def _signedpost(self, url, data, endpoint = Service.ENDPOINT_PRIVATE):
         customerid = self.confget('customerid')
         if data is None:
             data = {}
@@ -68,11 +76,11 @@ the websocket API.
         data['signature'] =  sign
         datastr = urllib.parse.urlencode(data)
         #print(datastr)
-        body, response = await self._post(url, body=datastr)
+        body, response = await self._post(url, body=datastr, endpoint=endpoint)
         return body, response
-    async def _query_private(self, method, args):
+    async def _query_private(self, method, args, endpoint = Service.ENDPOINT_PRIVATE):
         url = "%s%s" % (self.baseurl, method)
-        body, response = await self._signedpost(url, args)
+        body, response = await self._signedpost(url, args, endpoint)
         j = simplejson.loads(body.decode('UTF-8'), use_decimal=True)
         return j
     async def fetchRates(self, pairs = None):
@@ -93,7 +101,45 @@ the websocket API.
             self.updateRates(p, ask, bid, int(j['timestamp']))
             res[p] = self.rates[p]
         return res
+    async def _fetchOrderbook(self, pair):
+        """Fetch the complete order book for pair.  Return the order book and
+its microtimestamp.
+
+        """
+        url = "%sv2/order_book/%s%s/" % (self.baseurl,
+                                          pair[0].lower(), pair[1].lower())
+        j, r = await self._jsonget(url)
+        o = Orderbook()
+        for side in ('asks', 'bids'):
+            oside = {
+                'asks' : o.SIDE_ASK,
+                'bids' : o.SIDE_BID,
+            }[side]
+            for e in j[side]:
+                o.update(oside, Decimal(e[0]), Decimal(e[1]))
+        o.setupdated(int(j['timestamp']))
+        return o, int(j['microtimestamp'])
     class WSClient(WebSocketClient):
+        """Follow the order books using the diff_order_book channels, sending
+only the changed price levels.  When a channel subscription is
+confirmed, a REST snapshot of the order book is fetched, and the
+changes received meanwhile are buffered.  Changes with a
+microtimestamp not newer than the snapshot are dropped, and the rest
+are applied to the snapshot.
+
+Set diff to False to use the order_book channels instead, sending the
+top 100 levels of the order book with every change.
+
+        """
+        usedecimal = True
+        diff = True
+        # Ask for compressed messages.  The order_book channels send
+        # the top 100 levels, a few KiB, so anything larger than 1 MiB
+        # is broken.
+        compression = {}
+        maxmessagesize = 1024 * 1024
+        # Seconds to wait before retrying a failed snapshot fetch
+        snapshotretry = 10
         _channelmap = {
             'order_book_bchbtc' : ('BCH', 'BTC'),
             'order_book_bcheur' : ('BCH', 'EUR'),
@@ -111,21 +157,35 @@ the websocket API.
             'order_book_xrpeur' : ('XRP', 'EUR'),
             'order_book_xrpusd' : ('XRP', 'USD'),
         }
-        # Channels to subscribe to, should match ratepars() above
-        _channels = [
-            'order_book',
-            'order_book_btceur',
-            'order_book_eurusd',
-        ]
-        def __init__(self, service):
-            super().__init__(service)
+        def __init__(self, service, pairs = None):
+            super().__init__(service, pairs=pairs)
             self.url = "wss://ws.bitstamp.net"
+            self.synced = {}
+            self.buffered = {}
+            self.retries = {}
         def connect(self, url = None):
             if url is None:
                 url = self.url
             super().connect(url)
+        def _on_disconnect(self):
+            self._cancelretries()
+            self.synced = {}
+            self.buffered = {}
+        def close(self):
+            self._cancelretries()
+            super().close()
+        def _cancelretries(self):
+            for timeout in self.retries.values():
+                self.service.ioloop.remove_timeout(timeout)
+            self.retries = {}
         def _on_connection_success(self):
-            for c in self._channels:
+            channels = { pair : c for c, pair in self._channelmap.items() }
+            for pair in self.streampairs():
+                if pair not in channels:
+                    continue
+                c = channels[pair]
+                if self.diff:
+                    c = 'diff_' + c
                 msg={
                     "event": "bts:subscribe",
                     "data": {
@@ -133,10 +193,20 @@ the websocket API.
                     }
                 }
                 self.send(msg)
-        def _on_message(self, msg):
-            m = simplejson.loads(msg, use_decimal=True)
+        def _on_data(self, m):
             #print(m)
-            if 'data' == m['event']:
+            channel = m.get('channel', '')
+            if 0 == channel.find('diff_'):
+                pair = self._channelmap[channel[len('diff_'):]]
+                if 'bts:subscription_succeeded' == m['event']:
+                    self.buffered[pair] = []
+                    self.service.ioloop.add_callback(self._fetchSnapshot, pair)
+                elif 'data' == m['event']:
+                    if pair in self.synced:
+                        self._applyDiff(pair, m['data'])
+                    elif pair in self.buffered:
+                        self.buffered[pair].append(m['data'])
+            elif 'data' == m['event']:
                 o = Orderbook()
                 d = m['data']
                 for side in ('asks', 'bids'):
@@ -148,9 +218,55 @@ the websocket API.
                         # Note, some times volume is zero.  No idea what that mean.
                         o.update(oside, Decimal(e[0]), Decimal(e[1]))
                 o.setupdated(int(d['timestamp']))
-                self.service.updateOrderbook(self._channelmap[m['channel']], o)
+                self.service.updateOrderbook(self._channelmap[channel], o)
+        async def _fetchSnapshot(self, pair):
+            self.retries.pop(pair, None)
+            if pair not in self.buffered:
+                return
+            try:
+                o, microtimestamp = await self.service.track(
+                    self.service._fetchOrderbook(pair))
+            except Exception as e:
+                self.service.logerror("fetching %s order book snapshot failed: %s" %
+                                      (pair, str(e)))
+                if pair in self.buffered:
+                    self.retries[pair] = self.service.ioloop.call_later(
+                        self.snapshotretry, self._fetchSnapshot, pair)
+                return
+            if pair not in self.buffered:
+                # Disconnected while waiting
+                return
+            deltas = self.buffered.pop(pair)
+            self.synced[pair] = microtimestamp
+            self.service.orderbooks[pair] = o
+            for d in deltas:
+                self._applyDiff(pair, d, notify=False)
+            self.service.updateOrderbook(pair, o)
+        def _applyDiff(self, pair, d, notify=True):
+            microtimestamp = int(d['microtimestamp'])
+            if microtimestamp <= self.synced[pair]:
+                return
+            self.synced[pair] = microtimestamp
+            o = self.service.orderbooks[pair]
+            for side in ('asks', 'bids'):
+                oside = {
+                    'asks' : o.SIDE_ASK,
+                    'bids' : o.SIDE_BID,
+                }[side]
+                for e in d[side]:
+                    price = Decimal(e[0])
+                    if 0 == Decimal(e[1]):
+                        try:
+                            o.remove(oside, price)
+                        except KeyError:
+                            pass
+                    else:
+                        o.update(oside, price, Decimal(e[1]))
+            o.setupdated(int(d['timestamp']))
+            if notify:
+                self.service.updateOrderbook(pair, o)
     def websocket(self):
-        return self.WSClient(self)
+        return shard(self, self.WSClient)
     class BitstampTrading(Trading):
         def __init__(self, service):
             self.service = service
@@ -224,7 +340,8 @@ loaded from the stored configuration.
             if immediate:
                 data['ioc_order'] = True
             #print(data)
-            res = await self.service._query_private(urlpath, data)
+            res = await self.service._query_private(urlpath, data,
+                                                    Service.ENDPOINT_ORDER)
             #print(res)
             if 'error' in res and 'error' == res['status']:
                 raise Exception('placing %s order failed' % type)
@@ -235,11 +352,13 @@ loaded from the stored configuration.
             data = {
                 'id': orderref,
             }
-            res = await self.service._query_private('v2/cancel_order/', data)
+            res = await self.service._query_private('v2/cancel_order/', data,
+                                                    Service.ENDPOINT_ORDER)
             # Nothing to return.  _query_private() will throw if not successfull
             return res
         async def cancelallorders(self, marketpair=None):
-            res = await self.service._query_private('cancel_all_orders/', {})
+            res = await self.service._query_private('cancel_all_orders/', {},
+                                                    Service.ENDPOINT_ORDER)
             # Nothing needs to be returned.  _query_private() will
             # throw if not successfull
             return res
@@ -364,6 +483,58 @@ Run simple self test.
         self.runCheck(self.checkWebsocket, timeout=10)
         self.assertTrue(0 < self.updates)
 
+    async def checkDiffOrderbook(self):
+        pair = ('BTC', 'EUR')
+        async def fetchOrderbook(pair):
+            o = Orderbook()
+            o.update(Orderbook.SIDE_ASK, Decimal('101'), Decimal('1'))
+            o.update(Orderbook.SIDE_BID, Decimal('99'), Decimal('1'))
+            return o, 2000
+        self.s._fetchOrderbook = fetchOrderbook
+        c = self.s.websocket()
+        def diff(microtimestamp, asks, bids):
+            c._on_message(simplejson.dumps({
+                'event': 'data',
+                'channel': 'diff_order_book_btceur',
+                'data': {
+                    'timestamp': str(microtimestamp // 1000000),
+                    'microtimestamp': str(microtimestamp),
+                    'asks': asks,
+                    'bids': bids,
+                },
+            }))
+        c._on_message(simplejson.dumps({
+            'event': 'bts:subscription_succeeded',
+            'channel': 'diff_order_book_btceur',
+            'data': {},
+        }))
+        # Older than the snapshot, dropped
+        diff(1000, [['101', '0']], [])
+        diff(3000, [], [['100', '2']])
+        await c._fetchSnapshot(pair)
+        self.assertEqual(Decimal('101'), self.s.rates[pair]['ask'])
+        self.assertEqual(Decimal('100'), self.s.rates[pair]['bid'])
+        diff(4000, [['100.5', '1']], [['100', '0']])
+        self.assertEqual(Decimal('100.5'), self.s.rates[pair]['ask'])
+        self.assertEqual(Decimal('99'), self.s.rates[pair]['bid'])
+        self.ioloop.stop()
+    def testDiffOrderbook(self):
+        self.runCheck(self.checkDiffOrderbook)
+
+    def testSnapshotRetry(self):
+        pair = ('BTC', 'EUR')
+        async def fetchOrderbook(pair):
+            raise Exception('unavailable')
+        self.s._fetchOrderbook = fetchOrderbook
+        self.s.logerror = lambda msg: None
+        c = self.s.websocket()
+        c.buffered[pair] = []
+        self.ioloop.run_sync(lambda: c._fetchSnapshot(pair))
+        # A retry is scheduled, and cancelled when closing
+        self.assertIn(pair, c.retries)
+        c.close()
+        self.assertEqual({}, c.retries)
+
     async def checkTradingConnection(self):
         # Unable to test without API access credentials in the config
         if self.s.confget('apikey', fallback=None) is None:
@@ -19,6 +19,7 @@ from valutakrambod.services import Orderbook
 from valutakrambod.services import Service
 from valutakrambod.services import Trading
 from valutakrambod.websocket import WebSocketClient
+from valutakrambod.websocket import WebSocketClientGroup
 
 class Bl3p(Service):
     """
@@ -26,7 +27,14 @@ Query the Bl3p API.  Documentation is available from
 https://bl3p.eu/api .
 """
     baseurl = "https://api.bl3p.eu/1/"
-    async def _signedpost(self, url, data):
+    # "The API is limited to 600 requests per 5 minutes."  Split the
+    # budget between the endpoint classes.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (1, 5),
+        Service.ENDPOINT_PRIVATE : (0.5, 5),
+        Service.ENDPOINT_ORDER : (0.5, 5),
+    }
+    async def _signedpost(self, url, data, endpoint = Service.ENDPOINT_PRIVATE):
         path = url.replace(self.baseurl, '')
         datastr = urllib.parse.urlencode(data)
 
@@ -42,11 +50,12 @@ https://bl3p.eu/api .
             'Rest-Sign': sign.decode(),
         }
 
-        body, response = await self._post(url, body=datastr, headers=headers)
+        body, response = await self._post(url, body=datastr, headers=headers,
+                                          endpoint=endpoint)
         return body, response
-    async def _query_private(self, method, args):
+    async def _query_private(self, method, args, endpoint = Service.ENDPOINT_PRIVATE):
         url = "%s%s" % (self.baseurl, method)
-        body, response = await self._signedpost(url, args)
+        body, response = await self._signedpost(url, args, endpoint)
         j = simplejson.loads(body.decode('UTF-8'), use_decimal=True)
         #print(j)
         if 'success' != j['result']:
@@ -85,37 +94,63 @@ https://bl3p.eu/api .
         return res
 
     class WSClient(WebSocketClient):
-        def __init__(self, service):
-            super().__init__(service)
-            self.url = "wss://api.bl3p.eu/1/BTCEUR/orderbook"
+        """Follow the order book of one market.  Bl3p send the complete
+order book with every message, so the levels are compared with the
+previous message, and only the changed levels are updated in the
+order book.  Subscribers are not notified when nothing changed.
+
+        """
+        def __init__(self, service, pair):
+            super().__init__(service, pairs=[pair])
+            self.pair = pair
+            self.url = "wss://api.bl3p.eu/1/%s%s/orderbook" % pair
+            self.levels = {}
         def connect(self, url = None):
             if url is None:
                 url = self.url
             super().connect(url)
-        def _on_message(self, msg):
-            m = simplejson.loads(msg, use_decimal=True)
+        def _on_disconnect(self):
+            self.levels = {}
+        def _on_data(self, m):
             #print(m)
-            o = Orderbook()
+            pair = (m['marketplace'][:3], m['marketplace'][3:])
+            if pair in self.service.orderbooks and self.levels:
+                o = self.service.orderbooks[pair]
+            else:
+                o = Orderbook()
+                self.levels = {}
+            changed = False
             for side in ('asks', 'bids'):
                 oside = {
                     'asks' : o.SIDE_ASK,
                     'bids' : o.SIDE_BID,
                 }[side]
+                old = self.levels.get(side, {})
+                new = {}
                 for e in m[side]:
-                    o.update(oside, Decimal(e['price_int']) / 100000,
-                             Decimal(e['amount_int']) / 100000000 )
+                    new[e['price_int']] = e['amount_int']
+                for price in old.keys() - new.keys():
+                    o.remove(oside, Decimal(price).scaleb(-5))
+                    changed = True
+                for price, amount in new.items():
+                    if old.get(price) != amount:
+                        o.update(oside, Decimal(price).scaleb(-5),
+                                 Decimal(amount).scaleb(-8))
+                        changed = True
+                self.levels[side] = new
+            if not changed:
+                # Let the watchdog know the stream is alive
+                self.markalive(pair)
+                return
             # FIXME setting our own timestamp, as there is no
             # timestamp from the source.  Asked bl3p to set one in
             # email sent 2018-06-27.
             #o.setupdated(time.time())
-            pair = (m['marketplace'][:3], m['marketplace'][3:])
             self.service.updateOrderbook(pair, o)
-        def _on_connection_close(self):
-            pass
-        def _on_connection_error(self, exception):
-            pass
     def websocket(self):
-        return self.WSClient(self)
+        pairs = self.wantedpairs or self.ratepairs()
+        return WebSocketClientGroup(self, [self.WSClient(self, pair)
+                                           for pair in pairs])
 
     class Bl3pTrading(Trading):
         def __init__(self, service):
@@ -176,7 +211,8 @@ N/A
             data['amount_int'] = int(volume * 100000000)
 
             method = '%s/money/order/add' % pairstr
-            order = await self.service._query_private(method, data)
+            order = await self.service._query_private(method, data,
+                                                      Service.ENDPOINT_ORDER)
             order_id = order['order_id']
             return order_id
         async def cancelorder(self, marketpair, orderref):
@@ -187,7 +223,8 @@ N/A
                 'order_id': orderref,
             }
             order = await self.service._query_private('%s/money/order/cancel'
-                                                       % pairstr, data)
+                                                       % pairstr, data,
+                                                       Service.ENDPOINT_ORDER)
             # Nothing needs to be returned.  _query_private() will
             # throw if not successfull
             return
@@ -343,6 +380,72 @@ Run simple self test.
         self.runCheck(self.checkWebsocket, timeout=10)
         self.assertTrue(0 < self.updates)
 
+    def testOrderbookDiff(self):
+        updates = []
+        self.s.subscribe(lambda service, pair, changed: updates.append(pair))
+        c = self.s.websocket().clients[0]
+        def book(asks, bids):
+            c._on_message(simplejson.dumps({
+                'marketplace': 'BTCEUR',
+                'asks': [{'price_int': p, 'amount_int': a} for p, a in asks],
+                'bids': [{'price_int': p, 'amount_int': a} for p, a in bids],
+            }))
+        book([(10100000, 100000000), (10200000, 50000000)],
+             [(9900000, 100000000)])
+        pair = ('BTC', 'EUR')
+        self.assertEqual(Decimal('101'), self.s.rates[pair]['ask'])
+        self.assertEqual(Decimal('0.5'),
+                         self.s.orderbooks[pair].ask[Decimal('102')])
+        self.assertEqual(1, len(updates))
+        # Unchanged book, no notification but the pair is alive
+        c.lastpairupdate[pair] = 0
+        c._receive(simplejson.dumps({
+            'marketplace': 'BTCEUR',
+            'asks': [{'price_int': 10100000, 'amount_int': 100000000},
+                     {'price_int': 10200000, 'amount_int': 50000000}],
+            'bids': [{'price_int': 9900000, 'amount_int': 100000000}],
+        }))
+        self.assertEqual(1, len(updates))
+        self.assertLess(0, c.lastpairupdate[pair])
+        book([(10200000, 50000000)], [(9900000, 100000000)])
+        self.assertEqual(Decimal('102'), self.s.rates[pair]['ask'])
+        self.assertEqual(1, len(self.s.orderbooks[pair].ask))
+        self.assertEqual(2, len(updates))
+
+    def testReplayShards(self):
+        import os
+        import tempfile
+        from valutakrambod import recorder
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(path)
+        try:
+            self.s.recorder = recorder.Recorder(path)
+            g = self.s.websocket()
+            for c in g.clients:
+                c._read_message(simplejson.dumps({
+                    'marketplace': '%s%s' % c.pair,
+                    'asks': [{'price_int': 5000000, 'amount_int': 100000000}],
+                    'bids': [{'price_int': 4900000, 'amount_int': 100000000}],
+                }))
+            # Change both books, each diffed against its own levels
+            for c in g.clients:
+                c._read_message(simplejson.dumps({
+                    'marketplace': '%s%s' % c.pair,
+                    'asks': [{'price_int': 5100000, 'amount_int': 100000000}],
+                    'bids': [{'price_int': 4900000, 'amount_int': 100000000}],
+                }))
+            self.s.recorder.close()
+            s = Bl3p()
+            stats = recorder.replay(path, {s.servicename(): s.websocket()})
+            self.assertEqual(0, stats[s.servicename()]['errors'])
+            self.assertEqual(Decimal('51'), s.rates[('BTC', 'EUR')]['ask'])
+            self.assertEqual(Decimal('51'), s.rates[('LTC', 'EUR')]['ask'])
+            for pair in s.orderbooks:
+                self.assertEqual(1, len(s.orderbooks[pair].ask))
+        finally:
+            os.unlink(path)
+
     async def checkTradingConnection(self):
         # Unable to test without API access credentials in the config
         if self.s.confget('apikey', fallback=None) is None:
@@ -2,14 +2,35 @@
 # Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
 # This file is covered by the GPLv2 or later, read COPYING for details.
 
+import dateutil.parser
+import simplejson
+import time
 import unittest
 import tornado.ioloop
 
 from decimal import Decimal
+from tornado import gen
+from valutakrambod.services import Orderbook
 from valutakrambod.services import Service
+from valutakrambod.websocket import WebSocketClient
+from valutakrambod.websocket import shard
 
 class Coinbase(Service):
+    """Query the Coinbase API.  The pairs traded on the Coinbase Exchange
+use the exchange ticker and order books, while the other pairs use the
+retail buy and sell prices.
+
+"""
     baseurl = "https://api.coinbase.com/v2/"
+    exchangeurl = "https://api.exchange.coinbase.com/"
+    exchangepairs = [
+        ('BTC', 'EUR'),
+        ('BTC', 'USD'),
+    ]
+    # The data API allow 10,000 requests per hour.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (2.5, 10),
+    }
     def servicename(self):
         return "Coinbase"
 
@@ -24,24 +45,141 @@ class Coinbase(Service):
         if pairs is None:
             pairs = self.ratepairs()
         res = {}
+        futures = []
         for p in pairs:
-            f = p[0]
-            t = p[1]
-            sellurl = "%sprices/sell?currency=%s" % (self.baseurl, t)
-            buyurl  = "%sprices/buy?currency=%s"  % (self.baseurl, t)
-            (sj, sr) = await self._jsonget(sellurl)
-            #print(sj)
-            (bj, br) = await self._jsonget(buyurl)
-            #print(bj)
-            ask = Decimal(bj['data']['amount'])
-            bid = Decimal(sj['data']['amount'])
-            self.updateRates(p, ask, bid, None)
-            res[p] = self.rates[p]
+            if p in self.exchangepairs:
+                futures.append(self._fetchTicker(p))
+            else:
+                futures.append(self._fetchPrices(p))
+        for p, rates in zip(pairs, await gen.multi(futures)):
+            res[p] = rates
         return res
+    async def _fetchTicker(self, p):
+        """Fetch the top of the order book of an exchange pair."""
+        url = "%sproducts/%s-%s/ticker" % (self.exchangeurl, p[0], p[1])
+        j, r = await self._jsonget(url)
+        when = dateutil.parser.parse(j['time']).timestamp()
+        self.updateRates(p, Decimal(j['ask']), Decimal(j['bid']), when)
+        return self.rates[p]
+    async def _fetchPrices(self, p):
+        """Fetch the retail buy and sell prices of a pair."""
+        t = p[1]
+        sellurl = "%sprices/sell?currency=%s" % (self.baseurl, t)
+        buyurl  = "%sprices/buy?currency=%s"  % (self.baseurl, t)
+        (sj, sr), (bj, br) = await gen.multi([self._jsonget(sellurl),
+                                              self._jsonget(buyurl)])
+        #print(sj)
+        #print(bj)
+        ask = Decimal(bj['data']['amount'])
+        bid = Decimal(sj['data']['amount'])
+        self.updateRates(p, ask, bid, None)
+        return self.rates[p]
 
+    class WSClient(WebSocketClient):
+        """Follow the Coinbase Exchange order books using the level2_batch
+channel, documented on https://docs.cdp.coinbase.com/exchange/docs/websocket-overview .
+The ticker is used until the order book snapshot arrive.  Pairs not
+traded on the exchange, like BTC-NOK, are not in the stream.  These
+are fetched using REST when connecting, and then polled every
+pollperiod seconds while the stream is running.
+
+        """
+        # The heartbeat channel send a heartbeat every second
+        heartbeatinterval = 1
+        pollperiod = 60
+        def __init__(self, service, pairs = None):
+            super().__init__(service, pairs=pairs)
+            self.url = "wss://ws-feed.exchange.coinbase.com"
+            self.synced = set()
+            self.lastpoll = 0
+        def connect(self, url = None):
+            if url is None:
+                url = self.url
+            super().connect(url)
+        def _pairs(self):
+            if self.pairs is not None:
+                return self.pairs
+            return self.service.wantedpairs or []
+        def streampairs(self):
+            return [p for p in self._pairs() if p in self.service.exchangepairs]
+        def pollpairs(self):
+            """Return the pairs followed using REST instead of the stream."""
+            return [p for p in self._pairs() if p not in self.service.exchangepairs]
+        def _on_connection_success(self):
+            products = ["%s-%s" % p for p in self.streampairs()]
+            self.send({
+                'type': 'subscribe',
+                'product_ids': products,
+                'channels': ['heartbeat', 'ticker', 'level2_batch'],
+            })
+            # Warm up with the REST API, also covering the pairs
+            # missing in the stream.
+            self.lastpoll = time.time()
+            self.service.requestUpdate()
+        def _checkstale(self):
+            super()._checkstale()
+            now = time.time()
+            if self.pollpairs() and now - self.lastpoll >= self.pollperiod:
+                self.lastpoll = now
+                self.service.ioloop.add_callback(self._poll)
+        async def _poll(self):
+            try:
+                await self.service.fetchRates(self.pollpairs())
+            except Exception as e:
+                self.service.logerror("%s fetchRates: %s" % (
+                    self.service.servicename(), str(e)))
+        def _on_disconnect(self):
+            self.synced = set()
+        def _on_data(self, m):
+            #print(m)
+            t = m['type']
+            if 'snapshot' == t:
+                pair = tuple(m['product_id'].split('-'))
+                o = Orderbook()
+                for side in ('asks', 'bids'):
+                    oside = {
+                        'asks' : o.SIDE_ASK,
+                        'bids' : o.SIDE_BID,
+                    }[side]
+                    for price, size in m[side]:
+                        o.update(oside, Decimal(price), Decimal(size))
+                self.synced.add(pair)
+                self.service.updateOrderbook(pair, o)
+            elif 'l2update' == t:
+                pair = tuple(m['product_id'].split('-'))
+                if pair not in self.synced:
+                    return
+                o = self.service.orderbooks[pair]
+                for side, price, size in m['changes']:
+                    oside = {
+                        'buy' : o.SIDE_BID,
+                        'sell' : o.SIDE_ASK,
+                    }[side]
+                    price = Decimal(price)
+                    size = Decimal(size)
+                    if 0 == size:
+                        try:
+                            o.remove(oside, price)
+                        except KeyError:
+                            pass
+                    else:
+                        o.update(oside, price, size)
+                self.service.updateOrderbook(pair, o)
+            elif 'ticker' == t:
+                pair = tuple(m['product_id'].split('-'))
+                if pair not in self.synced:
+                    self.service.updateRates(pair,
+                                             Decimal(m['best_ask']),
+                                             Decimal(m['best_bid']),
+                                             None)
+            elif 'error' == t:
+                self.service.logerror("%s websocket error: %s" % (
+                    self.service.servicename(), m.get('message')))
+            else:
+                # Ignore heartbeats and subscription confirmations
+                pass
     def websocket(self):
-        """Coinbase do not provide websocket API 2018-06-27."""
-        return None
+        return shard(self, self.WSClient)
 
 class TestCoinbase(unittest.TestCase):
     """
@@ -69,6 +207,68 @@ Run simple self test.
     def testCurrentRates(self):
         self.runCheck(self.checkCurrentRates)
 
+    def testWebsocketBook(self):
+        c = self.s.websocket()
+        pair = ('BTC', 'EUR')
+        c._on_message(simplejson.dumps({
+            'type': 'ticker', 'product_id': 'BTC-EUR',
+            'best_ask': '102', 'best_bid': '98',
+        }))
+        self.assertEqual(Decimal('102'), self.s.rates[pair]['ask'])
+        c._on_message(simplejson.dumps({
+            'type': 'snapshot', 'product_id': 'BTC-EUR',
+            'bids': [['100', '1'], ['99', '2']],
+            'asks': [['101', '0.5']],
+        }))
+        self.assertEqual(Decimal('101'), self.s.rates[pair]['ask'])
+        c._on_message(simplejson.dumps({
+            'type': 'l2update', 'product_id': 'BTC-EUR',
+            'changes': [['buy', '100', '0'], ['sell', '100.5', '1']],
+        }))
+        self.assertEqual(Decimal('100.5'), self.s.rates[pair]['ask'])
+        self.assertEqual(Decimal('99'), self.s.rates[pair]['bid'])
+        # The ticker is ignored once the book is available
+        c._on_message(simplejson.dumps({
+            'type': 'ticker', 'product_id': 'BTC-EUR',
+            'best_ask': '102', 'best_bid': '98',
+        }))
+        self.assertEqual(Decimal('100.5'), self.s.rates[pair]['ask'])
+    def testFetchRates(self):
+        urls = []
+        async def jsonget(url):
+            urls.append(url)
+            if 'ticker' in url:
+                return {'ask': '101', 'bid': '100',
+                        'time': '2021-01-01T00:00:00.000Z'}, None
+            if 'buy' in url:
+                return {'data': {'amount': '1010'}}, None
+            return {'data': {'amount': '990'}}, None
+        self.s._jsonget = jsonget
+        self.ioloop.run_sync(self.s.fetchRates)
+        # The exchange pairs use the exchange ticker, not retail prices
+        self.assertEqual(Decimal('101'), self.s.rates[('BTC', 'EUR')]['ask'])
+        self.assertEqual(1609459200, self.s.rates[('BTC', 'EUR')]['when'])
+        self.assertEqual(Decimal('1010'), self.s.rates[('BTC', 'NOK')]['ask'])
+        self.assertEqual(4, len(urls))
+    def testWebsocketPairs(self):
+        c = self.s.websocket()
+        self.assertEqual([('BTC', 'EUR'), ('BTC', 'USD')], c.streampairs())
+        self.assertEqual([('BTC', 'NOK')], c.pollpairs())
+        polled = []
+        async def fetchRates(pairs = None):
+            polled.append(pairs)
+        self.s.fetchRates = fetchRates
+        async def check():
+            c._checkstale()
+            await gen.sleep(0)
+            # Not polled again until pollperiod has passed
+            c._checkstale()
+            await gen.sleep(0)
+        self.ioloop.run_sync(check)
+        self.assertEqual([[('BTC', 'NOK')]], polled)
+        self.assertEqual(set(), c.stalepairs)
+        self.assertNotEqual('stale', self.s.status.get('stream'))
+
 if __name__ == '__main__':
     t = TestCoinbase()
     unittest.main()
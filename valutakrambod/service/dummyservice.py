@@ -27,9 +27,9 @@ class DummyService(Service):
 around a predefined price, with a predefined spread.
 
     """
-    def __init__(self, currencies=None):
+    def __init__(self, currencies=None, ioloop=None):
         global last
-        super().__init__(currencies)
+        super().__init__(currencies, ioloop)
         self.pricecenter = Decimal('5000.0')
         self.spread = Decimal('0.01')
         self.n = last + 1
@@ -16,6 +16,10 @@ https://www.ecb.europa.eu/stats/policy_and_exchange_rates/euro_reference_exchang
 
     """
     baseurl = "https://api.exchangeratesapi.io/"
+    # The rates are published once a day.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (0.2, 2),
+    }
 
     def servicename(self):
         return "Exchangerates"
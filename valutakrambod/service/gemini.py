@@ -2,12 +2,16 @@
 # Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
 # This file is covered by the GPLv2 or later, read COPYING for details.
 
+import simplejson
 import unittest
 import time
 import tornado.ioloop
 
 from decimal import Decimal
+from valutakrambod.services import Orderbook
 from valutakrambod.services import Service
+from valutakrambod.websocket import WebSocketClient
+from valutakrambod.websocket import shard
 
 class Gemini(Service):
     """
@@ -18,6 +22,11 @@ https://docs.gemini.com/
 
 """
     baseurl = "https://api.gemini.com/v1/"
+    # Public API calls are limited to 120 requests per minute, and
+    # Gemini recommend not exceeding 1 request per second.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (1, 5),
+    }
 
     def servicename(self):
         return "Gemini"
@@ -42,9 +51,63 @@ https://docs.gemini.com/
             res[p] = self.rates[p]
         return res
 
+    class WSClient(WebSocketClient):
+        """Follow the order books of all the wanted pairs over one connection
+using the v2 market data API, documented on
+https://docs.gemini.com/websocket-api/#market-data-version-2 .  The
+first l2_updates message for a symbol contain the complete order
+book, and the following ones the changed price levels, with quantity
+zero for removed levels.
+
+        """
+        def __init__(self, service, pairs = None):
+            super().__init__(service, pairs=pairs)
+            self.url = "wss://api.gemini.com/v2/marketdata"
+            self.synced = set()
+        def connect(self, url = None):
+            if url is None:
+                url = self.url
+            super().connect(url)
+        def _on_connection_success(self):
+            self.send({
+                'type': 'subscribe',
+                'subscriptions': [{
+                    'name': 'l2',
+                    'symbols': ["%s%s" % p for p in self.streampairs()],
+                }],
+            })
+        def _on_disconnect(self):
+            self.synced = set()
+        def _on_data(self, m):
+            #print(m)
+            if 'l2_updates' == m['type']:
+                symbol = m['symbol']
+                pair = (symbol[:3], symbol[3:])
+                if pair in self.synced:
+                    o = self.service.orderbooks[pair]
+                else:
+                    o = Orderbook()
+                    self.synced.add(pair)
+                for side, price, quantity in m['changes']:
+                    oside = {
+                        'buy' : o.SIDE_BID,
+                        'sell' : o.SIDE_ASK,
+                    }[side]
+                    price = Decimal(price)
+                    quantity = Decimal(quantity)
+                    if 0 == quantity:
+                        try:
+                            o.remove(oside, price)
+                        except KeyError:
+                            pass
+                    else:
+                        o.update(oside, price, quantity)
+                self.service.updateOrderbook(pair, o)
+            else:
+                # Ignore heartbeats and trades
+                pass
     def websocket(self):
-        """Gemini websocket support not implemented 2018-09-28."""
-        return None
+        return shard(self, self.WSClient)
 
 class TestGemini(unittest.TestCase):
     """
@@ -92,6 +155,32 @@ Run simple self test.
         self.runCheck(self.checkUpdates, timeout=10)
         self.assertTrue(0 < self.updates)
 
+    def testWebsocketBook(self):
+        c = self.s.websocket()
+        pair = ('BTC', 'USD')
+        c._on_message(simplejson.dumps({
+            'type': 'l2_updates',
+            'symbol': 'BTCUSD',
+            'changes': [
+                ['buy', '100.5', '1'],
+                ['buy', '100', '2'],
+                ['sell', '101', '0.5'],
+            ],
+        }))
+        self.assertEqual(Decimal('101'), self.s.rates[pair]['ask'])
+        self.assertEqual(Decimal('100.5'), self.s.rates[pair]['bid'])
+        c._on_message(simplejson.dumps({
+            'type': 'l2_updates',
+            'symbol': 'BTCUSD',
+            'changes': [
+                ['buy', '100.5', '0'],
+                ['sell', '100.75', '1'],
+            ],
+        }))
+        self.assertEqual(Decimal('100.75'), self.s.rates[pair]['ask'])
+        self.assertEqual(Decimal('100'), self.s.rates[pair]['bid'])
+        self.assertEqual(2, len(self.s.orderbooks[pair].ask))
+
 if __name__ == '__main__':
     t = TestGemini()
     unittest.main()
@@ -16,12 +16,23 @@ from decimal import Decimal
 from valutakrambod.services import Orderbook
 from valutakrambod.services import Service
 from valutakrambod.websocket import WebSocketClient
+from valutakrambod.websocket import shard
 
 class Hitbtc(Service):
     """
-Query the Hitbtc API.
+Query the Hitbtc API.  Documentation is available from
+https://api.hitbtc.com/ .  Hitbtc use USDT as its US dollar.
 """
-    baseurl = "http://api.hitbtc.com/api/1/"
+    baseurl = "https://api.hitbtc.com/api/3/"
+    # The market data endpoints allow 30 requests per second.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (30, 30),
+    }
+    # Number of order book levels to fetch using REST
+    bookdepth = 25
+    keymap = {
+        'USD' : 'USDT',
+        }
     def servicename(self):
         return "Hitbtc"
 
@@ -34,98 +45,155 @@ Query the Hitbtc API.
             return self.keymap[currency]
         else:
             return currency
+    def _makesymbol(self, pair):
+        return "%s%s" % (self._currencyMap(pair[0]), self._currencyMap(pair[1]))
+    def _symbolmap(self, pairs = None):
+        """Return a dictionary mapping Hitbtc symbols to pairs."""
+        if pairs is None:
+            pairs = self.ratepairs()
+        return { self._makesymbol(p) : p for p in pairs }
+    def datestr2epoch(self, datestr):
+        when = dateutil.parser.parse(datestr)
+        return when.timestamp()
     async def fetchRates(self, pairs = None):
         if pairs is None:
             pairs = self.ratepairs()
+        await self._fetchOrderbooks(pairs)
+        return { p : self.rates[p] for p in pairs if p in self.rates }
+    async def _fetchOrderbooks(self, pairs):
+        """Fetch the order books of all the pairs with one request, limited
+to bookdepth levels on each side.
+
+        """
+        symbols = self._symbolmap(pairs)
+        url = "%spublic/orderbook?symbols=%s&depth=%d" % (
+            self.baseurl, ",".join(sorted(symbols.keys())), self.bookdepth)
+        j, r = await self._jsonget(url)
+        for symbol, p in symbols.items():
+            o = Orderbook()
+            for side in ('ask', 'bid'):
+                oside = {
+                    'ask' : o.SIDE_ASK,
+                    'bid' : o.SIDE_BID,
+                }[side]
+                for price, size in j[symbol][side]:
+                    o.update(oside, Decimal(price), Decimal(size))
+            o.setupdated(self.datestr2epoch(j[symbol]['timestamp']))
+            self.updateOrderbook(p, o)
+    async def _fetchTicker(self, pairs = None):
+        """Fetch the tickers of all the pairs with one request."""
+        if pairs is None:
+            pairs = self.ratepairs()
+        symbols = self._symbolmap(pairs)
+        url = "%spublic/ticker?symbols=%s" % (self.baseurl,
+                                              ",".join(sorted(symbols.keys())))
+        #print(url)
+        j, r = await self._jsonget(url)
+        #print(j)
         res = {}
-        for p in pairs:
-            f = p[0]
-            t = p[1]
-            pair="%s%s" % (f, t)
-            #print(pair)
-            url = "%spublic/%s/ticker" % (self.baseurl, pair)
-            #print(url)
-            j, r = await self._jsonget(url)
-            #print(j)
-            ask = Decimal(j['ask'])
-            bid = Decimal(j['bid'])
-            self.updateRates(p, ask, bid, j['timestamp'] / 1000.0)
+        for symbol, p in symbols.items():
+            ask = Decimal(j[symbol]['ask'])
+            bid = Decimal(j[symbol]['bid'])
+            self.updateRates(p, ask, bid,
+                             self.datestr2epoch(j[symbol]['timestamp']))
             res[p] = self.rates[p]
         return res
 
     def websocket(self):
-        return self.WSClient(self)
+        return shard(self, self.WSClient)
 
     class WSClient(WebSocketClient):
-        def __init__(self, service):
-            super().__init__(service)
-            self.url = "wss://api.hitbtc.com/api/2/ws"
+        """Follow the order books using the orderbook/full channel of the v3
+websocket API.  All symbols are subscribed with one request.  Every
+request get an unique id, to be able to tell which request failed.
+After the snapshot, the updates are applied to the order book in
+place as long as their sequence numbers follow each other.  If a
+sequence number is missing, the symbol is subscribed again to get a
+fresh snapshot.
+
+        """
+        channel = 'orderbook/full'
+        def __init__(self, service, pairs = None):
+            super().__init__(service, pairs=pairs)
+            self.url = "wss://api.hitbtc.com/api/3/ws/public"
+            self.synced = {}
+            self.requests = {}
+            self.lastid = 0
+            self.symbols = service._symbolmap(self.streampairs())
         def connect(self, url = None):
             if url is None:
                 url = self.url
             super().connect(url)
+        def request(self, method, symbols):
+            self.lastid += 1
+            self.requests[self.lastid] = (method, symbols)
+            self.send({
+                'method': method,
+                'ch': self.channel,
+                'params': {
+                    'symbols': symbols,
+                },
+                'id': self.lastid,
+            })
         def _on_connection_success(self):
             #print("_on_connection_success()")
-            for p in self.service.ratepairs():
-                self.send({
-                    "method": "subscribeOrderbook", # subscribeTicker
-                    "params": {
-                        "symbol": "%s%s" % (p[0], p[1])
-                    },
-                    "id": 123
-                })
-            pass
-        def datestr2epoch(self, datestr):
-            when = dateutil.parser.parse(datestr)
-            return when.timestamp()
-        def symbols2pair(self, symbol):
-            return (symbol[:3], symbol[3:])
-        def _on_message(self, msg):
-            m = simplejson.loads(msg, use_decimal=True)
+            self.symbols = self.service._symbolmap(self.streampairs())
+            self.request('subscribe', sorted(self.symbols.keys()))
+        def _on_disconnect(self):
+            self.synced = {}
+            self.requests = {}
+        def resync(self, symbol):
+            del self.synced[symbol]
+            self.request('unsubscribe', [symbol])
+            self.request('subscribe', [symbol])
+        def _on_data(self, m):
             #print(m)
             #print()
-            if 'method' in m:
-                if "ticker" == m['method']:
-                    pair = self.symbols2pair(m['params']['symbol'])
-                    self.service.updateRates(pair,
-                                             m['params']['ask'],
-                                             m['params']['bid'],
-                                             self.datestr2epoch(m['params']['timestamp']),
-                    )
-                if "snapshotOrderbook" == m['method']:
-                    pair = self.symbols2pair(m['params']['symbol'])
+            if 'id' in m:
+                method, symbols = self.requests.pop(m['id'], (None, None))
+                if 'error' in m:
+                    self.service.logerror("%s %s %s failed: %s" % (
+                        self.service.servicename(), method,
+                        ",".join(symbols or []), m['error'].get('message')))
+            elif 'snapshot' in m:
+                for symbol, d in m['snapshot'].items():
+                    pair = self.symbols[symbol]
                     o = Orderbook()
-                    for side in ('ask', 'bid'):
-                        oside = {
-                            'ask' : o.SIDE_ASK,
-                            'bid' : o.SIDE_BID,
-                        }[side]
-                        #print(m['params'][side])
-                        for e in m['params'][side]:
-                            o.update(oside, Decimal(e['price']), Decimal(e['size']))
-                    # FIXME setting our own timestamp, as there is no
-                    # timestamp from the source.  Ask bl3p to set one?
-                    o.setupdated(time.time())
-                    self.service.updateOrderbook(pair, o)
-                if "updateOrderbook" == m['method']:
-                    pair = self.symbols2pair(m['params']['symbol'])
-                    o = self.service.orderbooks[pair].copy()
-                    for side in ('ask', 'bid'):
-                        oside = {
-                            'ask' : o.SIDE_ASK,
-                            'bid' : o.SIDE_BID,
-                        }[side]
-                        for e in m['params'][side]:
-                            price = Decimal(e['price'])
-                            if '0.00' == e['size']:
-                                o.remove(oside, price)
-                            else:
-                                volume = Decimal(e['size'])
-                                o.update(oside, price, volume)
-                    # FIXME setting our own timestamp, as there is no
-                    # timestamp from the source.  Ask bl3p to set one?
-                    o.setupdated(time.time())
+                    self._update(o, d)
+                    self.synced[symbol] = d['s']
                     self.service.updateOrderbook(pair, o)
+            elif 'update' in m:
+                for symbol, d in m['update'].items():
+                    if symbol not in self.synced:
+                        # Wait for the snapshot
+                        continue
+                    if d['s'] != self.synced[symbol] + 1:
+                        self.service.logerror("%s %s sequence gap (%d after %d), resubscribing" % (
+                            self.service.servicename(), symbol, d['s'],
+                            self.synced[symbol]))
+                        self.resync(symbol)
+                        continue
+                    self.synced[symbol] = d['s']
+                    o = self.service.orderbooks[self.symbols[symbol]]
+                    self._update(o, d)
+                    self.service.updateOrderbook(self.symbols[symbol], o)
+        def _update(self, o, d):
+            for side in ('a', 'b'):
+                oside = {
+                    'a' : o.SIDE_ASK,
+                    'b' : o.SIDE_BID,
+                }[side]
+                for price, size in d.get(side, []):
+                    price = Decimal(price)
+                    size = Decimal(size)
+                    if 0 == size:
+                        try:
+                            o.remove(oside, price)
+                        except KeyError:
+                            pass
+                    else:
+                        o.update(oside, price, size)
+            o.setupdated(d['t'] / 1000)
 
 class TestHitbtc(unittest.TestCase):
     """
@@ -181,6 +249,65 @@ Run simple self test.
         self.runCheck(self.checkWebsocket, timeout=10)
         self.assertTrue(0 < self.updates)
 
+    def testWebsocketSequence(self):
+        c = self.s.WSClient(self.s, pairs=[('BTC', 'USD'), ('ETH', 'USD')])
+        sent = []
+        c.send = sent.append
+        c._on_connection_success()
+        self.assertEqual(['BTCUSDT', 'ETHUSDT'], sent[0]['params']['symbols'])
+        pair = ('BTC', 'USD')
+        def book(kind, seq, asks, bids):
+            c._on_message(simplejson.dumps({
+                'ch': 'orderbook/full',
+                kind: {
+                    'BTCUSDT': {'t': 1000 * seq, 's': seq, 'a': asks, 'b': bids},
+                },
+            }))
+        book('snapshot', 10, [['101', '1']], [['100', '1'], ['99', '1']])
+        self.assertEqual(Decimal('101'), self.s.rates[pair]['ask'])
+        o = self.s.orderbooks[pair]
+        book('update', 11, [], [['100', '0']])
+        self.assertTrue(o is self.s.orderbooks[pair])
+        self.assertEqual(Decimal('99'), self.s.rates[pair]['bid'])
+        # Gap in the sequence, subscribe again and wait for a snapshot
+        book('update', 13, [['100.5', '1']], [])
+        self.assertEqual(Decimal('101'), self.s.rates[pair]['ask'])
+        self.assertEqual(['subscribe', 'unsubscribe', 'subscribe'],
+                         [r['method'] for r in sent])
+        # Only the symbol with the gap get a fresh snapshot
+        self.assertEqual(['BTCUSDT'], sent[1]['params']['symbols'])
+        self.assertEqual(['BTCUSDT'], sent[2]['params']['symbols'])
+        self.assertEqual(3, len(set([r['id'] for r in sent])))
+        book('update', 14, [['100.5', '1']], [])
+        self.assertEqual(Decimal('101'), self.s.rates[pair]['ask'])
+    def testFetchOrderbooks(self):
+        urls = []
+        async def jsonget(url):
+            urls.append(url)
+            return {
+                'BTCUSDT': {
+                    'timestamp': '2021-01-01T00:00:00.000Z',
+                    'ask': [['101', '1'], ['102', '2']],
+                    'bid': [['100', '1']],
+                },
+                'ETHUSDT': {
+                    'timestamp': '2021-01-01T00:00:00.000Z',
+                    'ask': [['11', '1']],
+                    'bid': [['10', '1']],
+                },
+            }, None
+        self.s._jsonget = jsonget
+        pairs = [('BTC', 'USD'), ('ETH', 'USD')]
+        tornado.ioloop.IOLoop.current().run_sync(
+            lambda: self.s._fetchOrderbooks(pairs))
+        # One request for all the pairs
+        self.assertEqual(1, len(urls))
+        self.assertTrue('symbols=BTCUSDT,ETHUSDT' in urls[0])
+        self.assertEqual(Decimal('101'), self.s.rates[pairs[0]]['ask'])
+        self.assertEqual(Decimal('10'), self.s.rates[pairs[1]]['bid'])
+        self.assertEqual(2, len(self.s.orderbooks[pairs[0]].ask))
+        self.assertEqual(1609459200, self.s.rates[pairs[0]]['when'])
+
 if __name__ == '__main__':
     t = TestHitbtc()
     unittest.main()
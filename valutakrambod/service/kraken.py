@@ -19,7 +19,9 @@ from os.path import expanduser
 from valutakrambod.services import Orderbook
 from valutakrambod.services import Service
 from valutakrambod.services import Trading
+from valutakrambod import tradetape
 from valutakrambod.websocket import WebSocketClient
+from valutakrambod.websocket import shard
 
 class Kraken(Service):
     """
@@ -38,6 +40,14 @@ https://www.kraken.com/features/websocket-api .
         }
     baseurl = "https://api.kraken.com/0/public/"
     privatebaseurl = "https://api.kraken.com/0/private/"
+    # From https://support.kraken.com/hc/en-us/articles/206548367 ,
+    # the private API counter decay with 0.33 per second and allow 15
+    # calls in a burst.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (1, 1),
+        Service.ENDPOINT_PRIVATE : (0.33, 15),
+        Service.ENDPOINT_ORDER : (1, 5),
+    }
     def servicename(self):
         return "Kraken"
 
@@ -64,7 +74,7 @@ https://www.kraken.com/features/websocket-api .
         #nonce = int(1000*time.time())
         nonce = int(time.time()*1000)
         return nonce
-    async def _signedpost(self, url, data):
+    async def _signedpost(self, url, data, endpoint = Service.ENDPOINT_PRIVATE):
         urlpath = urllib.parse.urlparse(url).path.encode('UTF-8')
         data['nonce'] = self._nonce()
         datastr = urllib.parse.urlencode(data)
@@ -83,11 +93,12 @@ https://www.kraken.com/features/websocket-api .
             'API-Key' : self.confget('apikey'),
             'API-Sign': sign,
             }
-        body, response = await self._post(url, body=datastr, headers=headers)
+        body, response = await self._post(url, body=datastr, headers=headers,
+                                          endpoint=endpoint)
         return body, response
-    async def _query_private(self, method, args):
+    async def _query_private(self, method, args, endpoint = Service.ENDPOINT_PRIVATE):
         url = "%s%s" % (self.privatebaseurl, method)
-        body, response = await self._signedpost(url, args)
+        body, response = await self._signedpost(url, args, endpoint)
         j = simplejson.loads(body.decode('UTF-8'), use_decimal=True)
         #print(j)
         if 0 != len(j['error']):
@@ -225,7 +236,8 @@ This is example output from the API call:
 #                'oflags' : ,
 #                'starttm' : ,
             }
-            res = await self.service._query_private('AddOrder', args)
+            res = await self.service._query_private('AddOrder', args,
+                                                    Service.ENDPOINT_ORDER)
             print(res)
             txids = res['txid']
             txdesc = res['descr']
@@ -234,7 +246,8 @@ This is example output from the API call:
             # Invalidate balance cache
             self._lastbalance = None
             args = {'txid' : orderref}
-            res = await self.service._query_private('CancelOrder', args)
+            res = await self.service._query_private('CancelOrder', args,
+                                                    Service.ENDPOINT_ORDER)
             return res
         async def cancelallorders(self, marketpair=None):
             raise NotImplementedError()
@@ -325,32 +338,117 @@ This is example output from the API call:
         return self.activetrader
 
     def websocket(self):
-        return self.WSClient(self)
+        return shard(self, self.WSClient)
 
     class WSClient(WebSocketClient):
-        def __init__(self, service):
-            super().__init__(service)
+        """Follow the order books of the wanted pairs.  The book depth is
+taken from the depths dictionary, using depth for pairs not listed
+there, and must be one of 10, 25, 100, 500 and 1000.  Kraken only
+send changes within the subscribed depth, and expect the client to
+drop the levels falling outside it.  Pairs can be added and removed
+at runtime using subscribepair() and unsubscribepair().
+
+The channels listed in channels are subscribed in addition to the
+book.  Trades are added to the trade tape of the service, while the
+ticker and spread update the rates until the order book is available.
+
+        """
+        usedecimal = True
+        # Kraken send a heartbeat every second when nothing else is sent
+        heartbeatinterval = 1
+        # Handle bursts of order book deltas in one go
+        batch = True
+        # Ask for compressed messages.  A 1000 level book snapshot is
+        # about 100 KiB, so anything larger than 2 MiB is broken.
+        compression = {}
+        maxmessagesize = 2 * 1024 * 1024
+        depth = 25
+        depths = {}
+        channels = ['trade', 'ticker', 'spread']
+        def __init__(self, service, pairs = None):
+            super().__init__(service, pairs=pairs)
             self.url = "wss://ws.kraken.com"
             self.channelinfo = {}
+            self.synced = set()
+            self.subscribed = {}
+            for pair in super().streampairs():
+                self.subscribed[pair] = self.depths.get(pair, self.depth)
         def connect(self, url = None):
             if url is None:
                 url = self.url
             super().connect(url)
+        def streampairs(self):
+            return list(self.subscribed.keys())
+        def _request(self, event, pairs, subscription):
+            self.send({
+                'event': event,
+                'subscription': subscription,
+                'pair': ["%s/%s" % p for p in pairs],
+            })
+        def _booksubscription(self, depth):
+            return {
+                'name': 'book',
+                'depth': depth,
+            }
         def _on_connection_success(self):
             #print("_on_connection_success()")
-            pairs = []
-            for p in self.service.ratepairs():
-                pairs.append("%s/%s" % (p[0], p[1]))
-            data = {
-                'event': 'subscribe',
-                'subscription': {
-                    'name': 'book',
-                    'depth': 500, # One of 10, 25, 100, 500, 1000
-                },
-                'pair': pairs,
-            }
-            self.send(data)
-            pass
+            # One request per depth
+            bydepth = {}
+            for pair, depth in self.subscribed.items():
+                bydepth.setdefault(depth, []).append(pair)
+            for depth, pairs in sorted(bydepth.items()):
+                self._request('subscribe', pairs, self._booksubscription(depth))
+            pairs = self.streampairs()
+            if pairs:
+                for name in self.channels:
+                    self._request('subscribe', pairs, {'name': name})
+        def subscribepair(self, pair, depth = None):
+            """Start following the order book of pair, with the given depth.
+If already subscribed with another depth, the old subscription is
+replaced.
+
+            """
+            if depth is None:
+                depth = self.depths.get(pair, self.depth)
+            if pair in self.subscribed:
+                old = self.subscribed[pair]
+                if depth == old:
+                    return
+                self.subscribed[pair] = depth
+                if self._ws_connection:
+                    self._request('unsubscribe', [pair],
+                                  self._booksubscription(old))
+                    self._request('subscribe', [pair],
+                                  self._booksubscription(depth))
+                return
+            self.subscribed[pair] = depth
+            self.lastpairupdate[pair] = time.time()
+            if self._ws_connection:
+                self._request('subscribe', [pair], self._booksubscription(depth))
+                for name in self.channels:
+                    self._request('subscribe', [pair], {'name': name})
+        def setpairs(self, pairs):
+            """Change the followed pairs without reconnecting."""
+            self.pairs = list(pairs)
+            for pair in list(self.subscribed.keys()):
+                if pair not in self.pairs:
+                    self.unsubscribepair(pair)
+            for pair in self.pairs:
+                self.subscribepair(pair)
+        def unsubscribepair(self, pair):
+            """Stop following pair."""
+            depth = self.subscribed.pop(pair, None)
+            if depth is None:
+                return
+            self.lastpairupdate.pop(pair, None)
+            if self._ws_connection:
+                self._request('unsubscribe', [pair],
+                              self._booksubscription(depth))
+                for name in self.channels:
+                    self._request('unsubscribe', [pair], {'name': name})
+        def _on_disconnect(self):
+            self.channelinfo = {}
+            self.synced = set()
         def symbols2pair(self, symbol):
             symbolmap = {
                 'XBT': 'BTC',
@@ -361,56 +459,116 @@ This is example output from the API call:
             if pair[0] in symbolmap:
                 pair[0] = symbolmap[pair[0]]
             return tuple(pair)
-        def _on_message(self, msg):
-            m = simplejson.loads(msg, use_decimal=True)
+        def _truncate(self, o, depth):
+            for table in (o.ask, o.bid):
+                while len(table) > depth:
+                    table.popitem()
+        def _on_subscriptionstatus(self, m):
+            pair = self.symbols2pair(m['pair'])
+            status = m.get('status')
+            if 'subscribed' == status:
+                self.channelinfo[m['channelID']] = {
+                    'pair': pair,
+                    'name': m['subscription']['name'],
+                    'depth': m['subscription'].get('depth', self.depth),
+                }
+            elif 'unsubscribed' == status:
+                self.channelinfo.pop(m.get('channelID'), None)
+                if 'book' == m['subscription']['name'] \
+                   and pair not in self.subscribed:
+                    self.synced.discard(pair)
+                    self.service.orderbooks.pop(pair, None)
+            elif 'error' == status:
+                self.service.logerror("%s subscription error for %s: %s" % (
+                    self.service.servicename(), m['pair'], m.get('errorMessage')))
+        def _on_trades(self, pair, data):
+            trades = []
+            for e in data:
+                side = {
+                    'b' : tradetape.BUY,
+                    's' : tradetape.SELL,
+                }[e[3]]
+                trades.append(tradetape.Trade(float(e[2]), Decimal(e[0]),
+                                              Decimal(e[1]), side))
+            self.service.updateTrades(pair, trades)
+        def _on_data(self, m):
             #print()
             #print(m)
             if dict == type(m):
                 # status/heartbeat
                 if 'event' in m:
                     if 'subscriptionStatus' == m['event']:
-                        channel = m['channelID']
-                        pair = self.symbols2pair(m['pair'])
-                        self.channelinfo[channel] = { 'pair': pair}
+                        self._on_subscriptionstatus(m)
                     elif 'heartbeat' == m['event']:
                         pass
                     elif 'systemStatus' == m['event']:
                         pass
             elif list == type(m):
                 channel = m[0]
-                pair = self.channelinfo[channel]['pair']
-                updates = list(m[1].keys())
-                #print("channel update:", updates, pair)
-                for update in updates:
-                    if update in ('as', 'bs'):
-                        o = Orderbook()
-                        for side in ('as', 'bs'):
-                            oside = {
-                                'as' : o.SIDE_ASK,
-                                'bs' : o.SIDE_BID,
-                            }[side]
-                            for e in m[1][side]:
-                                o.update(oside, Decimal(e[0]), Decimal(e[1]), float(e[2]))
-                        self.service.updateOrderbook(pair, o)
-                    elif update in ('a', 'b'):
-                        o = self.service.orderbooks[pair].copy()
-                        for side in ('a', 'b'):
-                            oside = {
-                                'a' : o.SIDE_ASK,
-                                'b' : o.SIDE_BID,
-                            }[side]
-                            if side in m[1]:
-                                for e in m[1][side]:
-                                    price = Decimal(e[0])
-                                    if '0.00000000' == e[1]:
-                                        try:
-                                            o.remove(oside, price)
-                                        except KeyError as e:
-                                            raise ValueError('asked to remove non-existing %s order %s' % (oside, price))
-                                    else:
-                                        volume = Decimal(e[1])
-                                        o.update(oside, price, volume, float(e[2]))
-                        self.service.updateOrderbook(pair, o)
+                if channel not in self.channelinfo:
+                    return
+                info = self.channelinfo[channel]
+                pair = info['pair']
+                if 'trade' == info['name']:
+                    self._on_trades(pair, m[1])
+                    return
+                elif 'ticker' == info['name']:
+                    if pair not in self.synced:
+                        self.service.updateRates(pair,
+                                                 Decimal(m[1]['a'][0]),
+                                                 Decimal(m[1]['b'][0]),
+                                                 None)
+                    return
+                elif 'spread' == info['name']:
+                    # Without a time like the ticker, as the order
+                    # book snapshot can be older than the last spread.
+                    if pair not in self.synced:
+                        self.service.updateRates(pair,
+                                                 Decimal(m[1][1]),
+                                                 Decimal(m[1][0]),
+                                                 None)
+                    return
+                # Updates with both asks and bids have one dictionary
+                # for each side.
+                data = {}
+                for d in m[1:]:
+                    if dict == type(d):
+                        data.update(d)
+                #print("channel update:", list(data.keys()), pair)
+                if 'as' in data or 'bs' in data:
+                    o = Orderbook()
+                    for side in ('as', 'bs'):
+                        oside = {
+                            'as' : o.SIDE_ASK,
+                            'bs' : o.SIDE_BID,
+                        }[side]
+                        for e in data.get(side, []):
+                            o.update(oside, Decimal(e[0]), Decimal(e[1]), float(e[2]))
+                    self.synced.add(pair)
+                    self.service.updateOrderbook(pair, o)
+                elif 'a' in data or 'b' in data:
+                    if pair not in self.synced:
+                        # Wait for the snapshot
+                        return
+                    o = self.service.orderbooks[pair]
+                    for side in ('a', 'b'):
+                        oside = {
+                            'a' : o.SIDE_ASK,
+                            'b' : o.SIDE_BID,
+                        }[side]
+                        for e in data.get(side, []):
+                            price = Decimal(e[0])
+                            volume = Decimal(e[1])
+                            if 0 == volume:
+                                try:
+                                    o.remove(oside, price)
+                                except KeyError:
+                                    # Already dropped by _truncate()
+                                    pass
+                            else:
+                                o.update(oside, price, volume, float(e[2]))
+                    self._truncate(o, info['depth'])
+                    self.service.updateOrderbook(pair, o)
             return
             if False:
                 if "ticker" == m['method']:
@@ -587,6 +745,69 @@ Run simple self test.
         self.runCheck(self.checkWebsocket, timeout=10)
         self.assertTrue(0 < self.updates)
 
+    def testWebsocketDepth(self):
+        c = self.s.websocket()
+        sent = []
+        c.send = sent.append
+        c._on_connection_success()
+        self.assertEqual(['book', 'trade', 'ticker', 'spread'],
+                         [r['subscription']['name'] for r in sent])
+        self.assertEqual(25, sent[0]['subscription']['depth'])
+        sent.clear()
+        c._ws_connection = True
+        c.subscribepair(('BTC', 'USD'), depth=10)
+        self.assertEqual(['unsubscribe', 'subscribe'],
+                         [r['event'] for r in sent])
+        c._ws_connection = None
+        pair = ('BTC', 'USD')
+        c._on_message(simplejson.dumps({
+            'event': 'subscriptionStatus', 'status': 'subscribed',
+            'channelID': 42, 'pair': 'XBT/USD',
+            'subscription': {'name': 'book', 'depth': 2},
+        }))
+        c._on_message('[42,{"as":[["101.0","1.0","1.0"],["102.0","1.0","1.0"]],'
+                      '"bs":[["100.0","1.0","1.0"],["99.0","1.0","1.0"]]},'
+                      '"book-2","XBT/USD"]')
+        # Asks and bids updated in the same message
+        c._on_message('[42,{"a":[["100.5","1.0","2.0"]]},'
+                      '{"b":[["100.0","0.00000000","2.0"]]},"book-2","XBT/USD"]')
+        o = self.s.orderbooks[pair]
+        self.assertEqual([Decimal('100.5'), Decimal('101.0')], list(o.ask.keys()))
+        self.assertEqual([Decimal('99.0')], list(o.bid.keys()))
+        self.assertEqual(Decimal('99.0'), self.s.rates[pair]['bid'])
+
+    def testWebsocketTrades(self):
+        c = self.s.websocket()
+        pair = ('BTC', 'EUR')
+        trades = []
+        self.s.tradesubscribe(lambda service, pair, t: trades.extend(t))
+        for channel, name in ((1, 'trade'), (2, 'spread')):
+            c._on_message(simplejson.dumps({
+                'event': 'subscriptionStatus', 'status': 'subscribed',
+                'channelID': channel, 'pair': 'XBT/EUR',
+                'subscription': {'name': name},
+            }))
+        c._on_message('[1,[["100.0","1.0","10.5","b","l",""],'
+                      '["101.0","3.0","11.5","s","m",""]],"trade","XBT/EUR"]')
+        self.assertEqual(2, len(trades))
+        self.assertEqual(tradetape.SELL, trades[1].side)
+        tape = self.s.tradetapes[pair]
+        self.assertEqual(Decimal('100.75'), tape.vwap())
+        self.assertEqual(Decimal('3.0'), tape.volume(since=11))
+        c._on_message('[2,["99.5","100.5","12.0","1.0","2.0"],"spread","XBT/EUR"]')
+        self.assertEqual(Decimal('100.5'), self.s.rates[pair]['ask'])
+        self.assertEqual(Decimal('99.5'), self.s.rates[pair]['bid'])
+        # A book snapshot older than the spread replace it
+        c._on_message(simplejson.dumps({
+            'event': 'subscriptionStatus', 'status': 'subscribed',
+            'channelID': 3, 'pair': 'XBT/EUR',
+            'subscription': {'name': 'book', 'depth': 10},
+        }))
+        c._on_message('[3,{"as":[["101.0","1.0","5.0"]],'
+                      '"bs":[["99.0","1.0","5.0"]]},"book-10","XBT/EUR"]')
+        self.assertEqual(Decimal('101.0'), self.s.rates[pair]['ask'])
+        self.assertEqual(5.0, self.s.rates[pair]['when'])
+
     async def checkBalanceCaching(self):
         t = self.s.trading()
         if not t:
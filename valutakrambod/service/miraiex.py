@@ -16,6 +16,11 @@ https://developers.miraiex.com/ .
 
     """
     baseurl = "https://api.miraiex.com/v1/"
+    hedging = True
+    # No documented limit, so stay at a modest pace.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (1, 5),
+    }
 
     def servicename(self):
         return "MiraiEx"
@@ -25,6 +25,13 @@ class Nbx(Service):
 found in https://nbx.com/developers .
     """
     baseurl = "https://api.nbx.com"
+    hedging = True
+    # No documented limit, so stay at a modest pace.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (1, 5),
+        Service.ENDPOINT_PRIVATE : (0.5, 5),
+        Service.ENDPOINT_ORDER : (0.5, 5),
+    }
 
     def servicename(self):
         return "NBX"
@@ -79,14 +86,16 @@ found in https://nbx.com/developers .
             'X-NBX-TIMESTAMP': timestamp
         }
         url = "%s%s" % (self.baseurl, path)
-        body, response = await self._post(url, body=body, headers=headers)
+        body, response = await self._post(url, body=body, headers=headers,
+                                          endpoint=Service.ENDPOINT_PRIVATE)
         j = simplejson.loads(body.decode('UTF-8'), use_decimal=True)
         self.token = j['token']
         self.token_timestamp = now
         return self.token
 
 
-    async def _query_private(self, path, args = None, method = None):
+    async def _query_private(self, path, args = None, method = None,
+                             endpoint = Service.ENDPOINT_PRIVATE):
         token = await self._refresh_token()
         headers = {'Authorization': f'Bearer {self.token}'}
         account_id = self.confget('account_id')
@@ -97,17 +106,19 @@ found in https://nbx.com/developers .
             url = path
         if 'POST' == method:
             body, response = await self._post(url, body=simplejson.dumps(args),
-                                              headers=headers)
+                                              headers=headers, endpoint=endpoint)
             j = simplejson.loads(body.decode('UTF-8'), use_decimal=True)
         elif 'DELETE' == method:
-            body, response = await self._fetch(method, url, headers=headers)
+            body, response = await self._fetch(method, url, headers=headers,
+                                               endpoint=endpoint)
             if body and '' != body:
                 j = simplejson.loads(body.decode('UTF-8'), use_decimal=True)
             else:
                 j = None, response
             return j, response
         else: # GET
-            j, response = await self._jsonget(url, headers=headers)
+            j, response = await self._jsonget(url, headers=headers,
+                                              endpoint=endpoint)
         return j, response
 
 
@@ -206,7 +217,8 @@ found in https://nbx.com/developers .
             }
             #print(method, path, body)
             j, response = \
-                await self.service._query_private(path, body, method='POST')
+                await self.service._query_private(path, body, method='POST',
+                                                  endpoint=Service.ENDPOINT_ORDER)
             location = response.headers['Location']
             #print("Location:", location)
             m = re.match(r'^.*/accounts/.+/orders/(.+)$', location)
@@ -218,7 +230,8 @@ found in https://nbx.com/developers .
             market_id = self.service._makepair(marketpair[0], marketpair[1])
             path = f'/markets/{market_id}/orders/{order_id}'
             j, response = \
-                await self.service._query_private(path, method='DELETE')
+                await self.service._query_private(path, method='DELETE',
+                                                  endpoint=Service.ENDPOINT_ORDER)
             return j
 
 
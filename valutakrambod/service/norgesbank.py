@@ -18,6 +18,10 @@ daily.  See also https://www.norges-bank.no/RSS/.
 
     """
     baseurl = "https://www.norges-bank.no/"
+    # The rates are published once a day.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (0.2, 2),
+    }
 
     def servicename(self):
         return "Norgesbank"
@@ -19,6 +19,10 @@ https://1forge.com/forex-data-api .
 
     """
     baseurl = "https://forex.1forge.com/1.0.1/"
+    # The free plan allow 1000 requests per day.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (1000 / 86400, 5),
+    }
 
     def servicename(self):
         return "OneForge"
@@ -12,6 +12,7 @@ import tornado.ioloop
 import unittest
 import urllib
 
+from tornado import gen
 from tornado.httpclient import HTTPError
 
 from decimal import Decimal, ROUND_DOWN
@@ -30,6 +31,12 @@ https://github.com/Paymium/api-documentation/blob/master/WEBSOCKETS.md.
 
     """
     baseurl = "https://paymium.com/api/v1/"
+    # No documented limit, so stay at a modest pace.
+    ratelimits = {
+        Service.ENDPOINT_PUBLIC : (1, 5),
+        Service.ENDPOINT_PRIVATE : (0.5, 5),
+        Service.ENDPOINT_ORDER : (0.5, 5),
+    }
     def servicename(self):
         return "Paymium"
 
@@ -41,7 +48,8 @@ https://github.com/Paymium/api-documentation/blob/master/WEBSOCKETS.md.
         nonce = int(time.time()*100)
         #print("Using nonce %d" % nonce)
         return nonce
-    async def _signedfetch(self, method, url, data):
+    async def _signedfetch(self, method, url, data,
+                           endpoint = Service.ENDPOINT_PRIVATE):
         urlpath = urllib.parse.urlparse(url).path.encode('UTF-8')
         nonce = self._nonce()
         datastr = urllib.parse.urlencode(data)
@@ -62,15 +70,18 @@ https://github.com/Paymium/api-documentation/blob/master/WEBSOCKETS.md.
             'Authorization': 'Bearer %s' % self.confget('apikey'),
         }
         if 'POST' == method:
-                body, response = await self._post(url, body=datastr, headers=headers)
+                body, response = await self._post(url, body=datastr, headers=headers,
+                                                  endpoint=endpoint)
         else:
-            body, response = await self._fetch(method, url, headers=headers)
+            body, response = await self._fetch(method, url, headers=headers,
+                                               endpoint=endpoint)
         return body, response
-    async def _query_private_fetch(self, method, action, args = {}):
+    async def _query_private_fetch(self, method, action, args = {},
+                                   endpoint = Service.ENDPOINT_PRIVATE):
         url = "%s%s" % (self.baseurl, action)
-        body, response = await self._signedfetch(method, url, args)
+        body, response = await self._signedfetch(method, url, args, endpoint)
         if body and '' != body:
-            j = simplejson.loads(response.body.decode('UTF-8'), use_decimal=True)
+            j = simplejson.loads(body.decode('UTF-8'), use_decimal=True)
             #print(j)
         else:
             j = None
@@ -129,15 +140,73 @@ https://github.com/Paymium/api-documentation/blob/master/WEBSOCKETS.md.
         return res
 
     class SIOClient(SocketIOClient):
+        """Keep the order book up to date using the bids and asks stream
+events.  These give the new amount for a price level, with amount
+zero when the level is gone.  A REST snapshot is fetched when the
+connection is established, and the events received while waiting for
+it are buffered and applied on top of the snapshot.  Events received
+before the snapshot was requested are already included in it, and are
+dropped, as they could bring back a level the snapshot no longer
+have.  Events received while the snapshot was requested are applied,
+as they are more recent than the ones already dropped.
+
+        """
+        usedecimal = True
+        # Seconds to wait before retrying a failed snapshot fetch
+        snapshotretry = 10
         def __init__(self, service):
             super().__init__(service)
             self.url = "wss://paymium.com/ws/socket.io/?transport=websocket"
+            self.synced = set()
+            self.buffered = {}
+            self.retries = {}
         def connect(self, url = None):
             if url is None:
                 url = self.url
             super().connect(url)
         def _on_connection_success(self):
             self.subscribe('/public')
+            for pair in self.streampairs():
+                self.buffered[pair] = []
+                self.service.ioloop.add_callback(
+                    self._fetchSnapshot, pair)
+        def _on_disconnect(self):
+            super()._on_disconnect()
+            self._cancelretries()
+            self.synced = set()
+            self.buffered = {}
+        def close(self):
+            self._cancelretries()
+            super().close()
+        def _cancelretries(self):
+            for timeout in self.retries.values():
+                self.service.ioloop.remove_timeout(timeout)
+            self.retries = {}
+        async def _fetchSnapshot(self, pair):
+            self.retries.pop(pair, None)
+            if pair not in self.buffered:
+                # Disconnected while waiting
+                return
+            start = time.time()
+            try:
+                await self.service.track(self.service._fetchOrderbooks([pair]))
+            except Exception as e:
+                self.service.logerror("fetching %s order book snapshot failed: %s" %
+                                      (pair, str(e)))
+                if pair in self.buffered:
+                    # Included in the snapshot fetched by the retry
+                    self.buffered[pair] = []
+                    self.retries[pair] = self.service.ioloop.call_later(
+                        self.snapshotretry, self._fetchSnapshot, pair)
+                return
+            if pair not in self.buffered:
+                return
+            deltas = [(oside, order)
+                      for received, oside, order in self.buffered.pop(pair)
+                      if received >= start]
+            self.synced.add(pair)
+            if deltas:
+                self._applyDeltas(pair, deltas)
         def _on_event(self, channel, events):
             #print("_on_events('%s', '%s')" % (channel, events))
             t, m = events
@@ -149,6 +218,8 @@ https://github.com/Paymium/api-documentation/blob/master/WEBSOCKETS.md.
             else:
                 pass # unknown event type
         def _on_stream_event(self, data):
+            now = time.time()
+            deltas = {}
             for t in data.keys():
                 if 'ticker' == t:
                     pair = ('BTC', data['ticker']['currency'])
@@ -157,18 +228,40 @@ https://github.com/Paymium/api-documentation/blob/master/WEBSOCKETS.md.
                                              Decimal(data['ticker']['bid']),
                                              data['ticker']['at'],
                     )
-                # Hm, how can we know we start with the complete
-                # ordebook when we start patching using bids and
-                # asks?
-                elif 'bids' == t:
-                    pass
-                elif 'asks' == t:
-                    pass
+                elif t in ('bids', 'asks'):
+                    oside = {
+                        'asks' : Orderbook.SIDE_ASK,
+                        'bids' : Orderbook.SIDE_BID,
+                    }[t]
+                    for order in data[t]:
+                        pair = ('BTC', order['currency'])
+                        if pair not in deltas:
+                            deltas[pair] = []
+                        deltas[pair].append((oside, order))
                 elif 'trades' == t:
                     # Ignore trades for now
                     pass
                 else: # unknown stream data type, ignore for now
                     pass
+            for pair, l in deltas.items():
+                if pair in self.synced:
+                    self._applyDeltas(pair, l)
+                elif pair in self.buffered:
+                    self.buffered[pair].extend(
+                        [(now, oside, order) for oside, order in l])
+        def _applyDeltas(self, pair, deltas):
+            o = self.service.orderbooks[pair]
+            for oside, order in deltas:
+                price = Decimal(order['price'])
+                if 0 == order['amount']:
+                    try:
+                        o.remove(oside, price)
+                    except KeyError:
+                        pass
+                else:
+                    o.update(oside, price, Decimal(order['amount']),
+                             order.get('timestamp'))
+            self.service.updateOrderbook(pair, o)
     def websocket(self):
         return self.SIOClient(self)
 
@@ -249,7 +342,8 @@ This is example output from the API call:
             }
             #print(args)
             try:
-                res = await self.service._query_private_fetch('POST', 'user/orders', args)
+                res = await self.service._query_private_fetch('POST', 'user/orders', args,
+                                                              Service.ENDPOINT_ORDER)
                 print(res)
             except HTTPError as e:
                 print("error:", e.response.body)
@@ -258,7 +352,8 @@ This is example output from the API call:
         async def cancelorder(self, marketpair, orderref):
             # Invalidate balance cache
             self._lastbalance = None
-            res = await self.service._query_private_fetch('DELETE', 'user/orders/%s/cancel' % orderref)
+            res = await self.service._query_private_fetch('DELETE', 'user/orders/%s/cancel' % orderref,
+                                                          endpoint=Service.ENDPOINT_ORDER)
             # Nothing needs to be returned.  _query_private() will
             # throw if not successfull
             return
@@ -413,6 +508,55 @@ Run simple self test of the Paymium service class.
         self.runCheck(self.checkWebsocket, timeout=10)
         self.assertTrue(0 < self.updates)
 
+    async def checkStreamDeltas(self):
+        pair = ('BTC', 'EUR')
+        async def fetchOrderbooks(pairs):
+            await gen.sleep(0.01)
+            # Received while the snapshot is requested
+            c._on_event('/public', ['stream', {'asks': [
+                {'price': Decimal('101'), 'amount': Decimal('0'), 'currency': 'EUR'},
+            ]}])
+            o = Orderbook()
+            o.update(Orderbook.SIDE_ASK, Decimal('101'), Decimal('1'))
+            o.update(Orderbook.SIDE_ASK, Decimal('102'), Decimal('1'))
+            o.update(Orderbook.SIDE_BID, Decimal('99'), Decimal('1'))
+            self.s.updateOrderbook(pair, o)
+        self.s._fetchOrderbooks = fetchOrderbooks
+        c = self.s.websocket()
+        self.assertEqual([pair], c.streampairs())
+        c.buffered[pair] = []
+        # Already included in the snapshot, the level is gone
+        c._on_event('/public', ['stream', {'asks': [
+            {'price': Decimal('100.5'), 'amount': Decimal('1'), 'currency': 'EUR'},
+        ]}])
+        self.assertFalse(pair in self.s.orderbooks)
+        await gen.sleep(0.01)
+        await c._fetchSnapshot(pair)
+        self.assertEqual(Decimal('102'), self.s.rates[pair]['ask'])
+        self.assertEqual(1, len(self.s.orderbooks[pair].ask))
+        c._on_event('/public', ['stream', {'bids': [
+            {'price': Decimal('100'), 'amount': Decimal('2'), 'currency': 'EUR'},
+        ]}])
+        self.assertEqual(Decimal('100'), self.s.rates[pair]['bid'])
+        self.assertEqual(2, len(self.s.orderbooks[pair].bid))
+        self.ioloop.stop()
+    def testStreamDeltas(self):
+        self.runCheck(self.checkStreamDeltas)
+    def testSnapshotRetry(self):
+        pair = ('BTC', 'EUR')
+        async def fetchOrderbooks(pairs):
+            raise HTTPError(503)
+        self.s._fetchOrderbooks = fetchOrderbooks
+        self.s.logerror = lambda msg: None
+        c = self.s.websocket()
+        c.buffered[pair] = [(0, Orderbook.SIDE_ASK, {})]
+        self.ioloop.run_sync(lambda: c._fetchSnapshot(pair))
+        # The buffered events are dropped and a retry scheduled
+        self.assertEqual([], c.buffered[pair])
+        self.assertIn(pair, c.retries)
+        c.close()
+        self.assertEqual({}, c.retries)
+
 
     async def checkTradingConnection(self):
         # Unable to test without API access credentials in the config
@@ -2,16 +2,36 @@
 # Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
 # This file is covered by the GPLv2 or later, read COPYING for details.
 
+import asyncio
 import collections
+import copy
+import io
+import logging
 import simplejson
 import statistics
 import time
+import unittest
+import urllib.parse
+import warnings
+import zlib
 from operator import neg
 
 from decimal import Decimal
 from sortedcontainers.sorteddict import SortedDict
+from tornado import gen
 from tornado import httpclient
 import tornado.ioloop
+from tornado.platform.asyncio import AsyncIOLoop
+
+from valutakrambod import ratelimit
+from valutakrambod import recorder
+from valutakrambod import resilience
+from valutakrambod import tradetape
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 class Orderbook(object):
     SIDE_ASK = "ask"
@@ -138,20 +158,175 @@ volume for price.
         """
         return Decimal(0.0)
 
+def acceptencoding():
+    """Return the Accept-Encoding header value listing the compression
+methods supported by decompress().
+
+    """
+    if brotli is not None:
+        return "gzip, deflate, br"
+    return "gzip, deflate"
+
+def decompress(body, encoding):
+    """Return body decompressed according to the Content-Encoding value
+in encoding.
+
+    """
+    encoding = encoding.strip().lower()
+    if encoding in ('', 'identity'):
+        return body
+    elif 'gzip' == encoding:
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif 'deflate' == encoding:
+        # Some servers send raw deflate data without the zlib header
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    elif 'br' == encoding and brotli is not None:
+        return brotli.decompress(body)
+    raise ValueError('unsupported content encoding %s' % encoding)
+
+# The IOLoops created by tornadoloop() for loops that were not running,
+# forgotten when the loop is closed.
+_ioloops = {}
+
+def tornadoloop(loop):
+    """Return the tornado IOLoop running on loop, which can be a tornado
+IOLoop, an asyncio event loop like the one provided by uvloop, or None
+for the current loop when the IOLoop is first needed.
+
+    """
+    if loop is None or isinstance(loop, tornado.ioloop.IOLoop):
+        return loop
+    try:
+        if asyncio.get_running_loop() is loop:
+            return tornado.ioloop.IOLoop.current()
+    except RuntimeError:
+        pass
+    for closed in [l for l in _ioloops if l.is_closed()]:
+        del _ioloops[closed]
+    if loop not in _ioloops:
+        try:
+            _ioloops[loop] = AsyncIOLoop(asyncio_loop=loop)
+        except RuntimeError:
+            # Tornado already have an IOLoop for loop, for example
+            # because IOLoop.current() was called while loop was the
+            # current event loop.  Look it up the same way.
+            _ioloops[loop] = _currentioloop(loop)
+    return _ioloops[loop]
+
+def _currentioloop(loop):
+    """Return the IOLoop tornado already created for loop."""
+    policy = asyncio.get_event_loop_policy()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        try:
+            previous = policy.get_event_loop()
+        except RuntimeError:
+            previous = None
+    asyncio.set_event_loop(loop)
+    try:
+        return tornado.ioloop.IOLoop.current()
+    finally:
+        asyncio.set_event_loop(previous)
+
+def inloop(ioloop):
+    """Return True if called from the running ioloop."""
+    try:
+        return asyncio.get_running_loop() is ioloop.asyncio_loop
+    except RuntimeError:
+        return False
+
+def jsondecode(text, usedecimal = True):
+    """Return the decoded JSON document in text, a string or UTF-8
+encoded bytes.  Numbers with decimals are returned as Decimal if
+usedecimal is True.  This is a module level function to allow it to
+be passed to a process pool.
+
+    """
+    if isinstance(text, bytes):
+        text = text.decode('UTF-8')
+    return simplejson.loads(text, use_decimal=usedecimal)
+
+class _HedgeAborted(Exception):
+    """Raised to make tornado close the connection of an aborted request."""
+
+def _hedgelogfilter(record):
+    # Tornado log the exception used to abort a request as uncaught
+    e = record.exc_info[1] if record.exc_info else None
+    while e is not None:
+        if isinstance(e, _HedgeAborted):
+            return False
+        e = e.__context__
+    return True
+
+logging.getLogger('tornado.application').addFilter(_hedgelogfilter)
+
 class Service(object):
-    def __init__(self, currencies=None):
-        self.http_client = httpclient.AsyncHTTPClient(
-            defaults=dict(user_agent="Valutakrambod library client")
-        )
+    ENDPOINT_PUBLIC = "public"
+    ENDPOINT_PRIVATE = "private"
+    ENDPOINT_ORDER = "order"
+    # Rate limits per endpoint class, as (requests per second, burst)
+    # tuples.  See valutakrambod.ratelimit for details.
+    ratelimits = {}
+    # Retry failing GET requests this many times, waiting a jittered
+    # exponential backoff starting at retrybackoff seconds between
+    # each attempt.
+    retries = 2
+    retrybackoff = 0.5
+    retrybackoffmax = 10
+    # Pause the updates after circuitthreshold failed updates in a
+    # row, and probe the service again after circuitcooldown seconds.
+    circuitthreshold = 5
+    circuitcooldown = 30
+    # Send a duplicate GET request when the first one has not
+    # completed within the 95 percentile of the observed latency, as
+    # long as the duplicates stay below hedgebudget of all requests.
+    hedging = False
+    hedgebudget = 0.05
+    # Set to a recorder.Recorder object to record all HTTP bodies and
+    # websocket messages received from the service.
+    recorder = None
+    # Number of trades to keep per pair in the trade tapes.
+    tradetapelen = 10000
+    # Set to a concurrent.futures executor to parse JSON documents of
+    # jsonparsethreshold bytes or more outside the IO loop.  A
+    # ProcessPoolExecutor avoid holding the GIL while parsing.
+    jsonparser = None
+    jsonparsethreshold = 256 * 1024
+    def __init__(self, currencies=None, ioloop=None):
+        self._ioloop = tornadoloop(ioloop)
+        self._http_client = None
         self.rates = {}
         self.orderbooks = {}
         self.subscribers = []
+        self.batchdepth = 0
+        self.batched = {}
         self.updates = {}
         self.currencies = currencies
         self.wantedpairs = None
         self.periodic = None
+        self.periodicpairs = None
         self.activetrader = None
-        self.lastupdaterequest = 0
+        self.updatepending = False
+        self.metrics = collections.Counter()
+        self.inflight = {}
+        self.inflightwaiters = collections.Counter()
+        self.latencies = collections.deque(maxlen=100)
+        self.status = {}
+        self.statussubscribers = []
+        self.tradetapes = {}
+        self.tradesubscribers = []
+        self.stalestreams = {}
+        self.stream = None
+        self.tasks = set()
+        self.closed = False
+        self.circuit = resilience.CircuitBreaker(
+            threshold=self.circuitthreshold,
+            cooldown=self.circuitcooldown,
+            onchange=self._circuitchanged,
+        )
         if currencies:
             for p in self.ratepairs():
                 #print(p, currencies)
@@ -164,11 +339,52 @@ class Service(object):
             self.wantedpairs = self.ratepairs()
         #print("Want", self.wantedpairs)
         self.errsubscribers = []
+    @property
+    def ioloop(self):
+        """The tornado IOLoop used by the service and its websocket clients,
+given to the constructor or the current IOLoop when first used.
+
+        """
+        if self._ioloop is None:
+            self._ioloop = tornado.ioloop.IOLoop.current()
+        return self._ioloop
+    @property
+    def http_client(self):
+        # Created on first use, to make sure it belong to the IO loop
+        # running the requests.  Not shared with other services, to
+        # allow aclose() to close it.
+        if self._http_client is None:
+            self._http_client = httpclient.AsyncHTTPClient(
+                force_instance=True,
+                defaults=dict(user_agent="Valutakrambod library client")
+            )
+        return self._http_client
+    def _inloop(self, callback, *args):
+        """Call callback with args in the IO loop of the service, at once if
+already running there.
+
+        """
+        if inloop(self.ioloop):
+            callback(*args)
+        else:
+            self.ioloop.add_callback(callback, *args)
     def errsubscribe(self, callback):
         self.errsubscribers.append(callback)
     def logerror(self, msg):
         for s in self.errsubscribers:
             s(self, msg)
+    def statussubscribe(self, callback):
+        self.statussubscribers.append(callback)
+    def updateStatus(self, key, value):
+        """Record the status value for key, for example the state of the
+circuit breaker, and tell the status subscribers if it changed.
+
+        """
+        if key in self.status and self.status[key] == value:
+            return
+        self.status[key] = value
+        for s in self.statussubscribers:
+            s(self, key, value)
 
     def confinit(self, config):
         """Set a configparser compatible object member for use by individual
@@ -187,50 +403,345 @@ services to store configuration.
     def confset(self, key, value):
         return self._config.set(self.servicename(), key, value)
 
-    async def _fetch(self, method, url, timeout = 30, headers = None):
+    def addmetric(self, name, value = 1):
+        """Add value to the named counter in the metrics member."""
+        self.metrics[name] += value
+    def _ratelimiter(self, url, endpoint):
+        """Return the token bucket limiting requests to the endpoint class
+of the host in url, or None if the requests are not limited.
+
+        """
+        if endpoint not in self.ratelimits:
+            return None
+        rate, burst = self.ratelimits[endpoint]
+        host = urllib.parse.urlsplit(url).netloc
+        return ratelimit.bucket(host, endpoint, rate, burst)
+    async def _throttle(self, url, endpoint):
+        """Wait until the rate limit for the given endpoint class allow
+another request to the host in url.  Return the time spent waiting.
+
+        """
+        bucket = self._ratelimiter(url, endpoint)
+        if bucket is None:
+            return 0
+        delay = await bucket.acquire()
+        self.addmetric('ratelimit.requests.%s' % endpoint)
+        self.addmetric('ratelimit.wait.%s' % endpoint, delay)
+        return delay
+    def latencypercentile(self, percentile):
+        """Return the given percentile of the latency of the last requests
+to the service, or None if too few requests have been made to tell.
+
+        """
+        if len(self.latencies) < 20:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * percentile / 100))]
+    async def _timedfetch(self, req):
+        start = time.monotonic()
+        response = await self.http_client.fetch(req)
+        self.latencies.append(time.monotonic() - start)
+        return response
+    def _abortablefetch(self, req):
+        """Start fetching req, and return the task fetching it and a function
+aborting the request.  Tornado can not cancel a request in flight, so
+the body is received using a streaming callback, which make tornado
+close the connection when more data arrive after the request was
+aborted or the task cancelled.
+
+        """
+        chunks = []
+        aborted = []
+        def received(chunk):
+            if aborted:
+                raise _HedgeAborted()
+            chunks.append(chunk)
+        streamed = copy.copy(req)
+        streamed.streaming_callback = received
+        async def fetch():
+            response = await self._timedfetch(streamed)
+            return httpclient.HTTPResponse(
+                req, response.code, headers=response.headers,
+                buffer=io.BytesIO(b''.join(chunks)),
+                effective_url=response.effective_url,
+                reason=response.reason,
+                request_time=response.request_time,
+                start_time=response.start_time,
+                time_info=response.time_info)
+        def abort(task = None):
+            if task is None or task.cancelled():
+                aborted.append(True)
+        task = self.track(fetch())
+        # Also when cancelled by aclose()
+        task.add_done_callback(abort)
+        return task, abort
+    async def _hedgedfetch(self, req, endpoint):
+        """Fetch req, and send a duplicate request if the first one is slower
+than the usual requests to the service.  Return the first successful
+response, and abort the other request.  Both are aborted if the caller
+is cancelled.
+
+        """
+        delay = self.latencypercentile(95)
+        if delay is None:
+            return await self._timedfetch(req)
+        first, abortfirst = self._abortablefetch(req)
+        requests = [(first, abortfirst)]
+        try:
+            done, pending = await asyncio.wait([first], timeout=delay)
+            if done:
+                return first.result()
+            bucket = self._ratelimiter(req.url, endpoint)
+            if self.metrics['hedge.sent'] + 1 > \
+               self.hedgebudget * self.metrics['requests'] or \
+               (bucket is not None and not bucket.tryacquire()):
+                return await first
+            self.addmetric('hedge.sent')
+            second, abortsecond = self._abortablefetch(req)
+            requests.append((second, abortsecond))
+            pending = [first, second]
+            while True:
+                done, pending = await asyncio.wait(pending,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                winner = done.pop()
+                if winner.exception() is None or not pending:
+                    break
+            if winner is second:
+                self.addmetric('hedge.won')
+            return winner.result()
+        finally:
+            # The slower request is no longer needed
+            for f, abort in requests:
+                if not f.done():
+                    abort()
+                    f.cancel()
+    async def _fetch(self, method, url, timeout = 30, headers = None,
+                     body = None, endpoint = ENDPOINT_PUBLIC):
+        """Send a HTTP request to the service and return the body and the
+response.  The body is decompressed if the service compressed it,
+while response.body is the body as it was received.
+
+        """
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = acceptencoding()
         req = httpclient.HTTPRequest(url,
                           method,
+                          body=body,
                           request_timeout=timeout,
                           headers=headers,
+                          decompress_response=False,
         )
-        response = await self.http_client.fetch(req)
+        attempt = 0
+        while True:
+            await self._throttle(url, endpoint)
+            self.addmetric('requests')
+            try:
+                if self.hedging and 'GET' == method:
+                    response = await self._hedgedfetch(req, endpoint)
+                else:
+                    response = await self._timedfetch(req)
+                break
+            except Exception as e:
+                # Only retry requests without side effects
+                if 'GET' != method or attempt >= self.retries \
+                   or not resilience.retryable(e):
+                    raise
+                delay = resilience.retryafter(e)
+                if delay is None:
+                    delay = resilience.backoff(attempt, self.retrybackoff,
+                                               self.retrybackoffmax)
+                self.addmetric('retries')
+                await gen.sleep(min(delay, self.retrybackoffmax))
+                attempt += 1
         #print("updated %s" % self.servicename())
-        return response.body, response
-    async def _get(self, url, timeout = 30, headers = None):
-        return await self._fetch('GET', url, timeout = timeout, headers = headers)
-    async def _jsonget(self, url, timeout = 30, headers = None):
-        body, response = await self._get(url, timeout=timeout, headers=headers)
-        j = simplejson.loads(body.decode('UTF-8'), use_decimal=True)
-        return j, response
-    async def _post(self, url, body = "", timeout = 30, headers = None):
-        req = httpclient.HTTPRequest(url,
-                                     "POST",
-                                     body=body,
-                                     request_timeout=timeout,
-                                     headers=headers)
-        response = await self.http_client.fetch(req)
-        return response.body, response
+        self.addmetric('bytes.wire', len(response.body))
+        body = decompress(response.body,
+                          response.headers.get('Content-Encoding', ''))
+        self.addmetric('bytes.decompressed', len(body))
+        if self.recorder is not None:
+            self.recorder.record(recorder.HTTP, self.servicename(), body,
+                                 url=url)
+        return body, response
+    async def _get(self, url, timeout = 30, headers = None,
+                   endpoint = ENDPOINT_PUBLIC):
+        return await self._fetch('GET', url, timeout = timeout, headers = headers,
+                                 endpoint = endpoint)
+    async def _singleflight(self, key, func):
+        """Call the coroutine function func and return its result, unless a
+call with the same key is already in flight.  In that case wait for
+the call in flight to finish and share its result instead of sending
+a duplicate request to the service.  Cancelling a caller only cancel
+the call when no other caller is waiting for it.
+
+        """
+        future = self.inflight.get(key)
+        if future is None:
+            future = gen.convert_yielded(func())
+            self.inflight[key] = future
+            future.add_done_callback(lambda f: self.inflight.pop(key, None))
+        else:
+            self.addmetric('singleflight.shared')
+        self.inflightwaiters[future] += 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self.inflightwaiters[future] -= 1
+            if 0 == self.inflightwaiters[future]:
+                del self.inflightwaiters[future]
+                if not future.done():
+                    future.cancel()
+    def track(self, coro):
+        """Run the coroutine coro as a task cancelled by aclose(), and return
+the task.
+
+        """
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+    def _jsonoffload(self, text, usedecimal = True):
+        """Start parsing the JSON document in text in the jsonparser
+executor and return a future with the result, or return None if the
+document should be parsed inline.
+
+        """
+        if self.jsonparser is None or len(text) < self.jsonparsethreshold:
+            return None
+        self.addmetric('json.offloaded')
+        return self.ioloop.run_in_executor(
+            self.jsonparser, jsondecode, text, usedecimal)
+    async def _jsonloads(self, text, usedecimal = True):
+        future = self._jsonoffload(text, usedecimal)
+        if future is None:
+            return jsondecode(text, usedecimal)
+        return await future
+    async def _jsonget(self, url, timeout = 30, headers = None,
+                       endpoint = ENDPOINT_PUBLIC):
+        async def jsonget():
+            body, response = await self._get(url, timeout=timeout,
+                                             headers=headers,
+                                             endpoint=endpoint)
+            j = await self._jsonloads(body)
+            return j, response
+        key = ('GET', url, endpoint,
+               tuple(sorted(headers.items())) if headers else None)
+        return await self._singleflight(key, jsonget)
+    async def _post(self, url, body = "", timeout = 30, headers = None,
+                    endpoint = ENDPOINT_PRIVATE):
+        return await self._fetch('POST', url, timeout = timeout,
+                                 headers = headers, body = body,
+                                 endpoint = endpoint)
     def servicename(self):
         raise NotImplementedError()
     def subscribe(self, callback):
         self.subscribers.append(callback)
+    def unsubscribe(self, callback):
+        """Stop calling callback on updates.  Unknown callbacks are ignored."""
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+    def tradesubscribe(self, callback):
+        """Call callback(service, pair, trades) when new trades are seen, with
+a list of tradetape.Trade objects.
+
+        """
+        self.tradesubscribers.append(callback)
+    def updateTrades(self, pair, trades):
+        """Add the trades to the trade tape of pair, and tell the trade
+subscribers about them.
+
+        """
+        if pair not in self.tradetapes:
+            self.tradetapes[pair] = tradetape.TradeTape(self.tradetapelen)
+        self.tradetapes[pair].extend(trades)
+        for s in self.tradesubscribers:
+            s(self, pair, trades)
+    def beginBatch(self):
+        """Hold back subscriber notifications until the matching call to
+endBatch().  Used to apply a batch of updates and only notify the
+subscribers once per pair with the final state.
+
+        """
+        self.batchdepth += 1
+    def endBatch(self):
+        self.batchdepth -= 1
+        if 0 == self.batchdepth:
+            batched = self.batched
+            self.batched = {}
+            for pair, changed in batched.items():
+                for s in self.subscribers:
+                    s(self, pair, changed)
+    def _notify(self, pair, changed):
+        if 0 < self.batchdepth:
+            self.batched[pair] = self.batched.get(pair, False) or changed
+        else:
+            for s in self.subscribers:
+                s(self, pair, changed)
+    def _circuitchanged(self, state):
+        if resilience.CircuitBreaker.OPEN == state:
+            self.logerror("%s failing, pausing updates for %d seconds" %
+                          (self.servicename(), self.circuit.cooldown))
+        elif resilience.CircuitBreaker.CLOSED == state:
+            self.logerror("%s working again, resuming updates" %
+                          self.servicename())
+        self.updateStatus('circuit', state)
     async def _callFetchRates(self):
+        # Do not start a new update while the previous one is still
+        # running, for example waiting for the rate limiter.
+        if self.closed or self.updatepending or not self.circuit.allow():
+            return
+        self.updatepending = True
+        task = asyncio.current_task()
+        self.tasks.add(task)
         try:
-            await self.fetchRates()
+            if self.periodicpairs is None:
+                await self.fetchRates()
+            else:
+                await self.fetchRates(self.periodicpairs)
+            self.circuit.success()
         except Exception as e:
-            self.logerror("%s fetchRates: %s" % (self.servicename(),
-                                                 str(e)))
-            raise
+            # Only report the first failures, the circuit breaker
+            # report when it give up on the service.
+            if resilience.CircuitBreaker.CLOSED == self.circuit.state:
+                self.logerror("%s fetchRates: %s" % (self.servicename(),
+                                                     str(e)))
+            self.circuit.failure()
+        finally:
+            self.tasks.discard(task)
+            self.updatepending = False
     def requestUpdate(self):
-        # Do not ask for updates more than once every two seconds, to give the
-        # update some time to finish and avoid rate limiting on the service side
-        if self.lastupdaterequest + 2 < time.time():
-            tornado.ioloop.IOLoop.current().add_callback(self._callFetchRates)
-            self.lastupdaterequest = time.time()
-    def periodicUpdate(self, mindelay = 30): # 30 seconds
+        # The rate limiter in _fetch() space the requests to the
+        # service, so only avoid queuing up several updates.
+        if not self.updatepending:
+            self.ioloop.add_callback(self._callFetchRates)
+    def updateStale(self, stream, pairs, period):
+        """Record the set of stale pairs of a websocket stream, and poll the
+stale pairs of all the streams of the service every period seconds
+using REST.  Polling stop when no stream has stale pairs.
+
+        """
+        before = set().union(*self.stalestreams.values())
+        if pairs:
+            self.stalestreams[stream] = set(pairs)
+        else:
+            self.stalestreams.pop(stream, None)
+        stale = set().union(*self.stalestreams.values())
+        if stale == before:
+            return
+        if stale:
+            self.updateStatus('stream', 'stale')
+            self.periodicUpdate(period, pairs=sorted(stale))
+            if stale - before:
+                self.requestUpdate()
+        else:
+            self.updateStatus('stream', 'live')
+            self.periodicUpdate(0)
+    def periodicUpdate(self, mindelay = 30, pairs = None): # 30 seconds
         """Start periodic calls to fetchRates(), with the minimum delay in
 seconds specified in as an argument.  The default update frequency is
-30 seconds.  To disable periodic updates, use mindelay=0.
+30 seconds.  To disable periodic updates, use mindelay=0.  If pairs is
+given, only update these pairs, otherwise update the default set of
+pairs for the service.
 
 
         """
@@ -239,11 +750,60 @@ seconds specified in as an argument.  The default update frequency is
         if self.periodic is not None:
             self.periodic.stop()
             self.periodic = None
+        self.periodicpairs = pairs
         if 0 != mindelay:
-            from functools import partial
-            self.periodic =  tornado.ioloop.PeriodicCallback(self._callFetchRates,
-                                                             mindelay * 1000)
-            self.periodic.start()
+            periodic = tornado.ioloop.PeriodicCallback(self._callFetchRates,
+                                                       mindelay * 1000)
+            self.periodic = periodic
+            def start():
+                # Unless replaced or stopped while waiting for the loop
+                if self.periodic is periodic:
+                    periodic.start()
+            self._inloop(start)
+    def start(self, period = 60):
+        """Start following the rates of the wanted pairs, using the websocket
+API if available and otherwise fetching the rates every period
+seconds.  The websocket client is available in the stream member.
+Return the service.
+
+        """
+        self.closed = False
+        self.stream = self.websocket()
+        if self.stream:
+            self.stream.connect()
+        else:
+            self.requestUpdate()
+            self.periodicUpdate(period)
+        return self
+    async def aclose(self):
+        """Stop all activity of the service.  Stop the periodic updates,
+close the websocket connections, cancel the requests in flight, notify
+the subscribers about batched updates and close the HTTP connections.
+Closing an already closed service does nothing.
+
+        """
+        self.closed = True
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.stalestreams = {}
+        self.periodicUpdate(0)
+        current = asyncio.current_task()
+        tasks = [t for t in set(self.tasks) | set(self.inflight.values())
+                 if t is not current and not t.done()]
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        while 0 < self.batchdepth:
+            self.endBatch()
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+    async def __aenter__(self):
+        return self.start()
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
 
     def updateRates(self, pair, ask, bid, when):
         now = time.time()
@@ -273,8 +833,7 @@ seconds specified in as an argument.  The default update frequency is
         else:
             self.rates[pair]['stored'] = now
             lastchange = self.rates[pair]['lastchange']
-        for s in self.subscribers:
-            s(self, pair, changed)
+        self._notify(pair, changed)
         if not pair in self.updates:
             self.updates[pair] = collections.deque(maxlen=10)
         if  lastchange and (0 == len(self.updates[pair]) or \
@@ -400,3 +959,191 @@ available.
 
         """
         return self.activetrader
+
+class TestServices(unittest.TestCase):
+    """
+Run simple self test of services using an explicitly given event loop.
+"""
+    def testAsyncioLoop(self):
+        from valutakrambod.service.dummyservice import DummyService
+        loop = asyncio.new_event_loop()
+        try:
+            s = DummyService(ioloop=loop)
+            self.assertIs(loop, s.ioloop.asyncio_loop)
+            self.assertIs(s.ioloop, tornadoloop(loop))
+            # Started in the given loop even if it is not running yet
+            s.periodicUpdate(0.01)
+            updates = []
+            s.subscribe(lambda service, pair, changed: updates.append(pair))
+            async def running():
+                return tornadoloop(loop)
+            self.assertIs(s.ioloop, loop.run_until_complete(running()))
+            loop.run_until_complete(asyncio.sleep(0.1))
+            s.periodicUpdate(0)
+            self.assertTrue(updates)
+        finally:
+            s.ioloop.close()
+        # A closed loop is forgotten
+        tornadoloop(asyncio.new_event_loop()).close()
+        self.assertNotIn(loop, _ioloops)
+    def testExistingIOLoop(self):
+        previous = asyncio.get_event_loop_policy().get_event_loop()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            # Created by tornado before tornadoloop() was asked
+            ioloop = tornado.ioloop.IOLoop.current()
+            self.assertIs(ioloop, tornadoloop(loop))
+            self.assertIs(ioloop, tornadoloop(loop))
+            self.assertIs(loop, asyncio.get_event_loop())
+        finally:
+            asyncio.set_event_loop(previous)
+            ioloop.close()
+    def testSingleflight(self):
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        calls = []
+        async def fetch():
+            calls.append(1)
+            await gen.sleep(0.01)
+            return len(calls)
+        async def run():
+            return await gen.multi([s._singleflight('k', fetch)
+                                    for i in range(3)])
+        self.assertEqual([1, 1, 1], s.ioloop.run_sync(run))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(2, s.metrics['singleflight.shared'])
+        self.assertEqual({}, s.inflight)
+        # A new call after the first one finished fetch again
+        self.assertEqual(2, s.ioloop.run_sync(
+            lambda: s._singleflight('k', fetch)))
+        # Cancelling one caller do not affect the others
+        async def cancel():
+            a = asyncio.ensure_future(s._singleflight('k', fetch))
+            b = asyncio.ensure_future(s._singleflight('k', fetch))
+            await gen.sleep(0)
+            a.cancel()
+            self.assertEqual(3, await b)
+            self.assertTrue(a.cancelled())
+            # The call is cancelled with the last caller
+            c = asyncio.ensure_future(s._singleflight('k', fetch))
+            await gen.sleep(0)
+            shared = s.inflight['k']
+            c.cancel()
+            await asyncio.gather(c, return_exceptions=True)
+            await gen.sleep(0)
+            self.assertTrue(shared.cancelled())
+        s.ioloop.run_sync(cancel)
+        self.assertEqual({}, s.inflight)
+        self.assertEqual({}, s.inflightwaiters)
+    def testHedgedFetch(self):
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        s.latencies.extend([0.01] * 20)
+        s.metrics['requests'] = 100
+        cancelled = []
+        sent = []
+        async def timedfetch(req):
+            n = s.metrics['hedge.sent']
+            sent.append(req)
+            try:
+                await gen.sleep(0.5 if 0 == n else 0.01)
+            except asyncio.CancelledError:
+                cancelled.append(n)
+                raise
+            req.streaming_callback(b'%d' % n)
+            return httpclient.HTTPResponse(req, 200, buffer=io.BytesIO())
+        s._timedfetch = timedfetch
+        req = httpclient.HTTPRequest('https://example.com/')
+        def hedgedfetch():
+            return s._hedgedfetch(req, s.ENDPOINT_PUBLIC)
+        start = time.monotonic()
+        # The first request is too slow, so the hedge win
+        response = s.ioloop.run_sync(hedgedfetch)
+        self.assertEqual(b'1', response.body)
+        self.assertIs(req, response.request)
+        # Sent after the 95 percentile latency, ie 0.01 seconds
+        self.assertTrue(0.02 <= time.monotonic() - start < 0.5)
+        self.assertEqual(1, s.metrics['hedge.sent'])
+        self.assertEqual(1, s.metrics['hedge.won'])
+        self.assertEqual([0], cancelled)
+        # The connection of the first request is closed when more
+        # data arrive
+        self.assertRaises(_HedgeAborted, sent[0].streaming_callback, b'x')
+        # Both requests are aborted if the caller is cancelled
+        async def cancel():
+            s.metrics['requests'] = 100
+            task = asyncio.ensure_future(hedgedfetch())
+            await gen.sleep(0.015)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await gen.sleep(0)
+        del sent[:], cancelled[:]
+        s.metrics['hedge.sent'] = 0
+        s.ioloop.run_sync(cancel)
+        self.assertEqual(2, len(sent))
+        self.assertEqual([0, 1], cancelled)
+        for r in sent:
+            self.assertRaises(_HedgeAborted, r.streaming_callback, b'x')
+        # Closing the service abort the requests in flight
+        async def close():
+            s.metrics['requests'] = 100
+            task = asyncio.ensure_future(hedgedfetch())
+            await gen.sleep(0.015)
+            self.assertEqual(2, len(s.tasks))
+            await s.aclose()
+            await asyncio.gather(task, return_exceptions=True)
+            return task
+        del sent[:], cancelled[:]
+        s.metrics['hedge.sent'] = 0
+        self.assertTrue(s.ioloop.run_sync(close).cancelled())
+        self.assertEqual([0, 1], sorted(cancelled))
+        self.assertEqual(set(), s.tasks)
+        for r in sent:
+            self.assertRaises(_HedgeAborted, r.streaming_callback, b'x')
+        # No hedge when the budget is used up
+        s.closed = False
+        s.metrics['hedge.sent'] = 1
+        s.metrics['requests'] = 10
+        self.assertEqual(b'1', s.ioloop.run_sync(hedgedfetch).body)
+        self.assertEqual(1, s.metrics['hedge.sent'])
+    def testDecompress(self):
+        import gzip
+        body = b'{"ask": 1.5, "bid": 1.4}' * 10
+        self.assertEqual(body, decompress(body, ''))
+        self.assertEqual(body, decompress(body, 'identity'))
+        self.assertEqual(body, decompress(gzip.compress(body), 'gzip'))
+        self.assertEqual(body, decompress(zlib.compress(body), 'Deflate'))
+        # Raw deflate data without the zlib header
+        c = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        raw = c.compress(body) + c.flush()
+        self.assertEqual(body, decompress(raw, 'deflate'))
+        if brotli is not None:
+            self.assertEqual(body, decompress(brotli.compress(body), 'br'))
+            self.assertIn('br', acceptencoding())
+        else:
+            self.assertRaises(ValueError, decompress, body, 'br')
+            self.assertNotIn('br', acceptencoding())
+        self.assertRaises(ValueError, decompress, body, 'compress')
+    def testThrottle(self):
+        import io
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        s.ratelimits = {s.ENDPOINT_PUBLIC : (20, 1)}
+        async def timedfetch(req):
+            return httpclient.HTTPResponse(req, 200, buffer=io.BytesIO(b'{}'))
+        s._timedfetch = timedfetch
+        url = 'https://throttle.example.com/'
+        async def run():
+            await s._get(url)
+            await s._get(url)
+            await s._post(url)
+        s.ioloop.run_sync(run)
+        # The second request waited for the first one, the private
+        # endpoint class is not limited
+        self.assertEqual(2, s.metrics['ratelimit.requests.public'])
+        self.assertTrue(0 < s.metrics['ratelimit.wait.public'] <= 0.05)
+        self.assertNotIn('ratelimit.requests.private', s.metrics)
+
+if __name__ == '__main__':
+    unittest.main()
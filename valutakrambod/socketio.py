@@ -2,28 +2,164 @@
 # Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
 # This file is covered by the GPLv2 or later, read COPYING for details.
 
-"""A bare minimum SocketIO client, based on reverse engineering the
-Paymium protocol and information found on
-https://socket.io/docs/server-api/ and
-https://github.com/socketio/engine.io-protocol
+"""A small SocketIO client, based on reverse engineering the Paymium
+protocol and information found on
+https://socket.io/docs/server-api/ ,
+https://github.com/socketio/engine.io-protocol and
+https://github.com/socketio/socket.io-protocol
+
+Only the websocket transport is supported.  Both Engine.IO protocol
+version 3, where the client send the pings, and version 4, where the
+server send them, are handled.  The version is taken from the EIO
+parameter in the URL, and default to 3.
 
 """
 
-from tornado import escape
-from tornado import gen
-from tornado import httpclient
-from tornado import httputil
-from tornado import ioloop
-from tornado import websocket
 
+import collections
 import time
+import unittest
+import urllib.parse
 import simplejson
 
+from decimal import Decimal
+
 import valutakrambod.websocket
 
+# Engine.IO packet types
+EIO_OPEN = '0'
+EIO_CLOSE = '1'
+EIO_PING = '2'
+EIO_PONG = '3'
+EIO_MESSAGE = '4'
+EIO_UPGRADE = '5'
+EIO_NOOP = '6'
+
+# Socket.IO packet types
+SIO_CONNECT = 0
+SIO_DISCONNECT = 1
+SIO_EVENT = 2
+SIO_ACK = 3
+SIO_ERROR = 4
+SIO_BINARY_EVENT = 5
+SIO_BINARY_ACK = 6
+
+# Separator between the packets in an Engine.IO version 4 payload
+RECORD_SEPARATOR = '\x1e'
+
+Packet = collections.namedtuple('Packet',
+                                ['type', 'namespace', 'id', 'data',
+                                 'attachments'])
+
+def encodepacket(type, namespace = '/', data = None, id = None,
+                 attachments = 0):
+    """Return the string form of a Socket.IO packet, without the Engine.IO
+message type prefix.
+
+    """
+    s = str(type)
+    if attachments:
+        s += "%d-" % attachments
+    if namespace and '/' != namespace:
+        s += namespace + ','
+    if id is not None:
+        s += str(id)
+    if data is not None:
+        s += simplejson.dumps(data, separators=(',', ':'))
+    return s
+
+def decodepacket(s, usedecimal = True):
+    """Parse the string form of a Socket.IO packet, without the Engine.IO
+message type prefix, and return a Packet.  Numbers with decimals in
+the data are returned as Decimal objects if usedecimal is True, and as
+float otherwise.
+
+    """
+    type = int(s[0])
+    i = 1
+    l = len(s)
+    attachments = 0
+    if type in (SIO_BINARY_EVENT, SIO_BINARY_ACK):
+        dash = s.index('-', i)
+        attachments = int(s[i:dash])
+        i = dash + 1
+    namespace = '/'
+    if i < l and '/' == s[i]:
+        comma = s.find(',', i)
+        if -1 == comma:
+            comma = l
+        namespace = s[i:comma]
+        i = comma + 1
+    start = i
+    while i < l and s[i].isdigit():
+        i += 1
+    id = None
+    if start < i:
+        id = int(s[start:i])
+    data = None
+    if i < l:
+        data = simplejson.loads(s[i:], use_decimal=usedecimal)
+    return Packet(type, namespace, id, data, attachments)
+
+def encodepayload(packets):
+    """Return the Engine.IO version 4 payload with the given packets."""
+    return RECORD_SEPARATOR.join(packets)
+
+def decodepayload(payload):
+    """Split an Engine.IO payload into its packets.  Both the version 4
+form using record separators and the version 3 form with the length
+of each packet before a colon are understood.
+
+    """
+    if RECORD_SEPARATOR in payload:
+        return payload.split(RECORD_SEPARATOR)
+    packets = []
+    i = 0
+    while i < len(payload):
+        colon = payload.index(':', i)
+        length = int(payload[i:colon])
+        packets.append(payload[colon + 1:colon + 1 + length])
+        i = colon + 1 + length
+    return packets
+
+def replaceplaceholders(data, buffers):
+    """Return data with the binary attachment placeholders replaced by the
+attachments in buffers.
+
+    """
+    if isinstance(data, list):
+        return [replaceplaceholders(d, buffers) for d in data]
+    if isinstance(data, dict):
+        if data.get('_placeholder') and 'num' in data:
+            return buffers[data['num']]
+        return {k : replaceplaceholders(v, buffers) for k, v in data.items()}
+    return data
+
+def extractbinary(data, buffers):
+    """Return data with all bytes objects replaced by placeholders, and
+append the bytes objects to buffers.
+
+    """
+    if isinstance(data, (bytes, bytearray)):
+        buffers.append(data)
+        return {'_placeholder': True, 'num': len(buffers) - 1}
+    if isinstance(data, (list, tuple)):
+        return [extractbinary(d, buffers) for d in data]
+    if isinstance(data, dict):
+        return {k : extractbinary(v, buffers) for k, v in data.items()}
+    return data
+
 class SocketIOClient(valutakrambod.websocket.WebSocketClient):
-    """Base for SocketIO websocket socket clients.
+    """Base for SocketIO websocket socket clients.  Subclasses connect to
+namespaces using subscribe(), send events using emit() and receive
+events in _on_event().
+
+If no ping or pong is received within the ping interval and timeout
+given by the server, the connection is closed and a new one set up.
+
     """
+    # Engine.IO packets are not plain JSON documents
+    offload = False
     def __init__(self, service, *,
                  connect_timeout=valutakrambod.websocket.DEFAULT_CONNECT_TIMEOUT,
                  request_timeout=valutakrambod.websocket.DEFAULT_REQUEST_TIMEOUT):
@@ -32,58 +168,247 @@ class SocketIOClient(valutakrambod.websocket.WebSocketClient):
                          connect_timeout=connect_timeout,
                          request_timeout=request_timeout,
         )
+        self.eio = 3
         self.pinginterval = 0
-    def subscribe(self, channel):
-        self.send("40%s" % channel)
-    def _ping(self, first=False):
-        if 0 == self.pinginterval:
+        self.pingtimeout = 0
+        self.lastping = 0
+        self.namespaces = set()
+        self._ping_ref = None
+        self._acks = {}
+        self._lastackid = 0
+        self._binary = None
+        self._buffers = []
+    def connect(self, url = None):
+        if url is None:
+            url = self.url
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        self.eio = int(query.get('EIO', ['3'])[0])
+        super().connect(url)
+    def subscribe(self, namespace):
+        """Connect to the given namespace."""
+        self._sendpacket(SIO_CONNECT, namespace)
+    def emit(self, event, *args, namespace = '/', callback = None):
+        """Send an event to the server.  If callback is given, ask the server
+to acknowledge the event, and call callback with the arguments of the
+acknowledgement.
+
+        """
+        id = None
+        if callback is not None:
+            self._lastackid += 1
+            id = self._lastackid
+            self._acks[(namespace, id)] = callback
+        self._sendpacket(SIO_EVENT, namespace, [event] + list(args), id)
+    def _sendpacket(self, type, namespace = '/', data = None, id = None):
+        buffers = []
+        if data is not None:
+            data = extractbinary(data, buffers)
+        if buffers:
+            type = {
+                SIO_EVENT : SIO_BINARY_EVENT,
+                SIO_ACK : SIO_BINARY_ACK,
+            }[type]
+        self.send(EIO_MESSAGE + encodepacket(type, namespace, data, id,
+                                             len(buffers)))
+        for b in buffers:
+            if 3 == self.eio:
+                b = b'\x04' + b
+            self._ws_connection.write_message(b, binary=True)
+    def _ping(self):
+        """Send a ping if the client is supposed to do it, and check that the
+server is still there.
+
+        """
+        self._ping_ref = None
+        if 0 == self.pinginterval or self._ws_connection is None:
             return
-        if not first:
-            self.send("2probe")
+        now = time.time()
+        if now - self.lastping > self.pinginterval + self.pingtimeout:
+            self.service.logerror("ping timeout for %s, reconnecting" %
+                                  self.service.servicename())
+            # Trigger the reconnect done when the server close the
+            # connection.
+            self._ws_connection.close()
+            return
+        if 3 == self.eio:
+            self.send(EIO_PING)
         # schedule next ping
-        loop = ioloop.IOLoop.current()
+        loop = self.service.ioloop
         self._ping_ref = loop.call_later(self.pinginterval, self._ping)
-    
+    def _on_disconnect(self):
+        if self._ping_ref is not None:
+            self.service.ioloop.remove_timeout(self._ping_ref)
+            self._ping_ref = None
+        self.namespaces = set()
+        self._acks = {}
+        self._binary = None
+        self._buffers = []
+
     def _on_message(self, msg):
         if self.trace:
             print("received '%s'" % msg)
         if msg is None:
             return
-
+        if isinstance(msg, bytes):
+            self._on_binary(msg)
+            return
+        if RECORD_SEPARATOR in msg:
+            for packet in decodepayload(msg):
+                self._on_enginepacket(packet)
+        else:
+            self._on_enginepacket(msg)
+    def _on_enginepacket(self, msg):
         type = msg[0]
-        if "0" == type:
+        if EIO_MESSAGE == type:
+            self._on_packet(decodepacket(msg[1:], self.usedecimal))
+        elif EIO_PING == type:
+            self.lastping = time.time()
+            self.send(EIO_PONG + msg[1:])
+        elif EIO_PONG == type:
+            self.lastping = time.time()
+        elif EIO_OPEN == type:
             j = simplejson.loads(msg[1:])
             if self.trace:
                 print(j)
             self.pinginterval = j['pingInterval'] / 1000
-            self._ping(first=True)
-            return
-        elif "2" == type: # ping
-            self.send("3" + msg[1:])
+            self.pingtimeout = j['pingTimeout'] / 1000
+            self.heartbeatinterval = self.pinginterval
+            self.lastping = time.time()
+            if self._ping_ref is None:
+                loop = self.service.ioloop
+                self._ping_ref = loop.call_later(self.pinginterval, self._ping)
+        elif EIO_CLOSE == type:
+            if self._ws_connection is not None:
+                self._ws_connection.close()
+        elif type in (EIO_UPGRADE, EIO_NOOP):
+            pass
+        else:
+            self.service.logerror("received unhandled SocketIO type %s" % type)
+    def _on_binary(self, data):
+        if self._binary is None:
+            self.service.logerror("received unexpected SocketIO binary attachment")
             return
-        elif "3" == type: # pong, reply to pin
+        if 3 == self.eio and data[:1] == b'\x04':
+            data = data[1:]
+        self._buffers.append(data)
+        if len(self._buffers) == self._binary.attachments:
+            packet = self._binary._replace(
+                data=replaceplaceholders(self._binary.data, self._buffers))
+            self._binary = None
+            self._buffers = []
+            self._dispatch(packet)
+    def _on_packet(self, packet):
+        if packet.attachments:
+            # Wait for the attachments
+            self._binary = packet
+            self._buffers = []
             return
-        elif "4" == type:
-            dtype = msg[1]
-            if '0' == dtype: # FIXME what is this?  subscribe confirm?
-                pass
-            elif '2' == dtype:
-                channel, data = msg[2:].split(',', 1)
-                if self.trace:
-                    print("channel '%s' data '%s'" % (channel, data))
-                events = simplejson.loads(data, use_decimal=True)
-                self._on_event(channel, events)
-            else:
-                self.service.logerror("received unhandled SocketIO data type %s" % dtype)
-                    
+        self._dispatch(packet)
+    def _dispatch(self, packet):
+        if SIO_CONNECT == packet.type:
+            self.namespaces.add(packet.namespace)
+        elif SIO_DISCONNECT == packet.type:
+            self.namespaces.discard(packet.namespace)
+        elif packet.type in (SIO_EVENT, SIO_BINARY_EVENT):
+            if self.trace:
+                print("channel '%s' data '%s'" % (packet.namespace, packet.data))
+            res = self._on_event(packet.namespace, packet.data)
+            if packet.id is not None:
+                if res is None:
+                    res = []
+                self._sendpacket(SIO_ACK, packet.namespace, list(res),
+                                 packet.id)
+        elif packet.type in (SIO_ACK, SIO_BINARY_ACK):
+            callback = self._acks.pop((packet.namespace, packet.id), None)
+            if callback is not None:
+                callback(*(packet.data or []))
+        elif SIO_ERROR == packet.type:
+            self.service.logerror("SocketIO error for %s namespace %s: %s" % (
+                self.service.servicename(), packet.namespace, packet.data))
         else:
-            self.service.logerror("received unhandled SocketIO type %s" % type)
+            self.service.logerror("received unhandled SocketIO data type %s" %
+                                  packet.type)
     def _on_event(self, channel, events):
         """This is called when a set of new events is available from the server.
-        :param str channel: the channel for the event
-        :param list events: the set of events received
+        :param str channel: the namespace of the event
+        :param list events: the event name followed by the event arguments
+        If the server asked for an acknowledgement, the returned list is
+        passed back as its arguments.
         """
 
         if self.trace:
             print("_on_events('%s', '%s')" % (channel, events))
         pass
+
+class TestSocketIO(unittest.TestCase):
+    """
+Run simple self test of the SocketIO codec.
+"""
+    def testPacket(self):
+        for s, p in (
+                ('0', Packet(SIO_CONNECT, '/', None, None, 0)),
+                ('0/public,', Packet(SIO_CONNECT, '/public', None, None, 0)),
+                ('2/public,["stream",{"a":1.5}]',
+                 Packet(SIO_EVENT, '/public', None, ['stream', {'a': 1.5}], 0)),
+                ('212["x"]', Packet(SIO_EVENT, '/', 12, ['x'], 0)),
+                ('51-/a,3["b",{"_placeholder":true,"num":0}]',
+                 Packet(SIO_BINARY_EVENT, '/a', 3,
+                        ['b', {'_placeholder': True, 'num': 0}], 1)),
+        ):
+            self.assertEqual(p, decodepacket(s))
+            self.assertEqual(s, encodepacket(p.type, p.namespace, p.data,
+                                             p.id, p.attachments))
+        data = decodepacket('2["a",1.5]').data
+        self.assertIsInstance(data[1], Decimal)
+        data = decodepacket('2["a",1.5]', usedecimal=False).data
+        self.assertIsInstance(data[1], float)
+    def testPayload(self):
+        self.assertEqual(['42["a"]', '3'], decodepayload('42["a"]\x1e3'))
+        self.assertEqual(['42["a"]', '3'], decodepayload('7:42["a"]1:3'))
+        self.assertEqual('42["a"]\x1e3', encodepayload(['42["a"]', '3']))
+    def testBinary(self):
+        buffers = []
+        data = extractbinary(['b', {'x': b'123'}], buffers)
+        self.assertEqual([b'123'], buffers)
+        self.assertEqual(['b', {'x': b'123'}], replaceplaceholders(data, buffers))
+
+    def testClient(self):
+        from valutakrambod.service.dummyservice import DummyService
+        class Client(SocketIOClient):
+            def _on_event(self, channel, events):
+                received.append((channel, events))
+                return ['ok']
+        received = []
+        acks = []
+        sent = []
+        c = Client(DummyService())
+        c.send = sent.append
+        c._on_message('0{"sid":"x","pingInterval":25000,"pingTimeout":5000}')
+        self.assertEqual(25, c.heartbeatinterval)
+        c._on_message('40/public,')
+        self.assertEqual(set(['/public']), c.namespaces)
+        # Batched payload, second event asking for an acknowledgement
+        c._on_message('42/public,["a",1]\x1e42/public,7["b"]')
+        self.assertEqual([('/public', ['a', 1]), ('/public', ['b'])], received)
+        self.assertEqual(['43/public,7["ok"]'], sent)
+        c.emit('c', namespace='/public', callback=lambda *args: acks.append(args))
+        self.assertEqual('42/public,1["c"]', sent[-1])
+        c._on_message('43/public,1[2]')
+        self.assertEqual([(2,)], acks)
+        received.clear()
+        c._on_message('451-["d",{"_placeholder":true,"num":0}]')
+        self.assertEqual([], received)
+        c._on_message(b'\x04xyz')
+        self.assertEqual([('/', ['d', b'xyz'])], received)
+        c._on_message('2')
+        self.assertEqual('3', sent[-1])
+        # Numbers are parsed as requested by the client
+        received.clear()
+        c._on_message('42["e",0.1]')
+        c.usedecimal = True
+        c._on_message('42["e",0.1]')
+        self.assertEqual([('/', ['e', 0.1]), ('/', ['e', Decimal('0.1')])],
+                         received)
+
+if __name__ == '__main__':
+    unittest.main()
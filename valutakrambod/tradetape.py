@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 Petter Reinholdtsen <pere@hungry.com>
+# This file is covered by the GPLv2 or later, read COPYING for details.
+
+"""Keep the most recent executed trades of a market in a fixed size
+ring buffer, and answer questions about the trades within a time
+window, like the volume weighted average price (VWAP).
+
+"""
+
+import collections
+import unittest
+
+from decimal import Decimal
+
+BUY = "buy"
+SELL = "sell"
+
+Trade = collections.namedtuple('Trade', ['when', 'price', 'volume', 'side'])
+
+class TradeTape(object):
+    """The last maxlen trades, ordered on time.  When full, the oldest
+trade is dropped for every new trade added.  Trades arriving late are
+inserted at their place in time.
+
+    """
+    def __init__(self, maxlen=10000):
+        if maxlen < 1:
+            raise ValueError('maxlen must be at least 1')
+        self.maxlen = maxlen
+        self._buf = [None] * maxlen
+        self._start = 0
+        self._len = 0
+    def __len__(self):
+        return self._len
+    def _get(self, i):
+        return self._buf[(self._start + i) % self.maxlen]
+    def _set(self, i, trade):
+        self._buf[(self._start + i) % self.maxlen] = trade
+    def __iter__(self):
+        for i in range(self._len):
+            yield self._get(i)
+    def append(self, trade):
+        """Add trade to the tape.  A trade older than the most recent trade
+is inserted after the trades done at or before the same time.  Return
+False if the trade was dropped because the tape is full and the trade
+is older than all the trades on it.
+
+        """
+        last = self.last()
+        if last is not None and trade.when < last.when:
+            return self._insert(trade)
+        if self._len < self.maxlen:
+            self._set(self._len, trade)
+            self._len += 1
+        else:
+            self._buf[self._start] = trade
+            self._start = (self._start + 1) % self.maxlen
+        return True
+    def _insert(self, trade):
+        if self._len == self.maxlen and trade.when < self._get(0).when:
+            return False
+        pos = self._bisect(trade.when, after=True)
+        if self._len == self.maxlen:
+            # Drop the oldest trade
+            self._start = (self._start + 1) % self.maxlen
+            self._len -= 1
+            pos -= 1
+        for i in range(self._len, pos, -1):
+            self._set(i, self._get(i - 1))
+        self._set(pos, trade)
+        self._len += 1
+        return True
+    def extend(self, trades):
+        for trade in trades:
+            self.append(trade)
+    def last(self):
+        """Return the most recent trade, or None if the tape is empty."""
+        if 0 == self._len:
+            return None
+        return self._get(self._len - 1)
+    def _bisect(self, when, after=False):
+        """Return the index of the first trade at or after when, or the first
+trade after when if after is True.
+
+        """
+        lo = 0
+        hi = self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = self._get(mid).when
+            if t < when or (after and t == when):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    def window(self, since=None, until=None):
+        """Return the list of trades done at or after since and before until.
+Both limits are seconds since epoch, and None mean no limit.
+
+        """
+        first = 0 if since is None else self._bisect(since)
+        end = self._len if until is None else self._bisect(until)
+        return [self._get(i) for i in range(first, end)]
+    def volume(self, since=None, until=None):
+        return sum((t.volume for t in self.window(since, until)), Decimal(0))
+    def vwap(self, since=None, until=None):
+        """Return the volume weighted average price of the trades in the
+given time window, or None if no volume was traded.
+
+        """
+        value = Decimal(0)
+        volume = Decimal(0)
+        for t in self.window(since, until):
+            value += t.price * t.volume
+            volume += t.volume
+        if 0 == volume:
+            return None
+        return value / volume
+
+class TestTradeTape(unittest.TestCase):
+    """
+Run simple self test of the trade tape.
+"""
+    def testRing(self):
+        tape = TradeTape(maxlen=3)
+        self.assertEqual(None, tape.last())
+        for i in range(5):
+            tape.append(Trade(i, Decimal(100 + i), Decimal(1), BUY))
+        self.assertEqual(3, len(tape))
+        self.assertEqual([2, 3, 4], [t.when for t in tape])
+        self.assertEqual(4, tape.last().when)
+    def testWindow(self):
+        tape = TradeTape(maxlen=4)
+        for i in range(6):
+            tape.append(Trade(10 * i, Decimal(100 + i), Decimal(i), SELL))
+        self.assertEqual([30, 40], [t.when for t in tape.window(25, 50)])
+        self.assertEqual([20, 30, 40, 50], [t.when for t in tape.window()])
+        self.assertEqual(Decimal(9), tape.volume(since=40))
+        # (104 * 4 + 105 * 5) / 9
+        self.assertEqual(Decimal(941) / Decimal(9), tape.vwap(since=40))
+        self.assertEqual(None, tape.vwap(since=60))
+    def testLate(self):
+        self.assertRaises(ValueError, TradeTape, 0)
+        tape = TradeTape(maxlen=4)
+        for when in (10, 30, 40):
+            tape.append(Trade(when, Decimal(100), Decimal(1), BUY))
+        # Inserted at its place in time, after trades done at the same time
+        self.assertTrue(tape.append(Trade(30, Decimal(101), Decimal(1), SELL)))
+        self.assertEqual([10, 30, 30, 40], [t.when for t in tape])
+        self.assertEqual(SELL, tape.window(30, 31)[1].side)
+        # When full, the oldest trade is dropped
+        self.assertTrue(tape.append(Trade(20, Decimal(100), Decimal(1), BUY)))
+        self.assertEqual([20, 30, 30, 40], [t.when for t in tape])
+        self.assertEqual(40, tape.last().when)
+        # Older than every trade on the full tape
+        self.assertFalse(tape.append(Trade(5, Decimal(100), Decimal(1), BUY)))
+        self.assertEqual([20, 30, 30, 40], [t.when for t in tape])
+        self.assertEqual([30, 30], [t.when for t in tape.window(25, 35)])
+
+if __name__ == '__main__':
+    unittest.main()
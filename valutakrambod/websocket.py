@@ -6,36 +6,191 @@ from tornado import escape
 from tornado import gen
 from tornado import httpclient
 from tornado import httputil
+from tornado import ioloop
 from tornado import websocket
 
+import collections
 import json
+import math
 import time
+import unittest
+
+from valutakrambod import recorder
+from valutakrambod import resilience
+from valutakrambod.services import jsondecode
 
 APPLICATION_JSON = 'application/json'
 
 DEFAULT_CONNECT_TIMEOUT = 60
 DEFAULT_REQUEST_TIMEOUT = 60
 
- 
+# A message already decoded in the parser executor of the service.
+Parsed = collections.namedtuple('Parsed', ['data'])
+
+
+class ConnectionSupervisor(object):
+    """Keep a websocket client connected.  When the connection is lost
+or can not be established, a new connection attempt is scheduled after
+a jittered exponential backoff delay.  The subscriptions are set up
+again by the _on_connection_success() method of the client when the
+new connection is established.
+
+The number of reconnects and the total time spent disconnected are
+available in the reconnects member and the downtime() method.
+
+    """
+    def __init__(self, client, backoff=1, maxbackoff=60):
+        self.client = client
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.attempt = 0
+        self.reconnects = 0
+        self.stopped = False
+        self.connectedsince = None
+        self.downsince = None
+        self.totaldowntime = 0
+        self._timeout = None
+    def start(self):
+        self.stopped = False
+    def stop(self):
+        """Stop reconnecting, used when the client is closed on purpose."""
+        self.stopped = True
+        if self._timeout is not None:
+            self.client.service.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+    def connected(self):
+        now = time.time()
+        if self.downsince is not None:
+            self.totaldowntime += now - self.downsince
+            self.downsince = None
+        self.connectedsince = now
+        self.client.service.updateStatus('websocket', 'connected')
+    def disconnected(self):
+        now = time.time()
+        # Only start from the shortest delay again if the connection
+        # stayed up for a while, to avoid hammering a service
+        # accepting and dropping connections.
+        if self.connectedsince is not None and \
+           now - self.connectedsince > self.maxbackoff:
+            self.attempt = 0
+        self.connectedsince = None
+        if self.downsince is None:
+            self.downsince = now
+        self.client.service.updateStatus('websocket', 'disconnected')
+        if self.stopped or self._timeout is not None:
+            return
+        delay = resilience.backoff(self.attempt, self.backoff, self.maxbackoff)
+        self.attempt += 1
+        self._timeout = self.client.service.ioloop.call_later(delay,
+                                                              self._reconnect)
+    def _reconnect(self):
+        self._timeout = None
+        if self.stopped:
+            return
+        self.reconnects += 1
+        self.client.service.addmetric('websocket.reconnects')
+        self.client.connect()
+    def downtime(self):
+        """Return the total number of seconds spent disconnected."""
+        if self.downsince is None:
+            return self.totaldowntime
+        return self.totaldowntime + time.time() - self.downsince
+
 class WebSocketClient(object):
     """Base for web socket clients.
+
+    A watchdog keep an eye on the stream.  If nothing is received for
+    staletimeout seconds, or five heartbeat intervals if the service
+    send heartbeats, the connection is considered dead and a new one
+    is set up.  If a pair is not updated for staletimeout seconds or
+    four times its usual update period, the service poll it using
+    REST every fallbackperiod seconds until the stream recover.
+
+    If batch is True, received messages are queued and handled
+    together when all the messages already received have been
+    queued, or after batchwindow seconds.  The subscribers are then
+    notified once per updated pair.
+
+    The compression member is passed as compression_options to
+    tornado, and a dictionary (empty for the default settings)
+    negotiate permessage-deflate compression with the server.  Set it
+    to None to disable compression.  Messages larger than
+    maxmessagesize bytes close the connection.
+
+    Subclasses handle the decoded JSON messages in _on_data().  If
+    the service has a jsonparser executor, messages larger than its
+    jsonparsethreshold are decoded in the executor.  The messages are
+    still handled in the order they were received, with smaller
+    messages waiting for larger ones received earlier.
     """
- 
-    def __init__(self, service, *,
+
+    staletimeout = 60
+    heartbeatinterval = None
+    fallbackperiod = 30
+    watchdoginterval = 5
+    batch = False
+    batchwindow = 0
+    compression = {}
+    maxmessagesize = 10 * 1024 * 1024
+    # The maximum number of pairs to follow per connection, used by
+    # shard().  None mean no limit.
+    maxpairs = None
+    # Parse numbers with decimals in the messages as Decimal.
+    usedecimal = False
+    # Parse large messages using the jsonparser executor of the
+    # service.  Set to False for clients not receiving plain JSON
+    # documents.
+    offload = True
+    def __init__(self, service, *, pairs=None,
                  connect_timeout=DEFAULT_CONNECT_TIMEOUT,
                  request_timeout=DEFAULT_REQUEST_TIMEOUT):
 
         self.service = service
+        self.pairs = pairs
+        # The index of the client in a WebSocketClientGroup
+        self.shard = None
         self.connect_timeout = connect_timeout
         self.request_timeout = request_timeout
         self.trace = False
+        self.url = None
         self._ws_connection = None
+        self.supervisor = ConnectionSupervisor(self)
+        self.lastmessage = time.time()
+        self.lastpairupdate = {}
+        self.stalepairs = set()
+        self._inmessage = False
+        self._watchdog = None
+        self._pending = []
+        self._parsing = collections.deque()
+        self._drainref = None
+        self._bytecounts = (0, 0)
+        self._messagebytes = 0
+        self.pairupdates = collections.Counter()
+        self.pairupdatessince = time.time()
+        service.subscribe(self._on_update)
 
-    def connect(self, url):
-        """Connect to the server.
-        :param str url: server URL.
+    def connect(self, url = None):
+        """Connect to the server, and keep reconnecting if the connection
+        is lost until close() is called.  The connection is set up in
+        the IO loop of the service.
+        :param str url: server URL, default to the url member.
         """
 
+        if url is None:
+            url = self.url
+        self.url = url
+        self.supervisor.start()
+        if self._on_update not in self.service.subscribers:
+            # Unsubscribed by close()
+            self.service.subscribe(self._on_update)
+        self.service._inloop(self._connect)
+
+    def _connect(self):
+        if self.supervisor.stopped:
+            # Closed before the IO loop got around to connect
+            return
+        url = self.url
+        self._startwatchdog()
         if self.trace:
             print("Connecting to %s" % url)
 
@@ -46,7 +201,9 @@ class WebSocketClient(object):
                                          headers=headers)
         ws_conn = websocket.websocket_connect(request,
                                               callback=self._connect_callback,
-                                              on_message_callback=self._read_message)
+                                              on_message_callback=self._read_message,
+                                              compression_options=self.compression,
+                                              max_message_size=self.maxmessagesize)
 
     def send(self, data):
         """Send message to the server
@@ -63,46 +220,280 @@ class WebSocketClient(object):
             print("Wrote '%s'" % data)
 
     def close(self):
-        """Close connection.
+        """Close connection and stop reconnecting.  Messages waiting to
+        be handled as a batch are handled first.  Closing an already
+        closed connection does nothing.
         """
 
+        self.supervisor.stop()
+        self._stopwatchdog()
+        self.service.unsubscribe(self._on_update)
+        self._parsing.clear()
+        if self._drainref is not None:
+            self.service.ioloop.remove_timeout(self._drainref)
+            self._drain()
         if not self._ws_connection:
-            raise RuntimeError('Web socket connection is already closed.')
+            return
 
+        self._syncbytecounters()
         self._ws_connection.close()
         self._ws_connection = None
+        self._on_disconnect()
 
-    async def _connect_callback(self, future):
+    def _connect_callback(self, future):
+        if self.supervisor.stopped:
+            # Closed while connecting
+            if future.exception() is None:
+                future.result().close()
+            return
         if future.exception() is None:
             self._ws_connection = future.result()
+            self._bytecounts = (0, 0)
+            self._messagebytes = 0
+            self.lastmessage = time.time()
+            self.supervisor.connected()
             self._on_connection_success()
-            await self._read_messages()
         else:
             self._on_connection_error(future.exception())
+            self.supervisor.disconnected()
 
     def _read_message(self, msg):
+        self.lastmessage = time.time()
         if msg is None:
-            self.service.logerror("received empty websocket message from %s, reconnecting" %
-                                  self.service.servicename())
-            self.close()
-            self.connect()
+            if self._ws_connection is None:
+                # Closed on purpose by close()
+                return
+            self._syncbytecounters()
+            self._ws_connection = None
+            self._parsing.clear()
+            self._on_connection_close()
+            self._on_disconnect()
+            self.supervisor.disconnected()
+            return
+        if isinstance(msg, bytes) or msg.isascii():
+            self._messagebytes += len(msg)
+        else:
+            self._messagebytes += len(msg.encode('UTF-8'))
+        if self.service.recorder is not None:
+            url = self.url or ''
+            if self.shard is not None:
+                url = '%s#%d' % (url, self.shard)
+            self.service.recorder.record(recorder.WEBSOCKET,
+                                         self.service.servicename(), msg,
+                                         url=url)
+        if self.offload:
+            future = self.service._jsonoffload(msg, self.usedecimal)
+            if future is not None or self._parsing:
+                self._parsing.append((msg, future))
+                if future is not None:
+                    future.add_done_callback(self._on_parsed)
+                return
+        self._receive(msg)
+
+    def _on_parsed(self, future = None):
+        """Handle the messages at the head of the parse queue, until a
+        message still being parsed is found.
+        """
+        while self._parsing:
+            msg, future = self._parsing[0]
+            if future is not None and not future.done():
+                return
+            self._parsing.popleft()
+            if future is None:
+                self._receive(msg)
+            elif future.exception() is not None:
+                self.service.logerror("bad msg from %s: %s" % (
+                    self.service.servicename(), str(future.exception())
+                ))
+            else:
+                self._receive(Parsed(future.result()))
+
+    def _receive(self, msg):
+        if self.batch:
+            self._pending.append(msg)
+            if self._drainref is None:
+                self._drainref = self.service.ioloop.call_later(
+                    self.batchwindow, self._drain)
             return
+        self._inmessage = True
+        try:
+            self._handle_message(msg)
+        finally:
+            self._inmessage = False
+
+    def _handle_message(self, msg):
         try:
-            self._on_message(msg)
+            if isinstance(msg, Parsed):
+                self._on_data(msg.data)
+            else:
+                self._on_message(msg)
         except Exception as exception:
             self.service.logerror("bad msg from %s: %s" % (
                 self.service.servicename(), str(exception)
             ))
 
-    async def _read_messages(self):
-        while self._ws_connection:
-            self._read_message(await self._ws_connection.read_message())
+    def _drain(self):
+        """Handle all queued messages as one batch."""
+        self._drainref = None
+        pending = self._pending
+        self._pending = []
+        self.service.addmetric('websocket.batches')
+        self.service.addmetric('websocket.batchedmessages', len(pending))
+        self._inmessage = True
+        self.service.beginBatch()
+        try:
+            for msg in pending:
+                self._handle_message(msg)
+        finally:
+            self.service.endBatch()
+            self._inmessage = False
+
+    def bytecounters(self):
+        """Return the number of bytes received on the wire and the number of
+        bytes after decompression on the current connection.  The
+        decompressed size is the UTF-8 encoded size of the received
+        messages, counted by the client.  Tornado has no public
+        counter for the bytes on the wire, so the wire size is taken
+        from a private counter of the tornado websocket protocol, and
+        is None if a tornado version without it is used.
+        """
+        protocol = getattr(self._ws_connection, 'protocol', None)
+        return (getattr(protocol, '_wire_bytes_in', None), self._messagebytes)
+
+    def _syncbytecounters(self):
+        """Add the bytes received since the last call to the service
+        metrics.
+        """
+        wire, decompressed = self.bytecounters()
+        lastwire, lastdecompressed = self._bytecounts
+        if wire is not None:
+            self.service.addmetric('websocket.bytes.wire', wire - lastwire)
+        self.service.addmetric('websocket.bytes.decompressed',
+                               decompressed - lastdecompressed)
+        self._bytecounts = (wire or 0, decompressed)
+
+    def streampairs(self):
+        """Return the pairs expected to be updated by the stream, ie the
+        pairs given to the constructor or the wanted pairs of the service.
+        """
+        if self.pairs is not None:
+            return self.pairs
+        return self.service.wantedpairs or []
+
+    def setpairs(self, pairs):
+        """Change the pairs followed by the stream.  The default
+        implementation set up a new connection to subscribe to the new
+        set of pairs.
+        """
+        self.pairs = list(pairs)
+        now = time.time()
+        for pair in self.pairs:
+            self.lastpairupdate.setdefault(pair, now)
+        if self._ws_connection is not None:
+            # Trigger the reconnect done when the server close the
+            # connection.
+            self._ws_connection.close()
+
+    def _on_update(self, service, pair, changed):
+        # Only count updates caused by the stream, not by REST polling
+        if self._inmessage:
+            self.markalive(pair)
+            self.pairupdates[pair] += 1
+
+    def markalive(self, pair):
+        """Tell the watchdog the stream is alive for pair, for example when
+        a message arrived for the pair without changing anything.  Ignored
+        when not called while handling a message from the stream.
+        """
+        if self._inmessage:
+            self.lastpairupdate[pair] = time.time()
+
+    def pairrates(self):
+        """Return a dictionary with the number of updates per second for
+        each pair followed by the stream, since the last call to
+        resetpairrates().
+        """
+        duration = max(time.time() - self.pairupdatessince, 1)
+        return { pair : self.pairupdates[pair] / duration
+                 for pair in self.streampairs() }
+
+    def resetpairrates(self):
+        self.pairupdates = collections.Counter()
+        self.pairupdatessince = time.time()
+
+    def _startwatchdog(self):
+        if self._watchdog is None:
+            now = time.time()
+            self.lastmessage = now
+            for pair in self.streampairs():
+                self.lastpairupdate.setdefault(pair, now)
+            self._watchdog = ioloop.PeriodicCallback(self._checkstale,
+                                                     self.watchdoginterval * 1000)
+            self._watchdog.start()
+
+    def _stopwatchdog(self):
+        if self._watchdog is not None:
+            self._watchdog.stop()
+            self._watchdog = None
+
+    def connectiontimeout(self):
+        if self.heartbeatinterval:
+            return 5 * self.heartbeatinterval
+        return self.staletimeout
+
+    def pairtimeout(self, pair):
+        period = self.service.guessperiod(pair)
+        if math.isnan(period):
+            return self.staletimeout
+        return max(self.staletimeout, 4 * period)
+
+    def _checkstale(self):
+        self._syncbytecounters()
+        now = time.time()
+        if now - self.lastmessage > self.connectiontimeout():
+            stale = set(self.streampairs())
+            if self._ws_connection is not None:
+                self.service.logerror("nothing received from %s in %d seconds, reconnecting" %
+                                      (self.service.servicename(),
+                                       now - self.lastmessage))
+                self.lastmessage = now
+                # Trigger the reconnect done when the server close
+                # the connection.
+                self._ws_connection.close()
+        else:
+            stale = set()
+            for pair in self.streampairs():
+                if now - self.lastpairupdate.get(pair, now) > self.pairtimeout(pair):
+                    stale.add(pair)
+        self._setstale(stale)
+
+    def _setstale(self, stale):
+        """Poll the stale pairs using REST, and stop polling when no pair is
+        stale any more.
+        """
+        if stale == self.stalepairs:
+            return
+        self.stalepairs = stale
+        if stale:
+            self.service.logerror("%s stream stale, polling %s" % (
+                self.service.servicename(),
+                ", ".join(["%s-%s" % p for p in sorted(stale)])))
+        else:
+            self.service.logerror("%s stream live again, stopped polling" %
+                                  self.service.servicename())
+        self.service.updateStale(self, stale, self.fallbackperiod)
 
     def _on_message(self, msg):
         """This is called when new message is available from the server.
         :param str msg: server message.
         """
 
+        self._on_data(jsondecode(msg, self.usedecimal))
+
+    def _on_data(self, data):
+        """This is called with the decoded JSON message from the server.
+        """
+
         pass
 
     def _on_connection_success(self):
@@ -114,7 +505,17 @@ class WebSocketClient(object):
     def _on_connection_close(self):
         """This is called when server closed the connection.
         """
-        self.service.logerror("websocket connection closed for %s" % self.service.servicename())
+        self.service.logerror("websocket connection closed for %s, reconnecting" %
+                              self.service.servicename())
+
+    def _on_disconnect(self):
+        """This is called when the connection is lost or closed.  Forget
+        any per connection state, like channel mappings, and make sure
+        no order book deltas are applied before a fresh snapshot is
+        received on the next connection.
+        """
+
+        pass
 
     def _on_connection_error(self, exception):
         """This is called in case if connection to the server could
@@ -123,3 +524,403 @@ class WebSocketClient(object):
         self.service.logerror("connection error for %s: %s" % (
             self.service.servicename(), str(exception)
         ))
+
+class WebSocketClientGroup(object):
+    """Several websocket clients for the same service, handled as one
+    client.  Used for services needing one connection per market, and
+    to spread the pairs of a service over several connections.  Each
+    client keep its own connection, reconnect and watchdog.
+
+    If rebalanceinterval is set, the pairs are moved between the
+    clients every rebalanceinterval seconds if the observed update
+    rates of the busiest client is more than rebalancethreshold times
+    the average.
+    """
+
+    rebalanceinterval = None
+    rebalancethreshold = 1.5
+    def __init__(self, service, clients = None):
+        self.service = service
+        self.clients = []
+        self._rebalancer = None
+        for client in clients or []:
+            self.add(client)
+
+    def add(self, client):
+        client.shard = len(self.clients)
+        self.clients.append(client)
+
+    def connect(self):
+        """Connect all the clients to their server."""
+        for client in self.clients:
+            client.connect()
+        if self.rebalanceinterval and self._rebalancer is None:
+            rebalancer = ioloop.PeriodicCallback(self.rebalance,
+                                                 self.rebalanceinterval * 1000)
+            self._rebalancer = rebalancer
+            def start():
+                # Unless closed while waiting for the loop
+                if self._rebalancer is rebalancer:
+                    rebalancer.start()
+            self.service._inloop(start)
+
+    def rebalance(self):
+        """Spread the pairs over the clients based on their observed update
+        rates, moving pairs only if the load is skewed.  Return True if
+        pairs were moved.
+        """
+        rates = {}
+        loads = []
+        for client in self.clients:
+            r = client.pairrates()
+            rates.update(r)
+            loads.append(sum(r.values()))
+            client.resetpairrates()
+        if 2 > len(self.clients) or 0 == sum(loads):
+            return False
+        average = sum(loads) / len(loads)
+        if max(loads) <= self.rebalancethreshold * average:
+            return False
+        maxpairs = self.clients[0].maxpairs
+        assigned = [[] for c in self.clients]
+        load = [0] * len(self.clients)
+        # Place the busiest pairs first, each on the least loaded
+        # client with room for it.
+        for pair in sorted(rates.keys(), key=lambda p: (-rates[p], p)):
+            candidates = [i for i in range(len(self.clients))
+                          if maxpairs is None or len(assigned[i]) < maxpairs]
+            i = min(candidates, key=lambda i: (load[i], len(assigned[i]), i))
+            assigned[i].append(pair)
+            load[i] += rates[pair]
+        moved = False
+        for client, pairs in zip(self.clients, assigned):
+            if set(pairs) != set(client.streampairs()):
+                client.setpairs(pairs)
+                moved = True
+        if moved:
+            self.service.addmetric('websocket.rebalances')
+        return moved
+
+    def close(self):
+        """Close all connections.
+        """
+        if self._rebalancer is not None:
+            self._rebalancer.stop()
+            self._rebalancer = None
+        for client in self.clients:
+            client.close()
+
+    def _on_message(self, msg):
+        """Pass a message to the first client.  Used when replaying
+        recordings where the receiving connection is unknown, while
+        replay() pass messages recorded from a group directly to the
+        client with the same shard number.
+        """
+        self.clients[0]._on_message(msg)
+
+def shard(service, factory, pairs = None, connections = 1):
+    """Return a websocket client following pairs (default to the wanted
+    pairs of service), created by calling factory(service, pairs=...).
+    The pairs are spread over the given number of connections, or more
+    if needed to stay within the maxpairs limit of the factory.  If
+    more than one connection is needed, a WebSocketClientGroup is
+    returned.
+    """
+    if pairs is None:
+        pairs = service.wantedpairs or []
+    pairs = list(pairs)
+    maxpairs = getattr(factory, 'maxpairs', None)
+    if maxpairs:
+        connections = max(connections, math.ceil(len(pairs) / maxpairs))
+    if 1 >= connections:
+        return factory(service, pairs=pairs)
+    return WebSocketClientGroup(service, [factory(service, pairs=pairs[i::connections])
+                                          for i in range(connections)])
+
+class TestSupervisor(unittest.TestCase):
+    """
+Run simple self test of reconnecting after lost connections.
+"""
+    def testBackoff(self):
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        connects = []
+        class Client(object):
+            service = s
+            def connect(self):
+                # Every connection attempt fail
+                connects.append(time.time())
+                sup.disconnected()
+        sup = ConnectionSupervisor(Client(), backoff=0.01, maxbackoff=0.04)
+        async def run():
+            start = time.time()
+            sup.disconnected()
+            while len(connects) < 5:
+                await gen.sleep(0.01)
+            sup.stop()
+            return start
+        start = s.ioloop.run_sync(run, timeout=5)
+        self.assertEqual(5, sup.reconnects)
+        self.assertEqual(5, s.metrics['websocket.reconnects'])
+        self.assertIsNone(sup._timeout)
+        self.assertEqual('disconnected', s.status['websocket'])
+        # The delays are capped by maxbackoff
+        self.assertTrue(connects[-1] - start <= 0.01 + 0.02 + 3 * 0.04 + 0.5)
+        self.assertTrue(sup.downtime() > 0)
+        # A connection dropped right away keep backing off
+        attempt = sup.attempt
+        sup.start()
+        sup.connected()
+        self.assertEqual('connected', s.status['websocket'])
+        sup.disconnected()
+        self.assertEqual(attempt + 1, sup.attempt)
+        sup.stop()
+        # After a connection staying up for a while, start from the
+        # shortest delay again
+        sup.start()
+        sup.connected()
+        sup.connectedsince -= 1
+        sup.disconnected()
+        self.assertEqual(1, sup.attempt)
+        sup.stop()
+
+class TestStale(unittest.TestCase):
+    """
+Run simple self test of falling back to REST polling for stale pairs.
+"""
+    def testFallback(self):
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        eur, usd = ('BTC', 'EUR'), ('BTC', 'USD')
+        c = WebSocketClient(s, pairs=[eur, usd])
+        changes = []
+        s.statussubscribers.append(
+            lambda service, key, value: changes.append((key, value)))
+        def stream(pair):
+            c._inmessage = True
+            s._notify(pair, True)
+            c._inmessage = False
+        async def run():
+            now = time.time()
+            c.lastmessage = now
+            c.lastpairupdate = {eur: now, usd: now}
+            c._checkstale()
+            self.assertEqual(set(), c.stalepairs)
+            self.assertIsNone(s.periodic)
+            # Only the pair without updates is polled
+            c.lastpairupdate[eur] = now - c.staletimeout - 1
+            c._checkstale()
+            self.assertEqual({eur}, c.stalepairs)
+            self.assertEqual([eur], s.periodicpairs)
+            self.assertIsNotNone(s.periodic)
+            # Nothing received at all, poll every pair
+            c.lastmessage = now - c.connectiontimeout() - 1
+            c._checkstale()
+            self.assertEqual({eur, usd}, c.stalepairs)
+            self.assertEqual([eur, usd], s.periodicpairs)
+            # Updates from REST polling do not count
+            c.lastmessage = time.time()
+            s._notify(eur, True)
+            c._checkstale()
+            self.assertEqual({eur}, c.stalepairs)
+            # The stream recovered
+            stream(eur)
+            c._checkstale()
+            self.assertEqual(set(), c.stalepairs)
+            self.assertIsNone(s.periodic)
+        s.ioloop.run_sync(run)
+        c.close()
+        self.assertEqual([('stream', 'stale'), ('stream', 'live')], changes)
+
+class TestBatch(unittest.TestCase):
+    """
+Run simple self test of handling bursts of messages as one batch.
+"""
+    def testCoalesce(self):
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        eur, usd = ('BTC', 'EUR'), ('BTC', 'USD')
+        class Client(WebSocketClient):
+            batch = True
+            def _on_data(self, data):
+                pair, changed = data
+                self.service._notify(tuple(pair), changed)
+        c = Client(s, pairs=[eur, usd])
+        notified = []
+        s.subscribe(lambda service, pair, changed:
+                    notified.append((pair, changed)))
+        async def run():
+            for m in [[eur, True], [usd, False], [eur, False], [usd, False]]:
+                c._read_message(json.dumps(m))
+            self.assertEqual([], notified)
+            await gen.sleep(0.01)
+        s.ioloop.run_sync(run)
+        # One notification per pair, changed if any of the updates was
+        self.assertEqual([(eur, True), (usd, False)], notified)
+        self.assertEqual(1, s.metrics['websocket.batches'])
+        self.assertEqual(4, s.metrics['websocket.batchedmessages'])
+        # Nested batches are handled when the outer one end
+        del notified[:]
+        s.beginBatch()
+        s.beginBatch()
+        s._notify(eur, False)
+        s.endBatch()
+        self.assertEqual([], notified)
+        s._notify(eur, True)
+        s.endBatch()
+        self.assertEqual([(eur, True)], notified)
+        self.assertEqual(0, s.batchdepth)
+        c.close()
+
+class TestSharding(unittest.TestCase):
+    """
+Run simple self test of the sharding of pairs over several connections.
+"""
+    def setUp(self):
+        from valutakrambod.service.dummyservice import DummyService
+        self.s = DummyService()
+        self.pairs = [('BTC', c) for c in ('EUR', 'USD', 'NOK', 'GBP', 'SEK')]
+    def testShard(self):
+        class Client(WebSocketClient):
+            maxpairs = 2
+        c = shard(self.s, WebSocketClient, pairs=self.pairs)
+        self.assertEqual(self.pairs, c.streampairs())
+        g = shard(self.s, Client, pairs=self.pairs)
+        self.assertEqual(3, len(g.clients))
+        self.assertEqual(sorted(self.pairs),
+                         sorted(sum([c.streampairs() for c in g.clients], [])))
+    def testRebalance(self):
+        g = shard(self.s, WebSocketClient, pairs=self.pairs[:4], connections=2)
+        busy = g.clients[0]
+        busypairs = list(busy.streampairs())
+        # Both pairs of the first client are busy, the others are quiet
+        busy._inmessage = True
+        for i in range(100):
+            for pair in busypairs:
+                self.s._notify(pair, True)
+        busy._inmessage = False
+        self.assertTrue(g.rebalance())
+        for c in g.clients:
+            self.assertEqual(1, len([p for p in c.streampairs()
+                                     if p in busypairs]))
+        # Balanced, nothing to do
+        self.assertFalse(g.rebalance())
+
+class TestOffload(unittest.TestCase):
+    """
+Run simple self test of parsing large messages outside the IO loop.
+"""
+    def testOrder(self):
+        import concurrent.futures
+        from valutakrambod.service.dummyservice import DummyService
+        s = DummyService()
+        s.jsonparser = concurrent.futures.ThreadPoolExecutor(1)
+        s.jsonparsethreshold = 100
+        received = []
+        class Client(WebSocketClient):
+            def _on_data(self, data):
+                received.append(data)
+        c = Client(s)
+        msgs = [[1], list(range(100)), [2], 'bad' * 50, [3]]
+        async def feed():
+            for m in msgs:
+                c._read_message(m if isinstance(m, str) else json.dumps(m))
+            while c._parsing:
+                await gen.sleep(0.01)
+        s.ioloop.run_sync(feed)
+        s.jsonparser.shutdown()
+        # The small messages wait for the large one, the bad one is dropped
+        self.assertEqual([[1], list(range(100)), [2], [3]], received)
+        self.assertEqual(2, s.metrics['json.offloaded'])
+
+class TestCounters(unittest.TestCase):
+    """
+Run simple self test of the byte counters using a local compressing
+websocket server.
+"""
+    def testBytes(self):
+        import tornado.httpserver
+        import tornado.netutil
+        import tornado.web
+        from valutakrambod.service.dummyservice import DummyService
+        msg = json.dumps([['BTC', 'EUR', '1.5', '2.5', 'Ø']] * 50,
+                         ensure_ascii=False)
+        class Sender(websocket.WebSocketHandler):
+            def get_compression_options(self):
+                return {}
+            async def open(self):
+                for i in range(10):
+                    await self.write_message(msg)
+        s = DummyService()
+        received = []
+        class Client(WebSocketClient):
+            def _on_data(self, data):
+                received.append(data)
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+        server = tornado.httpserver.HTTPServer(
+            tornado.web.Application([(r'/', Sender)]))
+        server.add_sockets(sockets)
+        c = Client(s)
+        async def run():
+            c.connect('ws://127.0.0.1:%d/' % sockets[0].getsockname()[1])
+            while len(received) < 10:
+                await gen.sleep(0.01)
+            c.close()
+        try:
+            s.ioloop.run_sync(run, timeout=10)
+        finally:
+            server.stop()
+        # Counted in bytes, not characters
+        self.assertEqual(10 * len(msg.encode('UTF-8')),
+                         s.metrics['websocket.bytes.decompressed'])
+        # The repeated content compress well
+        self.assertTrue(0 < s.metrics['websocket.bytes.wire'] < len(msg))
+
+class TestLoop(unittest.TestCase):
+    """
+Run simple self test of services using an explicitly given event loop.
+"""
+    def testLifecycle(self):
+        import asyncio
+        from valutakrambod.service.dummyservice import DummyService
+        loop = asyncio.new_event_loop()
+        s = DummyService(ioloop=loop)
+        def websocket():
+            c = WebSocketClient(s, pairs=[])
+            c.url = 'ws://127.0.0.1:1/'
+            return c
+        updates = []
+        s.subscribe(lambda service, pair, changed: updates.append(pair))
+        async def run():
+            async with s:
+                self.assertIsNotNone(s.periodic)
+            self.assertIsNone(s.periodic)
+            s.websocket = websocket
+            s.start()
+            c = s.stream
+            blocked = asyncio.ensure_future(asyncio.sleep(60))
+            s.inflight['blocked'] = blocked
+            s.beginBatch()
+            s._notify(('BTC', 'EUR'), True)
+            await s.aclose()
+            # Closing again is harmless
+            c.close()
+            await s.aclose()
+            # Restarting does not leave subscribers behind
+            subscribers = len(s.subscribers)
+            for i in range(5):
+                s.start()
+                await s.aclose()
+            self.assertEqual(subscribers, len(s.subscribers))
+            await asyncio.sleep(0.1)
+            return c, blocked
+        try:
+            c, blocked = loop.run_until_complete(run())
+            self.assertTrue(blocked.cancelled())
+            self.assertIsNone(c._watchdog)
+            self.assertIsNone(c._ws_connection)
+            self.assertIsNone(c.supervisor._timeout)
+            self.assertEqual(0, s.batchdepth)
+            self.assertIn(('BTC', 'EUR'), updates)
+        finally:
+            s.ioloop.close()